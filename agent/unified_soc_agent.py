@@ -4,8 +4,42 @@ import threading, socket, platform, uuid, hashlib, requests, psutil, time, webbr
 from datetime import datetime
 from collections import deque
 import json
+from urllib.parse import quote, urlencode
+
+try:
+    import websocket
+except ImportError:
+    websocket = None
 
 BACKEND = "http://localhost:8000"
+# With live updates connected the REST endpoints are only polled to reconcile, except
+# the risk score while the backend does not push it (no in-memory risk engine)
+RECONCILE_INTERVAL = 60
+POLL_INTERVAL = 2
+
+
+def login(username, password, backend=BACKEND):
+    """Log in through /auth/login; returns the access token, raises ValueError with the server's reason"""
+    res = requests.post(f"{backend}/auth/login", data={"username": username, "password": password}, timeout=10)
+    body = res.json()
+    if body.get("status") != "SUCCESS" or not body.get("access_token"):
+        raise ValueError(body.get("message") or body.get("error") or "Login failed")
+    return body["access_token"]
+
+
+def connect_push(username, token, topics, since=None, backend=BACKEND):
+    """Open the live update WebSocket and authenticate it with the login token.
+
+    The token goes in the first message rather than the URL, which proxies may log.
+    """
+    query = {"topics": ",".join(topics)}
+    if since is not None:
+        query["since"] = since
+    ws_url = backend.replace("http", "ws", 1)
+    conn = websocket.create_connection(f"{ws_url}/ws/{quote(username)}?{urlencode(query)}", timeout=30)
+    conn.send(json.dumps({"action": "auth", "token": token}))
+    return conn
+
 
 class UnifiedSOCAgent:
     def __init__(self, root):
@@ -14,8 +48,15 @@ class UnifiedSOCAgent:
         self.root.geometry("1400x900")
         self.root.configure(bg='#000000')
         self.username = None
+        self.password = None
+        self.access_token = None
         self.monitoring = False
         self.device_info = {}
+        self.push_connected = False
+        self.risk_push = False
+        self.last_seq = None
+        self.last_sync = 0
+        self.recent_files = []
         self.show_login()
     
     def show_login(self):
@@ -32,14 +73,25 @@ class UnifiedSOCAgent:
         tk.Label(center, text="Enter Username:", font=('Courier New', 12, 'bold'), bg='#000000', fg='#00ff00').pack(pady=(30,10))
         self.user_entry = tk.Entry(center, font=('Courier New', 14), bg='#001100', fg='#00ff00', insertbackground='#00ff00', width=30, bd=2, relief='solid')
         self.user_entry.pack(pady=10)
-        self.user_entry.bind('<Return>', lambda e: self.start_monitoring())
+        self.user_entry.bind('<Return>', lambda e: self.password_entry.focus_set())
+        
+        tk.Label(center, text="Enter Password:", font=('Courier New', 12, 'bold'), bg='#000000', fg='#00ff00').pack(pady=(10,10))
+        self.password_entry = tk.Entry(center, font=('Courier New', 14), bg='#001100', fg='#00ff00', insertbackground='#00ff00', width=30, bd=2, relief='solid', show='*')
+        self.password_entry.pack(pady=10)
+        self.password_entry.bind('<Return>', lambda e: self.start_monitoring())
         
         tk.Button(center, text="[ START MONITORING ]", command=self.start_monitoring, font=('Courier New', 12, 'bold'), bg='#001100', fg='#00ff00', activebackground='#00ff00', activeforeground='#000000', bd=2, relief='solid', padx=40, pady=10, cursor='hand2').pack(pady=20)
     
     def start_monitoring(self):
         self.username = self.user_entry.get().strip()
-        if not self.username:
-            messagebox.showerror("Error", "Username required!")
+        self.password = self.password_entry.get()
+        if not self.username or not self.password:
+            messagebox.showerror("Error", "Username and password required!")
+            return
+        try:
+            self.access_token = login(self.username, self.password)
+        except Exception as e:
+            messagebox.showerror("Login failed", str(e))
             return
         
         self.collect_device_info()
@@ -48,6 +100,8 @@ class UnifiedSOCAgent:
         self.create_dashboard()
         self.monitoring = True
         threading.Thread(target=self.monitor_loop, daemon=True).start()
+        if websocket is not None:
+            threading.Thread(target=self.push_loop, daemon=True).start()
     
     def collect_device_info(self):
         mem = psutil.virtual_memory()
@@ -206,34 +260,102 @@ NETWORK ADAPTERS:
         tk.Frame(inner, bg='#00ff00', height=2).pack(fill='x', padx=10)
         return inner
     
-    def monitor_loop(self):
+    def show_risk(self, risk_score):
+        self.stat_boxes['risk'].config(text=str(risk_score))
+        if risk_score >= 70:
+            self.stat_boxes['risk'].config(fg='#ff0000')
+        elif risk_score >= 50:
+            self.stat_boxes['risk'].config(fg='#ffaa00')
+        else:
+            self.stat_boxes['risk'].config(fg='#00ff00')
+    
+    def refresh_risk(self):
+        try:
+            res = requests.get(f"{BACKEND}/security/analyze/user/{self.username}", timeout=3)
+            if res.status_code == 200:
+                self.show_risk(res.json().get('risk_score', 0))
+        except:
+            pass
+    
+    def refresh_from_backend(self):
+        """Full risk and file list fetch; deltas from push_loop keep them current in between"""
+        self.last_sync = time.time()
+        self.refresh_risk()
+        
+        # Fetch file logs
+        try:
+            res = requests.get(f"{BACKEND}/files/list/{self.username}", timeout=3)
+            if res.status_code == 200:
+                self.recent_files = res.json()
+                self.stat_boxes['files'].config(text=str(len(self.recent_files)))
+                self.update_file_logs(self.recent_files)
+        except:
+            pass
+    
+    def push_loop(self):
+        """Receive risk deltas and file events over the backend WebSocket, resuming from the last sequence seen"""
+        topics = [f"risk:{self.username}", f"files:{self.username}"]
         while self.monitoring:
+            subscribed = False
             try:
-                # Fetch risk score from backend
+                conn = connect_push(self.username, self.access_token, topics, self.last_seq)
                 try:
-                    res = requests.get(f"{BACKEND}/security/analyze/user/{self.username}", timeout=3)
-                    if res.status_code == 200:
-                        user_data = res.json()
-                        risk_score = user_data.get('risk_score', 0)
-                        self.stat_boxes['risk'].config(text=str(risk_score))
-                        if risk_score >= 70:
-                            self.stat_boxes['risk'].config(fg='#ff0000')
-                        elif risk_score >= 50:
-                            self.stat_boxes['risk'].config(fg='#ffaa00')
-                        else:
-                            self.stat_boxes['risk'].config(fg='#00ff00')
-                except:
-                    pass
-                
-                # Fetch file logs
-                try:
-                    res = requests.get(f"{BACKEND}/files/list/{self.username}", timeout=3)
-                    if res.status_code == 200:
-                        files = res.json()
-                        self.stat_boxes['files'].config(text=str(len(files)))
-                        self.update_file_logs(files)
-                except:
-                    pass
+                    while self.monitoring:
+                        try:
+                            message = json.loads(conn.recv())
+                        except websocket.WebSocketTimeoutException:
+                            continue
+                        self.handle_push(message)
+                        subscribed = subscribed or self.push_connected
+                finally:
+                    self.push_connected = False
+                    conn.close()
+            except Exception as e:
+                self.push_connected = False
+                self.log_activity(f"[{datetime.now().strftime('%H:%M:%S')}] ✗ Live updates unavailable: {str(e)}")
+                time.sleep(5)
+                if not subscribed:
+                    # Closed before subscribing: most likely the token expired or was revoked
+                    try:
+                        self.access_token = login(self.username, self.password)
+                    except Exception as e:
+                        self.log_activity(f"[{datetime.now().strftime('%H:%M:%S')}] ✗ Login failed: {str(e)}")
+    
+    def handle_push(self, message):
+        kind = message.get('type')
+        seq = message.get('seq')
+        if kind == 'subscribed':
+            self.push_connected = True
+            self.risk_push = bool(message.get('risk_push'))
+            if self.last_seq is None:
+                self.last_seq = seq
+                self.refresh_from_backend()
+        elif kind == 'resync':
+            self.last_seq = message.get('seq')
+            self.refresh_from_backend()
+        elif kind == 'resumed':
+            self.last_seq = max(self.last_seq or 0, message.get('seq', 0))
+        elif seq is not None:
+            if self.last_seq is not None and seq <= self.last_seq:
+                return
+            self.last_seq = seq
+            if kind == 'risk_delta':
+                self.show_risk(message.get('risk_score', 0))
+                self.log_activity(f"[{datetime.now().strftime('%H:%M:%S')}] Risk {message.get('previous_score')} -> {message.get('risk_score')} {' '.join(message.get('signals', []))}")
+            elif kind == 'file_access':
+                for event in message.get('events', []):
+                    self.recent_files.insert(0, {'file_name': event.get('file_name') or 'N/A', 'action': event.get('action') or 'N/A', 'access_time': str(event.get('access_time'))})
+                del self.recent_files[50:]
+                self.stat_boxes['files'].config(text=str(len(self.recent_files)))
+                self.update_file_logs(self.recent_files)
+    
+    def monitor_loop(self):
+        while self.monitoring:
+            try:
+                if not self.push_connected or time.time() - self.last_sync >= RECONCILE_INTERVAL:
+                    self.refresh_from_backend()
+                elif not self.risk_push:
+                    self.refresh_risk()
                 
                 # Update stats
                 cpu = psutil.cpu_percent(interval=1)
@@ -254,7 +376,7 @@ NETWORK ADAPTERS:
                 if int(time.time()) % 30 == 0:
                     self.send_telemetry()
                 
-                time.sleep(2)
+                time.sleep(POLL_INTERVAL)
             except:
                 pass
     
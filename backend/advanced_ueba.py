@@ -1,73 +1,122 @@
 from datetime import datetime, timedelta
 
-def calculate_advanced_risk(username, db):
+CRITICAL_FILE_PATTERNS = ('%secret%', '%credential%', '%salary%')
+
+SIGNAL_COUNTERS = (
+    "critical_read", "critical_edit", "critical_download", "deletes", "edits",
+    "downloads", "odd_hour_logins", "failed_logins", "distinct_ips"
+)
+
+# All signal counters for a set of users in one round trip. File actions and
+# odd-hour logins look back 24 hours, failed logins 1 hour, distinct IPs 2 hours.
+RISK_COUNTERS_SQL = """
+    WITH critical AS (
+        SELECT user_id, action,
+               (file_name ILIKE %s OR file_name ILIKE %s OR file_name ILIKE %s) AS is_critical
+        FROM file_access_logs
+        WHERE user_id = ANY(%s) AND access_time > NOW() - INTERVAL '24 hours'
+    ), files AS (
+        SELECT user_id,
+               COUNT(*) FILTER (WHERE is_critical AND action = 'READ') AS critical_read,
+               COUNT(*) FILTER (WHERE is_critical AND action = 'WRITE') AS critical_edit,
+               COUNT(*) FILTER (WHERE is_critical AND action = 'DOWNLOAD') AS critical_download,
+               COUNT(*) FILTER (WHERE action = 'DELETE') AS deletes,
+               COUNT(*) FILTER (WHERE action = 'WRITE') AS edits,
+               COUNT(*) FILTER (WHERE action = 'DOWNLOAD') AS downloads
+        FROM critical
+        GROUP BY user_id
+    ), logins AS (
+        SELECT user_id,
+               COUNT(*) FILTER (WHERE EXTRACT(HOUR FROM login_time) >= 20 OR EXTRACT(HOUR FROM login_time) < 6) AS odd_hour_logins,
+               COUNT(*) FILTER (WHERE NOT success AND login_time > NOW() - INTERVAL '1 hour') AS failed_logins,
+               COUNT(DISTINCT ip_address) FILTER (WHERE login_time > NOW() - INTERVAL '2 hours') AS distinct_ips
+        FROM login_logs
+        WHERE user_id = ANY(%s) AND login_time > NOW() - INTERVAL '24 hours'
+        GROUP BY user_id
+    )
+    SELECT u.user_id,
+           COALESCE(f.critical_read, 0) AS critical_read,
+           COALESCE(f.critical_edit, 0) AS critical_edit,
+           COALESCE(f.critical_download, 0) AS critical_download,
+           COALESCE(f.deletes, 0) AS deletes,
+           COALESCE(f.edits, 0) AS edits,
+           COALESCE(f.downloads, 0) AS downloads,
+           COALESCE(l.odd_hour_logins, 0) AS odd_hour_logins,
+           COALESCE(l.failed_logins, 0) AS failed_logins,
+           COALESCE(l.distinct_ips, 0) AS distinct_ips
+    FROM unnest(%s::text[]) AS u(user_id)
+    LEFT JOIN files f ON f.user_id = u.user_id
+    LEFT JOIN logins l ON l.user_id = u.user_id
+"""
+
+def fetch_risk_counters(usernames, db):
+    """Signal counters keyed by username, zero-filled for users without activity"""
+    usernames = list(dict.fromkeys(usernames))
+    if not usernames:
+        return {}
     cursor = db.cursor(dictionary=True)
+    cursor.execute(RISK_COUNTERS_SQL, (*CRITICAL_FILE_PATTERNS, usernames, usernames, usernames))
+    rows = cursor.fetchall()
+    cursor.close()
+    return {row["user_id"]: {k: int(row.get(k) or 0) for k in SIGNAL_COUNTERS} for row in rows}
+
+def score_risk(counters):
     risk = 0
     signals = []
-    
+
     # Critical file READ (low risk)
-    cursor.execute("SELECT COUNT(*) as c FROM file_access_logs WHERE user_id=%s AND (file_name LIKE %s OR file_name LIKE %s OR file_name LIKE %s) AND action='READ' AND access_time > DATE_SUB(NOW(), INTERVAL 24 HOUR)", (username, '%secret%', '%credential%', '%salary%'))
-    c = cursor.fetchone()['c']
+    c = counters.get("critical_read", 0)
     if c > 0:
         risk += c * 5
         signals.append(f"CRITICAL_FILE_READ({c})")
-    
+
     # Critical file EDIT (very high risk - most dangerous)
-    cursor.execute("SELECT COUNT(*) as c FROM file_access_logs WHERE user_id=%s AND (file_name LIKE %s OR file_name LIKE %s OR file_name LIKE %s) AND action='WRITE' AND access_time > DATE_SUB(NOW(), INTERVAL 24 HOUR)", (username, '%secret%', '%credential%', '%salary%'))
-    c = cursor.fetchone()['c']
+    c = counters.get("critical_edit", 0)
     if c > 0:
         risk += c * 20
         signals.append(f"CRITICAL_FILE_EDIT({c})")
-    
+
     # Critical file DOWNLOAD (high risk)
-    cursor.execute("SELECT COUNT(*) as c FROM file_access_logs WHERE user_id=%s AND (file_name LIKE %s OR file_name LIKE %s OR file_name LIKE %s) AND action='DOWNLOAD' AND access_time > DATE_SUB(NOW(), INTERVAL 24 HOUR)", (username, '%secret%', '%credential%', '%salary%'))
-    c = cursor.fetchone()['c']
+    c = counters.get("critical_download", 0)
     if c > 0:
         risk += c * 12
         signals.append(f"CRITICAL_FILE_DOWNLOAD({c})")
-    
+
     # Any file deletion (high risk)
-    cursor.execute("SELECT COUNT(*) as c FROM file_access_logs WHERE user_id=%s AND action='DELETE' AND access_time > DATE_SUB(NOW(), INTERVAL 24 HOUR)", (username,))
-    c = cursor.fetchone()['c']
+    c = counters.get("deletes", 0)
     if c > 0:
         risk += c * 15
         signals.append(f"FILE_DELETION({c})")
-    
+
     # Regular file editing (low-medium risk)
-    cursor.execute("SELECT COUNT(*) as c FROM file_access_logs WHERE user_id=%s AND action='WRITE' AND access_time > DATE_SUB(NOW(), INTERVAL 24 HOUR)", (username,))
-    c = cursor.fetchone()['c']
+    c = counters.get("edits", 0)
     if c > 1:
         risk += c * 3
         signals.append(f"FILE_EDIT({c})")
-    
+
     # Regular file download (low risk)
-    cursor.execute("SELECT COUNT(*) as c FROM file_access_logs WHERE user_id=%s AND action='DOWNLOAD' AND access_time > DATE_SUB(NOW(), INTERVAL 24 HOUR)", (username,))
-    c = cursor.fetchone()['c']
+    c = counters.get("downloads", 0)
     if c > 3:
         risk += c * 2
         signals.append(f"FILE_DOWNLOAD({c})")
-    
-    cursor.execute("SELECT COUNT(*) as c FROM login_logs WHERE user_id=%s AND (HOUR(login_time) >= 20 OR HOUR(login_time) < 6) AND login_time > DATE_SUB(NOW(), INTERVAL 24 HOUR)", (username,))
-    c = cursor.fetchone()['c']
+
+    c = counters.get("odd_hour_logins", 0)
     if c > 0:
         risk += c * 8
         signals.append(f"ODD_HOUR_LOGIN({c})")
-    
-    cursor.execute("SELECT COUNT(*) as c FROM login_logs WHERE user_id=%s AND success=0 AND login_time > DATE_SUB(NOW(), INTERVAL 1 HOUR)", (username,))
-    c = cursor.fetchone()['c']
+
+    c = counters.get("failed_logins", 0)
     if c > 3:
         risk += 20
         signals.append(f"FAILED_LOGIN({c})")
-    
-    cursor.execute("SELECT COUNT(DISTINCT ip_address) as c FROM login_logs WHERE user_id=%s AND login_time > DATE_SUB(NOW(), INTERVAL 2 HOUR)", (username,))
-    c = cursor.fetchone()['c']
+
+    c = counters.get("distinct_ips", 0)
     if c > 2:
         risk += 15
         signals.append(f"MULTIPLE_IPS({c})")
-    
-    cursor.close()
+
     risk = min(risk, 100)
-    
+
     if risk <= 30:
         level, decision, zone = "LOW", "ALLOW", "CRITICAL"
     elif risk <= 50:
@@ -76,5 +125,20 @@ def calculate_advanced_risk(username, db):
         level, decision, zone = "HIGH", "RESTRICT", "INTERNAL"
     else:
         level, decision, zone = "CRITICAL", "DENY", "PUBLIC"
-    
+
     return {"risk_score": risk, "risk_level": level, "decision": decision, "zone": zone, "signals": signals}
+
+def calculate_advanced_risk_batch(usernames, db):
+    """Score many users with a single query, or from the in-memory risk engine once it is warm"""
+    from risk_engine import risk_engine
+
+    if risk_engine.ready:
+        return {username: risk_engine.score(username) for username in usernames}
+    counters = fetch_risk_counters(usernames, db)
+    scores = {username: score_risk(counters.get(username, {})) for username in usernames}
+    for username, score in scores.items():
+        risk_engine.observe(username, score)
+    return scores
+
+def calculate_advanced_risk(username, db):
+    return calculate_advanced_risk_batch([username], db)[username]
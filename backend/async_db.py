@@ -0,0 +1,149 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from mysql_database import get_db, pool as sync_pool
+
+# This is not a native async driver: asyncpg and psycopg 3 are not dependencies,
+# so statements still run on the psycopg2 pool, from a thread pool sized to it.
+# What the event loop gets is that it never blocks on the database; each
+# in-flight query still holds a thread as well as a connection.
+
+
+def _fetch_all(conn, sql, params):
+    cursor = conn.cursor(dictionary=True)
+    try:
+        cursor.execute(sql, params)
+        return [dict(row) for row in cursor.fetchall()]
+    finally:
+        cursor.close()
+
+
+def _fetch_one(conn, sql, params):
+    cursor = conn.cursor(dictionary=True)
+    try:
+        cursor.execute(sql, params)
+        row = cursor.fetchone()
+        return dict(row) if row else None
+    finally:
+        cursor.close()
+
+
+def _execute(conn, sql, params):
+    cursor = conn.cursor()
+    try:
+        cursor.execute(sql, params)
+        return cursor.rowcount
+    finally:
+        cursor.close()
+
+
+class ThreadConnection:
+    """A pooled psycopg2 connection whose statements run on the database executor"""
+
+    def __init__(self, database, conn):
+        self._database = database
+        self.conn = conn
+
+    async def fetch_all(self, sql, params=()):
+        return await self._database._call(_fetch_all, self.conn, sql, params)
+
+    async def fetch_one(self, sql, params=()):
+        return await self._database._call(_fetch_one, self.conn, sql, params)
+
+    async def fetch_val(self, sql, params=()):
+        row = await self.fetch_one(sql, params)
+        return next(iter(row.values())) if row else None
+
+    async def execute(self, sql, params=()):
+        return await self._database._call(_execute, self.conn, sql, params)
+
+
+class AsyncDatabase:
+    """Database access for async handlers that never blocks the event loop.
+
+    Queries run on the psycopg2 pool from an executor, so waiting on Postgres
+    ties up a worker thread rather than the loop. The query helpers run one
+    statement in its own transaction; use transaction() to group statements.
+
+    A transaction keeps its connection across awaits, and every statement in
+    it needs an executor thread. So everything that reaches the executor,
+    call() included, first takes a slot from an asyncio semaphore sized to
+    the pool: requests queue on the loop for a connection rather than in
+    executor threads blocked inside the pool, and the executor always has a
+    thread for every checked-out connection.
+    """
+
+    def __init__(self, max_connections=None):
+        self.max_connections = max_connections or (sync_pool.max_size + sync_pool.overflow)
+        self.max_workers = self.max_connections
+        self._executor = None
+        self._connections = None
+        self.backend = None
+
+    async def start(self):
+        if self.backend is not None:
+            return
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="db")
+        self._connections = asyncio.Semaphore(self.max_connections)
+        self.backend = "threads"
+
+    async def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+        self.backend = None
+
+    async def _call(self, fn, *args):
+        """Run fn on the executor; the caller already holds a connection slot"""
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    async def call(self, fn, *args):
+        """Run a blocking function that may take a pool connection (ingest, ActivityTracker) on the executor"""
+        await self.start()
+        async with self._connections:
+            return await self._call(fn, *args)
+
+    async def run_sync(self, fn, *args):
+        """Run fn(conn, *args) with a psycopg2 connection for code that is still synchronous"""
+        def run():
+            with get_db() as conn:
+                return fn(conn, *args)
+        return await self.call(run)
+
+    @asynccontextmanager
+    async def transaction(self):
+        await self.start()
+        async with self._connections:
+            conn = await self._call(get_db)
+            try:
+                yield ThreadConnection(self, conn)
+            except BaseException as e:
+                await self._call(conn.__exit__, type(e), e, e.__traceback__)
+                raise
+            else:
+                await self._call(conn.__exit__, None, None, None)
+
+    async def fetch_all(self, sql, params=()):
+        async with self.transaction() as conn:
+            return await conn.fetch_all(sql, params)
+
+    async def fetch_one(self, sql, params=()):
+        async with self.transaction() as conn:
+            return await conn.fetch_one(sql, params)
+
+    async def fetch_val(self, sql, params=()):
+        async with self.transaction() as conn:
+            return await conn.fetch_val(sql, params)
+
+    async def execute(self, sql, params=()):
+        async with self.transaction() as conn:
+            return await conn.execute(sql, params)
+
+    def stats(self):
+        stats = {"backend": self.backend, "executor_workers": self.max_workers, "max_connections": self.max_connections}
+        if self._connections is not None:
+            stats["connections_free"] = self._connections._value
+        return stats
+
+
+async_db = AsyncDatabase()
@@ -1,6 +1,10 @@
 from fastapi import APIRouter, Request
 from datetime import datetime
 from database import get_db
+from risk_engine import risk_engine
+from geolocation import geo_resolver
+from client_ip import get_client_ip, login_ip
+from password_hasher import password_hasher
 import psycopg2.extras
 
 router = APIRouter(prefix="/auth", tags=["Auth"])
@@ -10,52 +14,25 @@ async def login(request: Request, username: str, password: str):
     db = get_db()
     cursor = db.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
     
-    cursor.execute("SELECT * FROM users WHERE username=%s AND password=%s", (username, password))
+    cursor.execute("SELECT * FROM users WHERE username=%s", (username,))
     user = cursor.fetchone()
     
-    success = bool(user)
-    ip = request.client.host
+    success = False
+    if user:
+        success, new_hash = await password_hasher.verify(password, user["password"])
+        if new_hash:
+            cursor.execute("UPDATE users SET password=%s WHERE username=%s", (new_hash, username))
+    ip = get_client_ip(request)
     
-    # Get real public IP if behind proxy/NAT
-    real_ip = ip
-    try:
-        import requests
-        public_ip_response = requests.get("https://api.ipify.org?format=json", timeout=3).json()
-        real_ip = public_ip_response.get("ip", ip)
-    except:
-        pass
+    # Local clients are recorded under the server's public IP (resolved once at startup)
+    real_ip = login_ip(request)
     
-    # Get geolocation from real public IP
-    country = "Unknown"
-    city = "Unknown"
-    
-    try:
-        import requests
-        # Try ip-api.com with real public IP
-        geo = requests.get(f"http://ip-api.com/json/{real_ip}", timeout=3).json()
-        if geo.get("status") == "success":
-            country = geo.get("country", "Unknown")
-            city = geo.get("city", "Unknown")
-            lat = geo.get("lat")
-            lon = geo.get("lon")
-            if lat and lon:
-                city = f"{city} ({lat:.2f}, {lon:.2f})"
-    except:
-        pass
-    
-    # If still unknown, try ipapi.co
-    if country == "Unknown":
-        try:
-            import requests
-            geo = requests.get(f"https://ipapi.co/{real_ip}/json/", timeout=3).json()
-            country = geo.get("country_name", "Unknown")
-            city = geo.get("city", "Unknown")
-            lat = geo.get("latitude")
-            lon = geo.get("longitude")
-            if lat and lon:
-                city = f"{city} ({lat:.2f}, {lon:.2f})"
-        except:
-            pass
+    # Resolved locally; unknown IPs are looked up and backfilled in the background
+    geo = geo_resolver.lookup(real_ip)
+    country = geo["country"]
+    city = geo["city"]
+    if geo.get("latitude") and geo.get("longitude"):
+        city = f"{city} ({geo['latitude']:.2f}, {geo['longitude']:.2f})"
     
     # If still unknown and local IP, mark as local
     if country == "Unknown" and (ip.startswith(("127.", "10.", "192.168.", "172.")) or ip in ["localhost", "::1"]):
@@ -67,6 +44,7 @@ async def login(request: Request, username: str, password: str):
         VALUES (%s,%s,%s,%s,%s,%s)
     """, (username, datetime.now(), real_ip, success, country, city))
     db.commit()
+    risk_engine.record_login(username, real_ip, success)
     cursor.close()
     db.close()
     
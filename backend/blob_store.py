@@ -0,0 +1,179 @@
+import asyncio
+import hashlib
+import os
+import re
+import tempfile
+import time
+
+_DIGEST = re.compile(r"^[0-9a-f]{64}$")
+
+
+class BlobStore:
+    """Content-addressed file bodies on local disk.
+
+    A body is stored once under its SHA-256 digest, sharded as
+    <root>/ab/cd/<digest>, so identical uploads and unchanged versions share
+    one copy. Blobs are written to a temporary file and renamed into place,
+    and never modified afterwards.
+
+    collect() removes blobs nothing references any more. A blob's mtime is
+    refreshed whenever an upload finds it already stored, and blobs younger
+    than the grace period are kept, so a write whose row is not committed
+    yet is never collected. Callers cannot shorten the grace period below
+    min_grace_seconds.
+    """
+
+    def __init__(self, root, fsync=True, min_grace_seconds=3600):
+        self.root = root
+        self.fsync = fsync
+        self.min_grace_seconds = min_grace_seconds
+        self.writes = 0
+        self.dedup_hits = 0
+        self.bytes_written = 0
+        self.collected = 0
+
+    def path(self, digest):
+        if not _DIGEST.match(digest or ""):
+            raise ValueError(f"Invalid blob digest: {digest!r}")
+        return os.path.join(self.root, digest[:2], digest[2:4], digest)
+
+    def exists(self, digest):
+        return os.path.exists(self.path(digest))
+
+    def put(self, data):
+        """Store bytes; returns (digest, size)"""
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path(digest)
+        if os.path.exists(path):
+            try:
+                os.utime(path)
+                self.dedup_hits += 1
+                return digest, len(data)
+            except FileNotFoundError:
+                # Collected between the check and the touch; write it again
+                pass
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+                if self.fsync:
+                    f.flush()
+                    os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        self.writes += 1
+        self.bytes_written += len(data)
+        return digest, len(data)
+
+    def get(self, digest):
+        with open(self.path(digest), "rb") as f:
+            return f.read()
+
+    async def iter_range(self, digest, start, end, chunk_size=64 * 1024):
+        """Yield bytes start..end (inclusive) of a blob in chunks, reading off the event loop"""
+        loop = asyncio.get_running_loop()
+        fd = await loop.run_in_executor(None, os.open, self.path(digest), os.O_RDONLY)
+        try:
+            position = start
+            while position <= end:
+                chunk = await loop.run_in_executor(None, os.pread, fd, min(chunk_size, end - position + 1), position)
+                if not chunk:
+                    break
+                position += len(chunk)
+                yield chunk
+        finally:
+            os.close(fd)
+
+    async def write(self, data):
+        return await asyncio.get_running_loop().run_in_executor(None, self.put, data)
+
+    async def read(self, digest):
+        return await asyncio.get_running_loop().run_in_executor(None, self.get, digest)
+
+    def collect(self, referenced, grace_seconds=3600):
+        """Delete blobs (and abandoned temp files) not in `referenced` and untouched for grace_seconds"""
+        grace_seconds = max(grace_seconds, self.min_grace_seconds)
+        cutoff = time.time() - grace_seconds
+        scanned = deleted = freed = 0
+        for directory, _, names in os.walk(self.root):
+            for name in names:
+                if not (_DIGEST.match(name) or name.startswith(".tmp-")):
+                    continue
+                scanned += 1
+                if name in referenced:
+                    continue
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                    if stat.st_mtime >= cutoff:
+                        continue
+                    os.unlink(path)
+                except FileNotFoundError:
+                    continue
+                deleted += 1
+                freed += stat.st_size
+        self.collected += deleted
+        return {"scanned": scanned, "deleted": deleted, "bytes_freed": freed, "grace_seconds": grace_seconds}
+
+    def stats(self):
+        return {"root": self.root, "writes": self.writes, "dedup_hits": self.dedup_hits,
+                "bytes_written": self.bytes_written, "collected": self.collected}
+
+
+blob_store = BlobStore(
+    root=os.getenv("BLOB_DIR", "blobs"),
+    fsync=os.getenv("BLOB_FSYNC", "1") == "1",
+    min_grace_seconds=int(os.getenv("BLOB_GC_MIN_GRACE", "3600"))
+)
+
+
+async def store_content(content):
+    """Store a text body; returns (digest, size in bytes)"""
+    return await blob_store.write(content.encode("utf-8"))
+
+
+async def load_content(file):
+    """Body of a files row: from the blob store, or inline for rows not yet migrated"""
+    if file.get("content_sha256"):
+        return (await blob_store.read(file["content_sha256"])).decode("utf-8")
+    return file.get("file_content") or ""
+
+
+def collect_garbage(conn, grace_seconds=3600):
+    """Collect blobs no longer referenced by files or file_versions, e.g. bodies superseded by an edit"""
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT content_sha256 FROM files WHERE content_sha256 IS NOT NULL
+        UNION
+        SELECT blob_sha256 FROM file_versions
+    """)
+    referenced = {row[0] for row in cursor.fetchall()}
+    cursor.close()
+    return blob_store.collect(referenced, grace_seconds)
+
+
+def migrate_inline_content(conn, batch_size=500):
+    """Move file_content still stored in files rows into the blob store; returns rows moved"""
+    moved = 0
+    cursor = conn.cursor()
+    while True:
+        cursor.execute("""
+            SELECT id, file_content FROM files
+            WHERE content_sha256 IS NULL AND file_content IS NOT NULL
+            LIMIT %s
+        """, (batch_size,))
+        rows = cursor.fetchall()
+        if not rows:
+            break
+        for file_id, content in rows:
+            digest, size = blob_store.put(content.encode("utf-8"))
+            cursor.execute("UPDATE files SET content_sha256 = %s, file_size = %s, file_content = NULL WHERE id = %s",
+                           (digest, size, file_id))
+        moved += len(rows)
+    cursor.close()
+    return moved
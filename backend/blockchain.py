@@ -1,29 +1,541 @@
+import glob
 import hashlib
 import json
+import os
+import queue
+import threading
+import time
+import uuid
+from collections import deque
 from datetime import datetime
+import psycopg2.extras
+from mysql_database import get_db
+from spool import load_checkpoint, save_checkpoint
 
-class Block:
-    def __init__(self, index, data, prev_hash):
-        self.index = index
-        self.timestamp = datetime.utcnow().isoformat()
-        self.data = data
-        self.prev_hash = prev_hash
-        self.hash = self.calculate_hash()
+GENESIS_HASH = '0' * 64
+DROPPED_EVENT = 'AUDIT_EVENTS_DROPPED'
+
+
+def entry_hash(block_index, timestamp, event_type, user_id, data_str, previous_hash):
+    raw = f"{block_index}{timestamp}{event_type}{user_id}{data_str}{previous_hash}"
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+def block_hash(block_number, first_index, last_index, merkle, previous_block_hash):
+    raw = f"{block_number}{first_index}{last_index}{merkle}{previous_block_hash}"
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+def _pair_hash(left, right):
+    return hashlib.sha256((left + right).encode()).hexdigest()
+
+
+def merkle_levels(leaves):
+    """All tree levels from the leaves up; an odd node is paired with itself"""
+    levels = [list(leaves)]
+    while len(levels[-1]) > 1:
+        level = levels[-1]
+        if len(level) % 2:
+            level = level + [level[-1]]
+        levels.append([_pair_hash(level[i], level[i + 1]) for i in range(0, len(level), 2)])
+    return levels
+
+
+def merkle_root(leaves):
+    return merkle_levels(leaves)[-1][0] if leaves else GENESIS_HASH
+
+
+def merkle_proof(leaves, position):
+    """Sibling hashes from leaf to root, each tagged with the side it sits on"""
+    proof = []
+    for level in merkle_levels(leaves)[:-1]:
+        if len(level) % 2:
+            level = level + [level[-1]]
+        sibling = position ^ 1
+        proof.append({"hash": level[sibling], "side": "left" if sibling < position else "right"})
+        position //= 2
+    return proof
+
+
+def verify_merkle_proof(leaf, proof, root):
+    node = leaf
+    for step in proof:
+        node = _pair_hash(step["hash"], node) if step["side"] == "left" else _pair_hash(node, step["hash"])
+    return node == root
 
-    def calculate_hash(self):
-        raw = f"{self.index}{self.timestamp}{json.dumps(self.data)}{self.prev_hash}"
-        return hashlib.sha256(raw.encode()).hexdigest()
 
 class AuditChain:
-    def __init__(self):
-        self.chain = [self.genesis()]
+    """Durable, append-only audit chain stored in blockchain_audit.
+
+    append() only queues the event. A single writer thread owns the cached
+    chain head, assigns block indexes and previous_hash links, and commits
+    everything queued (up to `batch_size` events) in one transaction. Each
+    commit is one block in audit_blocks, sealed with the Merkle root of its
+    event hashes and linked to the previous block's hash.
+
+    append() never blocks the caller. When a commit fails, the writer moves
+    the failed batch and everything queued to `spill_path`, one JSON event
+    per line, and commits the spill back in order before anything queued
+    after it. The replay position is saved in spool_checkpoints with each
+    block, so a restart neither skips nor repeats spilled events.
+
+    Events are only dropped when the queue is full (no spill path, or the
+    writer cannot keep up even with the disk). Drops are counted in stats()
+    and the next block records them as an AUDIT_EVENTS_DROPPED event, so
+    the gap is visible in the chain itself.
+    """
+
+    def __init__(self, batch_size=100, max_latency=0.5, queue_size=10000, recent_size=50, spill_path=None):
+        self.batch_size = batch_size
+        self.spill_path = spill_path
+        self.max_latency = max_latency
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._recent = deque(maxlen=recent_size)
+        self._recent_lock = threading.Lock()
+        self._head = None  # (block_index, current_hash) of the last committed event
+        self._block_head = None  # (block_number, block_hash) of the last sealed block
+        self._thread = None
+        self._stopping = threading.Event()
+        self._retry_batch = []
+        self._spill_replay = None  # [path, checkpoint name, position] of the spill file being replayed
+        self._listeners = []
+        self.committed = 0
+        self.commits = 0
+        self.failures = 0
+        self.spilled = 0
+        self.spill_replayed = 0
+        self.dropped = 0
+        self._unrecorded_drops = 0
+        self._overflowing = False
+
+    def append(self, event_type, user_id, event_data):
+        """Queue an event; returns its transaction id, or None if the queue was full and it was dropped"""
+        tx_id = uuid.uuid4().hex
+        try:
+            self._queue.put_nowait({
+                'tx_id': tx_id,
+                'event_type': event_type,
+                'user_id': user_id,
+                'event_data': event_data,
+                'timestamp': datetime.now()
+            })
+        except queue.Full:
+            self.dropped += 1
+            self._unrecorded_drops += 1
+            if not self._overflowing:
+                self._overflowing = True
+                print(f"Audit queue full ({self._queue.maxsize} events), dropping events until the writer catches up")
+            return None
+        return tx_id
+
+    def head(self):
+        return self._head
+
+    def add_listener(self, fn):
+        """Call fn(entries) on the writer thread after each committed block"""
+        self._listeners.append(fn)
+
+    def recent(self, limit=10):
+        """Most recently committed events, newest first"""
+        with self._recent_lock:
+            return list(self._recent)[-limit:][::-1]
+
+    def _load_head(self, conn):
+        cursor = conn.cursor(dictionary=True)
+        cursor.execute("""
+            SELECT block_index, timestamp, event_type, user_id, event_data, tx_id,
+                   current_hash, previous_hash
+            FROM blockchain_audit
+            ORDER BY block_index DESC
+            LIMIT %s
+        """, (self._recent.maxlen,))
+        rows = cursor.fetchall()
+        cursor.close()
+        self._head = (rows[0]['block_index'], rows[0]['current_hash']) if rows else (0, GENESIS_HASH)
+        cursor = conn.cursor()
+        cursor.execute("SELECT block_number, block_hash FROM audit_blocks ORDER BY block_number DESC LIMIT 1")
+        block = cursor.fetchone()
+        cursor.close()
+        self._block_head = (block[0], block[1]) if block else (0, GENESIS_HASH)
+        with self._recent_lock:
+            self._recent.clear()
+            for row in reversed(rows):
+                row['event_data'] = json.loads(row['event_data']) if row['event_data'] else {}
+                self._recent.append(row)
+
+    def _collect(self):
+        """Wait for an event, then keep gathering until the batch is full or max_latency passes"""
+        batch = self._retry_batch
+        self._retry_batch = []
+        if not batch:
+            try:
+                batch.append(self._queue.get(timeout=self.max_latency))
+            except queue.Empty:
+                return batch
+        deadline = time.monotonic() + self.max_latency
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0 and not self._stopping.is_set():
+                    batch.append(self._queue.get(timeout=remaining))
+                else:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _commit(self, batch, mark=None):
+        """Seal batch as one block; mark is a (checkpoint name, position) saved in the same transaction"""
+        with get_db() as conn:
+            if self._head is None:
+                self._load_head(conn)
+            index, previous_hash = self._head
+            block_number, previous_block_hash = self._block_head
+            block_number += 1
+            first_index = index + 1
+            rows = []
+            entries = []
+            for event in batch:
+                index += 1
+                data_str = json.dumps(event['event_data'], sort_keys=True, default=str)
+                timestamp = event['timestamp']
+                current_hash = entry_hash(index, timestamp.isoformat(), event['event_type'], event['user_id'], data_str, previous_hash)
+                rows.append((index, timestamp, event['event_type'], event['user_id'], data_str, event['tx_id'], current_hash, previous_hash, block_number))
+                entries.append({
+                    'block_index': index, 'timestamp': timestamp, 'event_type': event['event_type'],
+                    'user_id': event['user_id'], 'event_data': event['event_data'], 'tx_id': event['tx_id'],
+                    'current_hash': current_hash, 'previous_hash': previous_hash, 'block_number': block_number
+                })
+                previous_hash = current_hash
+            root = merkle_root([row[6] for row in rows])
+            sealed_hash = block_hash(block_number, first_index, index, root, previous_block_hash)
+            cursor = conn.cursor()
+            psycopg2.extras.execute_values(cursor, """
+                INSERT INTO blockchain_audit (block_index, timestamp, event_type, user_id,
+                                              event_data, tx_id, current_hash, previous_hash, block_number)
+                VALUES %s
+            """, rows, page_size=len(rows))
+            cursor.execute("""
+                INSERT INTO audit_blocks (block_number, first_index, last_index, event_count,
+                                          merkle_root, previous_block_hash, block_hash)
+                VALUES (%s, %s, %s, %s, %s, %s, %s)
+            """, (block_number, first_index, index, len(rows), root, previous_block_hash, sealed_hash))
+            if mark:
+                save_checkpoint(cursor, mark[0], 0, mark[1])
+            cursor.close()
+        self._head = (index, previous_hash)
+        self._block_head = (block_number, sealed_hash)
+        with self._recent_lock:
+            self._recent.extend(entries)
+        self.committed += len(batch)
+        self.commits += 1
+        self._overflowing = False
+        for listener in self._listeners:
+            try:
+                listener(entries)
+            except Exception as e:
+                print(f"Audit chain listener failed: {e}")
+
+    def _drop_notice(self):
+        """An event recording drops not yet in the chain, or None"""
+        count = self._unrecorded_drops
+        if not count:
+            return None
+        self._unrecorded_drops -= count
+        return {
+            'tx_id': uuid.uuid4().hex,
+            'event_type': DROPPED_EVENT,
+            'user_id': 'system',
+            'event_data': {'count': count, 'total_dropped': self.dropped},
+            'timestamp': datetime.now()
+        }
+
+    def _spill(self, batch):
+        """Move batch and everything queued behind it to the spill file; False if it cannot be written"""
+        events = list(batch)
+        while True:
+            try:
+                events.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        if not events:
+            return True
+        try:
+            with open(self.spill_path, "a", encoding="utf-8") as f:
+                for event in events:
+                    f.write(json.dumps({**event, 'timestamp': event['timestamp'].isoformat()}, default=str) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+        except OSError as e:
+            print(f"Audit spill failed, keeping events in memory: {e}")
+            # Whatever was taken off the queue beyond the batch stays pending with it
+            self._retry_batch = events
+            return False
+        self.spilled += len(events)
+        return True
+
+    def _replay_spill(self):
+        """Commit the next block from the spill file; returns the number of events replayed"""
+        if not self.spill_path:
+            return 0
+        if self._spill_replay is None:
+            replays = sorted(glob.glob(glob.escape(self.spill_path) + ".replay*"))
+            if not replays:
+                if not os.path.exists(self.spill_path):
+                    return 0
+                # A fresh name per file, so its checkpoint never applies to a later one
+                replays = [f"{self.spill_path}.replay-{time.time_ns()}-{uuid.uuid4().hex[:8]}"]
+                os.replace(self.spill_path, replays[0])
+            name = f"audit-spill:{os.path.basename(replays[0])}"
+            with get_db() as conn:
+                cursor = conn.cursor()
+                position = (load_checkpoint(cursor, name) or (0, 0))[1]
+                cursor.close()
+            self._spill_replay = [replays[0], name, position]
+        path, name, position = self._spill_replay
+        batch = []
+        with open(path, "rb") as f:
+            f.seek(position)
+            for line in f:
+                try:
+                    event = json.loads(line)
+                    event['timestamp'] = datetime.fromisoformat(event['timestamp'])
+                except (ValueError, KeyError, TypeError):
+                    # A line torn by a crash mid-write
+                    position += len(line)
+                    continue
+                position += len(line)
+                batch.append(event)
+                if len(batch) >= self.batch_size:
+                    break
+        if not batch:
+            os.remove(path)
+            with get_db() as conn:
+                cursor = conn.cursor()
+                cursor.execute("DELETE FROM spool_checkpoints WHERE name = %s", (name,))
+                cursor.close()
+            self._spill_replay = None
+            # Events spilled while this file was replayed come next, before anything queued
+            return self._replay_spill()
+        self._commit(batch, (name, position))
+        self._spill_replay[2] = position
+        self.spill_replayed += len(batch)
+        return len(batch)
+
+    def _failed(self, batch, backoff, error):
+        """Set batch aside after a failed commit; returns True if the writer should stop"""
+        # Another writer may have advanced the chain (unique block_index) - re-read the head
+        self.failures += 1
+        self._head = None
+        self._spill_replay = None
+        if self.spill_path and self._spill(batch):
+            self._retry_batch = []
+        elif batch:
+            self._retry_batch = self._retry_batch or batch
+        print(f"Audit chain commit failed, retrying in {backoff:.0f}s: {error}")
+        return self._stopping.is_set() or self._stopping.wait(backoff)
+
+    def _run(self):
+        backoff = 1.0
+        while True:
+            try:
+                if self._replay_spill():
+                    backoff = 1.0
+                    continue
+            except Exception as e:
+                # Keep what arrives meanwhile behind the spill, in order
+                if self._failed(list(self._retry_batch), backoff, e):
+                    return
+                backoff = min(backoff * 2, 30.0)
+                continue
+            batch = self._collect()
+            notice = self._drop_notice()
+            if notice:
+                batch.append(notice)
+            if not batch:
+                if self._stopping.is_set():
+                    return
+                continue
+            try:
+                self._commit(batch)
+                backoff = 1.0
+            except Exception as e:
+                if self._failed(batch, backoff, e):
+                    return
+                backoff = min(backoff * 2, 30.0)
+
+    def start(self):
+        if self._thread is None:
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name="audit-chain-writer", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=10):
+        """Flush queued events and stop the writer"""
+        if self._thread is not None:
+            self._stopping.set()
+            self._thread.join(timeout=timeout)
+            self._thread = None
+
+    def inclusion_proof(self, conn, block_index):
+        """Merkle proof that the event at block_index is part of its sealed block"""
+        cursor = conn.cursor(dictionary=True)
+        cursor.execute("""
+            SELECT a.block_index, a.timestamp, a.event_type, a.user_id, a.event_data, a.tx_id,
+                   a.current_hash, a.previous_hash, b.block_number, b.first_index, b.last_index,
+                   b.merkle_root, b.previous_block_hash, b.block_hash
+            FROM blockchain_audit a
+            JOIN audit_blocks b ON b.block_number = a.block_number
+            WHERE a.block_index = %s
+        """, (block_index,))
+        event = cursor.fetchone()
+        if not event:
+            cursor.close()
+            return None
+        cursor.execute("""
+            SELECT current_hash FROM blockchain_audit
+            WHERE block_index BETWEEN %s AND %s
+            ORDER BY block_index
+        """, (event['first_index'], event['last_index']))
+        leaves = [row['current_hash'] for row in cursor.fetchall()]
+        cursor.close()
+        position = block_index - event['first_index']
+        proof = merkle_proof(leaves, position)
+        return {
+            "block_index": block_index,
+            "leaf": event['current_hash'],
+            "position": position,
+            "proof": proof,
+            "merkle_root": event['merkle_root'],
+            "verified": verify_merkle_proof(event['current_hash'], proof, event['merkle_root']),
+            "block": {
+                "block_number": event['block_number'],
+                "first_index": event['first_index'],
+                "last_index": event['last_index'],
+                "previous_block_hash": event['previous_block_hash'],
+                "block_hash": event['block_hash']
+            },
+            "event": {
+                "timestamp": event['timestamp'].isoformat() if event['timestamp'] else None,
+                "event_type": event['event_type'],
+                "user_id": event['user_id'],
+                "event_data": json.loads(event['event_data']) if event['event_data'] else {},
+                "tx_id": event['tx_id'],
+                "previous_hash": event['previous_hash']
+            }
+        }
+
+    def verify_new_blocks(self, conn, limit=1000):
+        """Verify blocks sealed since the last checkpoint and advance it past the valid ones"""
+        cursor = conn.cursor(dictionary=True)
+        cursor.execute("SELECT block_number, block_hash FROM audit_checkpoints WHERE name = 'verifier'")
+        checkpoint = cursor.fetchone()
+        last_number, last_hash = (checkpoint['block_number'], checkpoint['block_hash']) if checkpoint else (0, GENESIS_HASH)
+        last_event_hash = None
+        if checkpoint:
+            cursor.execute("""
+                SELECT a.current_hash FROM audit_blocks b
+                JOIN blockchain_audit a ON a.block_index = b.last_index
+                WHERE b.block_number = %s
+            """, (last_number,))
+            row = cursor.fetchone()
+            last_event_hash = row['current_hash'] if row else None
+
+        cursor.execute("""
+            SELECT block_number, first_index, last_index, event_count, merkle_root,
+                   previous_block_hash, block_hash
+            FROM audit_blocks WHERE block_number > %s
+            ORDER BY block_number LIMIT %s
+        """, (last_number, limit))
+        blocks = cursor.fetchall()
+
+        verified = 0
+        error = None
+        for block in blocks:
+            cursor.execute("""
+                SELECT block_index, timestamp, event_type, user_id, event_data, current_hash, previous_hash
+                FROM blockchain_audit WHERE block_index BETWEEN %s AND %s
+                ORDER BY block_index
+            """, (block['first_index'], block['last_index']))
+            events = cursor.fetchall()
+            error = self._check_block(block, events, last_hash, last_event_hash)
+            if error:
+                break
+            last_number, last_hash = block['block_number'], block['block_hash']
+            last_event_hash = events[-1]['current_hash']
+            verified += 1
+
+        if verified:
+            cursor.execute("""
+                INSERT INTO audit_checkpoints (name, block_number, block_hash, verified_at)
+                VALUES ('verifier', %s, %s, NOW())
+                ON CONFLICT (name) DO UPDATE SET block_number = EXCLUDED.block_number,
+                    block_hash = EXCLUDED.block_hash, verified_at = EXCLUDED.verified_at
+            """, (last_number, last_hash))
+        cursor.close()
+        return {
+            "valid": error is None,
+            "blocks_verified": verified,
+            "checkpoint": last_number,
+            "error": error,
+            "more": error is None and len(blocks) == limit,
+            "dropped_events": self.dropped
+        }
+
+    @staticmethod
+    def _check_block(block, events, previous_block_hash, previous_event_hash):
+        number = block['block_number']
+        if block['previous_block_hash'] != previous_block_hash:
+            return f"Block {number} does not link to the previous block"
+        if len(events) != block['event_count']:
+            return f"Block {number} has {len(events)} events, expected {block['event_count']}"
+        for event in events:
+            if previous_event_hash is not None and event['previous_hash'] != previous_event_hash:
+                return f"Event {event['block_index']} does not link to the previous event"
+            recomputed = entry_hash(event['block_index'], event['timestamp'].isoformat(), event['event_type'],
+                                    event['user_id'], event['event_data'], event['previous_hash'])
+            if recomputed != event['current_hash']:
+                return f"Event {event['block_index']} hash mismatch"
+            previous_event_hash = event['current_hash']
+        if merkle_root([e['current_hash'] for e in events]) != block['merkle_root']:
+            return f"Block {number} Merkle root mismatch"
+        if block_hash(number, block['first_index'], block['last_index'], block['merkle_root'], block['previous_block_hash']) != block['block_hash']:
+            return f"Block {number} hash mismatch"
+        return None
+
+    def _spill_pending_bytes(self):
+        if not self.spill_path:
+            return 0
+        pending = 0
+        for path in [self.spill_path] + glob.glob(glob.escape(self.spill_path) + ".replay*"):
+            try:
+                pending += os.path.getsize(path)
+            except OSError:
+                pass
+        replay = self._spill_replay
+        if replay and os.path.exists(replay[0]):
+            pending -= replay[2]
+        return max(pending, 0)
 
-    def genesis(self):
-        return Block(0, {"event": "GENESIS"}, "0")
+    def stats(self):
+        return {
+            "head_index": self._head[0] if self._head else None,
+            "head_block": self._block_head[0] if self._block_head else None,
+            "queued": self._queue.qsize() + len(self._retry_batch),
+            "queue_capacity": self._queue.maxsize,
+            "committed": self.committed,
+            "commits": self.commits,
+            "failures": self.failures,
+            "spilled": self.spilled,
+            "spill_replayed": self.spill_replayed,
+            "spill_pending_bytes": self._spill_pending_bytes(),
+            "dropped": self.dropped
+        }
 
-    def add_event(self, data):
-        prev = self.chain[-1]
-        block = Block(len(self.chain), data, prev.hash)
-        self.chain.append(block)
 
-audit_chain = AuditChain()
+audit_chain = AuditChain(
+    batch_size=int(os.getenv("AUDIT_BLOCK_SIZE", "100")),
+    max_latency=float(os.getenv("AUDIT_BLOCK_MAX_LATENCY", "0.5")),
+    queue_size=int(os.getenv("AUDIT_QUEUE_SIZE", "10000")),
+    spill_path=os.getenv("AUDIT_SPILL_PATH", "audit_spill.jsonl") or None
+)
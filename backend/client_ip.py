@@ -0,0 +1,127 @@
+import ipaddress
+import os
+import threading
+import requests
+
+PUBLIC_IP_SERVICES = ("https://api.ipify.org", "https://icanhazip.com")
+
+
+def parse_networks(value):
+    networks = []
+    for item in value.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        try:
+            networks.append(ipaddress.ip_network(item, strict=False))
+        except ValueError:
+            print(f"Ignoring invalid trusted proxy entry: {item}")
+    return networks
+
+
+TRUSTED_PROXIES = parse_networks(os.getenv("TRUSTED_PROXIES", "127.0.0.1/32,::1/128"))
+
+
+def _clean(value):
+    """Strip quotes, IPv6 brackets and ports from a forwarded address"""
+    value = value.strip().strip('"')
+    if value.startswith("["):
+        return value[1:value.find("]")] if "]" in value else value[1:]
+    if value.count(":") == 1:
+        return value.split(":", 1)[0]
+    return value
+
+
+def _parse_ip(value):
+    try:
+        return ipaddress.ip_address(_clean(value))
+    except ValueError:
+        return None
+
+
+def is_trusted(address, trusted=None):
+    trusted = TRUSTED_PROXIES if trusted is None else trusted
+    return address is not None and any(address in network for network in trusted)
+
+
+def forwarded_chain(headers):
+    """Client-to-proxy address chain from Forwarded (RFC 7239) or X-Forwarded-For"""
+    forwarded = headers.get("forwarded")
+    if forwarded:
+        chain = []
+        for element in forwarded.split(","):
+            for pair in element.split(";"):
+                key, _, value = pair.partition("=")
+                if key.strip().lower() == "for":
+                    chain.append(value)
+        if chain:
+            return chain
+    xff = headers.get("x-forwarded-for")
+    if xff:
+        return [part for part in xff.split(",") if part.strip()]
+    return []
+
+
+def get_client_ip(request, trusted=None):
+    """Originating client address; forwarding headers are honoured only from trusted proxies"""
+    peer = request.client.host if request.client else None
+    address = _parse_ip(peer) if peer else None
+    if not is_trusted(address, trusted):
+        return peer or "127.0.0.1"
+
+    # Walk from the nearest hop back towards the client, skipping our own proxies
+    client = address
+    for hop in reversed(forwarded_chain(request.headers)):
+        hop_address = _parse_ip(hop)
+        if hop_address is None:
+            break
+        client = hop_address
+        if not is_trusted(hop_address, trusted):
+            break
+    return str(client)
+
+
+def is_local(ip):
+    try:
+        address = ipaddress.ip_address(ip)
+    except ValueError:
+        return ip == "localhost"
+    return address.is_private or address.is_loopback
+
+
+class ServerPublicIP:
+    """The server's own egress IP, looked up once in the background and cached"""
+
+    def __init__(self, configured=None):
+        self.value = configured or None
+        self._thread = None
+
+    def _resolve(self):
+        for url in PUBLIC_IP_SERVICES:
+            try:
+                ip = requests.get(url, timeout=3).text.strip()
+                ipaddress.ip_address(ip)
+                self.value = ip
+                return
+            except Exception:
+                continue
+        print("Could not determine the server's public IP")
+
+    def start(self):
+        if self.value is None and self._thread is None and os.getenv("PUBLIC_IP_LOOKUP", "1") == "1":
+            self._thread = threading.Thread(target=self._resolve, name="public-ip", daemon=True)
+            self._thread.start()
+
+    def get(self):
+        return self.value
+
+
+server_public_ip = ServerPublicIP(os.getenv("PUBLIC_IP", ""))
+
+
+def login_ip(request):
+    """Client IP for login records; local clients are recorded under the server's public IP"""
+    ip = get_client_ip(request)
+    if is_local(ip) and server_public_ip.get():
+        return server_public_ip.get()
+    return ip
@@ -1,44 +1,85 @@
 from fastapi import APIRouter, HTTPException, Form, Request, UploadFile, File
-from fastapi.responses import JSONResponse
-from mysql_database import get_db
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from async_db import async_db
 from activity_tracker import ActivityTracker
+import repository
+from risk_engine import risk_engine
+from client_ip import get_client_ip
+from ingest import ingest
+from blob_store import blob_store, store_content, load_content
+import file_versions
+import search
+from pagination import PageRequest, page_info, page_response
+from file_versions import PatchError, VersionConflict
+import hashlib
+import mimetypes
 import os
+import re
 import json
 from datetime import datetime
 
 router = APIRouter()
 
+STREAM_CHUNK_BYTES = int(os.getenv("FILE_STREAM_CHUNK_BYTES", str(64 * 1024)))
+
+
+def _etag_matches(header, etag):
+    if not header:
+        return False
+    candidates = [tag.strip() for tag in header.split(",")]
+    return "*" in candidates or any(tag.removeprefix("W/") == etag for tag in candidates)
+
+
+def _parse_range(header, size):
+    """(start, end) inclusive for a single "bytes=" range, None to send the whole body,
+    or ValueError when the range cannot be satisfied"""
+    if not header or not header.startswith("bytes=") or "," in header:
+        # Absent, another unit, or several ranges: serving the full body is allowed
+        return None
+    first, _, last = header[len("bytes="):].strip().partition("-")
+    try:
+        if not first:
+            suffix = int(last)
+            if suffix <= 0:
+                raise ValueError("Empty suffix range")
+            return max(0, size - suffix), size - 1
+        start = int(first)
+        end = int(last) if last else size - 1
+    except ValueError:
+        raise ValueError(f"Invalid range: {header}")
+    if start >= size or end < start:
+        raise ValueError(f"Range not satisfiable: {header}")
+    return start, min(end, size - 1)
+
+
+async def _iter_bytes(data, start, end):
+    for offset in range(start, end + 1, STREAM_CHUNK_BYTES):
+        yield data[offset:min(offset + STREAM_CHUNK_BYTES, end + 1)]
+
+async def record_access(user, file_name, action, sensitivity=None):
+    """Log a file access and count it toward the user's risk score"""
+    await repository.insert_file_access(async_db, user, file_name, action, sensitivity)
+    risk_engine.record_file_access(user, file_name, action)
+
 @router.get("/files/read/{filename}")
 async def read_file(filename: str, user: str = None, action: str = "read"):
     """Read file by filename"""
-    conn = get_db()
-    cursor = conn.cursor(dictionary=True)
+    file = await repository.get_file_by_name(async_db, filename)
     
-    try:
-        cursor.execute("SELECT * FROM files WHERE file_name = %s AND is_deleted = 0", (filename,))
-        file = cursor.fetchone()
-        
-        if not file:
-            raise HTTPException(status_code=404, detail="File not found")
-        
-        content = file['file_content']
-        sensitivity = file['sensitivity_level']
-        
-        # Track access in separate transaction
-        if user:
-            try:
-                cursor.execute("""
-                    INSERT INTO file_access_logs (user_id, file_name, action, sensitivity_level)
-                    VALUES (%s, %s, %s, %s)
-                """, (user, filename, action.upper(), sensitivity))
-                conn.commit()
-            except:
-                pass
-        
-        return {"content": content, "filename": filename}
-    finally:
-        cursor.close()
-        conn.close()
+    if not file:
+        raise HTTPException(status_code=404, detail="File not found")
+    
+    content = await load_content(file)
+    sensitivity = file['sensitivity_level']
+    
+    # Track access in separate transaction
+    if user:
+        try:
+            await record_access(user, filename, action.upper(), sensitivity)
+        except:
+            pass
+    
+    return {"content": content, "filename": filename}
 
 @router.post("/files/edit")
 async def edit_file_legacy(request: Request):
@@ -48,27 +89,16 @@ async def edit_file_legacy(request: Request):
     content = data.get('content')
     user = data.get('user')
     
-    conn = get_db()
-    cursor = conn.cursor()
+    async with async_db.transaction() as db:
+        file = await repository.get_file_by_name_for_update(db, filename)
+        if not file:
+            raise HTTPException(status_code=404, detail="File not found")
+        version = await file_versions.save_version(db, file, content or '', user)
     
-    try:
-        cursor.execute("""
-            UPDATE files SET file_content = %s, file_size = %s
-            WHERE file_name = %s AND is_deleted = 0
-        """, (content, len(content.encode('utf-8')), filename))
-        conn.commit()
-        
-        if user:
-            cursor.execute("""
-                INSERT INTO file_access_logs (user_id, file_name, action)
-                VALUES (%s, %s, 'EDIT')
-            """, (user, filename))
-            conn.commit()
-        
-        return {"status": "SUCCESS"}
-    finally:
-        cursor.close()
-        conn.close()
+    if user:
+        await record_access(user, filename, 'EDIT')
+    
+    return {"status": "SUCCESS", "version": version}
 
 @router.post("/files/delete")
 async def delete_file_legacy(request: Request):
@@ -77,109 +107,156 @@ async def delete_file_legacy(request: Request):
     filename = data.get('filename')
     user = data.get('user')
     
-    conn = get_db()
-    cursor = conn.cursor()
+    await repository.delete_file_by_name(async_db, filename)
     
-    try:
-        cursor.execute("UPDATE files SET is_deleted = 1 WHERE file_name = %s", (filename,))
-        conn.commit()
-        
-        if user:
-            cursor.execute("""
-                INSERT INTO file_access_logs (user_id, file_name, action)
-                VALUES (%s, %s, 'DELETE')
-            """, (user, filename))
-            conn.commit()
-        
-        return {"status": "SUCCESS"}
-    finally:
-        cursor.close()
-        conn.close()
+    if user:
+        await record_access(user, filename, 'DELETE')
+    
+    return {"status": "SUCCESS"}
 
 @router.get("/files/list")
-async def list_files_legacy():
+async def list_files_legacy(limit: int = None, cursor: str = None, fields: str = None):
     """Legacy endpoint for file listing"""
+    page_request = PageRequest(limit, cursor, fields, default=500)
     try:
-        conn = get_db()
-        cursor = conn.cursor(dictionary=True)
-        cursor.execute("""
-            SELECT file_name as name, file_size as size, 
-                   sensitivity_level as sensitivity, updated_at as modified
-            FROM files 
-            WHERE is_deleted = 0 
-            ORDER BY updated_at DESC
-        """)
-        files = cursor.fetchall()
-        
-        for file in files:
-            file['modified'] = file['modified'].isoformat()
-        
-        cursor.close()
-        conn.close()
-        return {"files": files}
+        files, page = await repository.list_files_page(async_db, page_request, repository.FILE_LIST_LEGACY_COLUMNS)
+        return page_response("files", files, page)
+    except HTTPException:
+        raise
     except Exception as e:
-        return {"files": []}
+        return page_response("files", [], page_info(page_request, 0))
 
 @router.get("/files")
-async def list_files():
-    """Get all files from database"""
+async def list_files(limit: int = None, cursor: str = None, fields: str = None):
+    """Get files from database, most recently updated first"""
+    page_request = PageRequest(limit, cursor, fields, default=500)
     try:
-        conn = get_db()
-        cursor = conn.cursor(dictionary=True)
-        cursor.execute("""
-            SELECT id, file_name, file_path, file_size, file_type, 
-                   sensitivity_level, owner_id, created_at, updated_at
-            FROM files 
-            WHERE is_deleted = 0 
-            ORDER BY updated_at DESC
-        """)
-        files = cursor.fetchall()
-        
-        # Convert datetime to string
-        for file in files:
-            file['created_at'] = file['created_at'].isoformat()
-            file['updated_at'] = file['updated_at'].isoformat()
-        
-        cursor.close()
-        conn.close()
-        return {"files": files}
+        files, page = await repository.list_files_page(async_db, page_request)
+        return page_response("files", files, page)
+    except HTTPException:
+        raise
     except Exception as e:
-        return {"files": []}
+        return page_response("files", [], page_info(page_request, 0))
+
+@router.get("/files/search")
+async def search_files(q: str, scope: str = "files", limit: int = None, cursor: str = None, fields: str = None):
+    """Ranked search over file names, paths and contents (scope=files) or file access logs (scope=access).
+
+    Terms must all match; "term*" matches by prefix. Pages follow page.next_cursor like the other lists.
+    """
+    tsquery = search.parse_query(q)
+    if tsquery is None:
+        raise HTTPException(status_code=400, detail="Query has no searchable terms")
+    if scope not in ("files", "access"):
+        raise HTTPException(status_code=400, detail="scope must be files or access")
+    page_request = PageRequest(limit, cursor, fields, default=20, maximum=100)
+    
+    query = repository.search_files if scope == "files" else repository.search_file_access
+    total, results, page = await query(async_db, tsquery, page_request, search.MAX_CANDIDATES)
+    return dict(
+        page_response("results", results, page),
+        query=q,
+        scope=scope,
+        total=total,
+        # Matches past SEARCH_MAX_CANDIDATES are not counted or ranked
+        total_is_lower_bound=total >= search.MAX_CANDIDATES
+    )
 
 @router.get("/files/{file_id}")
 async def get_file(file_id: int, username: str = None):
     """Get file content and track access"""
     try:
-        with get_db() as conn:
-            cursor = conn.cursor(dictionary=True)
-            cursor.execute("SELECT * FROM files WHERE id = %s AND is_deleted = 0", (file_id,))
-            file = cursor.fetchone()
-            
-            if not file:
-                raise HTTPException(status_code=404, detail="File not found")
-            
-            # Track file access if username provided
-            if username:
-                ActivityTracker.track_file_access(
-                    user_id=username,
-                    file_name=file['file_name'],
-                    file_path=file['file_path'],
-                    action='READ',
-                    file_size=file['file_size']
-                )
-            
-            return {
-                "id": file['id'],
-                "file_name": file['file_name'],
-                "content": file['file_content'],
-                "file_size": file['file_size'],
-                "sensitivity_level": file['sensitivity_level'],
-                "created_at": file['created_at'].isoformat(),
-                "updated_at": file['updated_at'].isoformat()
-            }
+        file = await repository.get_file(async_db, file_id)
+        
+        if not file:
+            raise HTTPException(status_code=404, detail="File not found")
+        
+        # Track file access if username provided
+        if username:
+            ActivityTracker.track_file_access(
+                user_id=username,
+                file_name=file['file_name'],
+                file_path=file['file_path'],
+                action='READ',
+                file_size=file['file_size']
+            )
+        
+        return {
+            "id": file['id'],
+            "file_name": file['file_name'],
+            "content": await load_content(file),
+            "file_size": file['file_size'],
+            "sensitivity_level": file['sensitivity_level'],
+            "created_at": file['created_at'].isoformat(),
+            "updated_at": file['updated_at'].isoformat()
+        }
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@router.get("/files/{file_id}/download")
+async def download_file(file_id: int, request: Request, username: str = None, action: str = "download"):
+    """Stream file content with Range and ETag support; the access is recorded once per request"""
+    action = action.upper()
+    if action not in ("READ", "DOWNLOAD"):
+        raise HTTPException(status_code=400, detail="action must be read or download")
+    file = await repository.get_file(async_db, file_id)
+    if not file:
+        raise HTTPException(status_code=404, detail="File not found")
+    
+    digest = file['content_sha256']
+    inline = None
+    if digest:
+        size = file['file_size']
+    else:
+        # Row not migrated to the blob store yet
+        inline = (file['file_content'] or '').encode('utf-8')
+        digest = hashlib.sha256(inline).hexdigest()
+        size = len(inline)
+    etag = f'"{digest}"'
+    disposition = "attachment" if action == "DOWNLOAD" else "inline"
+    safe_name = re.sub(r'[^\w. -]', '_', file['file_name'])
+    headers = {
+        "ETag": etag,
+        "Accept-Ranges": "bytes",
+        "Cache-Control": "private, no-cache",
+        "Content-Disposition": f'{disposition}; filename="{safe_name}"'
+    }
+    
+    status_code = 200
+    start, end = 0, size - 1
+    if _etag_matches(request.headers.get("if-none-match"), etag):
+        status_code = 304
+    else:
+        if_range = request.headers.get("if-range")
+        if size and (not if_range or if_range == etag):
+            try:
+                requested = _parse_range(request.headers.get("range"), size)
+            except ValueError:
+                return Response(status_code=416, headers={"Content-Range": f"bytes */{size}", **headers})
+            if requested:
+                start, end = requested
+                status_code = 206
+                headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    
+    if username:
+        ActivityTracker.track_file_access(
+            user_id=username,
+            file_name=file['file_name'],
+            file_path=file['file_path'],
+            action=action,
+            file_size=0 if status_code == 304 else end - start + 1
+        )
+    
+    if status_code == 304:
+        return Response(status_code=304, headers=headers)
+    headers["Content-Length"] = str(end - start + 1)
+    if inline is not None:
+        body = _iter_bytes(inline, start, end)
+    else:
+        body = blob_store.iter_range(digest, start, end, STREAM_CHUNK_BYTES)
+    media_type = mimetypes.guess_type(file['file_name'])[0] or "application/octet-stream"
+    return StreamingResponse(body, status_code=status_code, headers=headers, media_type=media_type)
+
 @router.post("/files/{file_id}/edit")
 async def edit_file(file_id: int, request: Request):
     """Edit file content and track changes"""
@@ -187,38 +264,90 @@ async def edit_file(file_id: int, request: Request):
         data = await request.json()
         username = data.get('username')
         new_content = data.get('content', '')
+        size = len(new_content.encode('utf-8'))
         
-        with get_db() as conn:
-            cursor = conn.cursor(dictionary=True)
-            
-            # Get current file
-            cursor.execute("SELECT * FROM files WHERE id = %s AND is_deleted = 0", (file_id,))
-            file = cursor.fetchone()
+        async with async_db.transaction() as db:
+            # Get current file, locked until the new version is recorded
+            file = await repository.get_file_for_update(db, file_id)
             
             if not file:
                 raise HTTPException(status_code=404, detail="File not found")
             
-            # Update file content
-            new_size = len(new_content.encode('utf-8'))
-            cursor.execute("""
-                UPDATE files SET file_content = %s, file_size = %s, updated_at = NOW()
-                WHERE id = %s
-            """, (new_content, new_size, file_id))
-            
-            # Track file modification
-            if username:
-                ActivityTracker.track_file_access(
-                    user_id=username,
-                    file_name=file['file_name'],
-                    file_path=file['file_path'],
-                    action='WRITE',
-                    file_size=new_size
-                )
-            
-            return {"status": "SUCCESS", "message": "File updated successfully"}
+            version = await file_versions.save_version(db, file, new_content, username)
+        
+        # Track file modification
+        if username:
+            ActivityTracker.track_file_access(
+                user_id=username,
+                file_name=file['file_name'],
+                file_path=file['file_path'],
+                action='WRITE',
+                file_size=size
+            )
+        
+        return {"status": "SUCCESS", "message": "File updated successfully", "version": version}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@router.post("/files/{file_id}/patch")
+async def patch_file(file_id: int, request: Request):
+    """Apply a line delta to the latest version; base_version must be the version the delta was made against"""
+    data = await request.json()
+    username = data.get('username')
+    base_version = data.get('base_version')
+    if not isinstance(base_version, int):
+        raise HTTPException(status_code=400, detail="base_version is required")
+    
+    async with async_db.transaction() as db:
+        file = await repository.get_file_for_update(db, file_id)
+        if not file:
+            raise HTTPException(status_code=404, detail="File not found")
+        latest, _ = await repository.latest_file_versions(db, file_id)
+        if base_version != (latest or 1):
+            # Files edited before versioning are version 1
+            raise HTTPException(status_code=409, detail=f"Version {base_version} is not the latest ({latest or 1})")
+        try:
+            new_content = file_versions.apply(await load_content(file), data.get('ops'))
+            version = await file_versions.save_version(db, file, new_content, username, base_version)
+        except VersionConflict as e:
+            raise HTTPException(status_code=409, detail=str(e))
+        except PatchError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    
+    size = len(new_content.encode('utf-8'))
+    if username:
+        ActivityTracker.track_file_access(
+            user_id=username,
+            file_name=file['file_name'],
+            file_path=file['file_path'],
+            action='WRITE',
+            file_size=size
+        )
+    
+    return {"status": "SUCCESS", "version": version, "file_size": size}
+
+@router.get("/files/{file_id}/versions")
+async def get_file_versions(file_id: int):
+    """Version history of a file, newest first"""
+    if not await repository.get_file(async_db, file_id):
+        raise HTTPException(status_code=404, detail="File not found")
+    return {"file_id": file_id, "versions": await repository.list_file_versions(async_db, file_id)}
+
+@router.get("/files/{file_id}/versions/{version}")
+async def get_file_version(file_id: int, version: int, username: str = None):
+    """Content of a file as of one version"""
+    file = await repository.get_file(async_db, file_id)
+    if not file:
+        raise HTTPException(status_code=404, detail="File not found")
+    content = await file_versions.load_version(async_db, file_id, version)
+    if content is None:
+        raise HTTPException(status_code=404, detail="Version not found")
+    
+    if username:
+        await record_access(username, file['file_name'], 'READ', file['sensitivity_level'])
+    
+    return {"file_id": file_id, "file_name": file['file_name'], "version": version, "content": content}
+
 @router.post("/files/create")
 async def create_file(request: Request):
     """Create new file and track creation"""
@@ -229,39 +358,30 @@ async def create_file(request: Request):
         file_content = data.get('content', '')
         sensitivity = data.get('sensitivity', 'internal')
         
-        with get_db() as conn:
-            cursor = conn.cursor(dictionary=True)
-            
+        file_path = f"/user_files/{file_name}"
+        file_type = file_name.split('.')[-1] if '.' in file_name else 'txt'
+        digest, file_size = await store_content(file_content)
+        
+        async with async_db.transaction() as db:
             # Check if file already exists
-            cursor.execute("SELECT id FROM files WHERE file_name = %s AND is_deleted = 0", (file_name,))
-            existing = cursor.fetchone()
-            
-            if existing:
+            if await repository.get_file_by_name(db, file_name):
                 raise HTTPException(status_code=400, detail="File already exists")
             
-            file_path = f"/user_files/{file_name}"
-            file_size = len(file_content.encode('utf-8'))
-            file_type = file_name.split('.')[-1] if '.' in file_name else 'txt'
-            
-            cursor.execute("""
-                INSERT INTO files (file_name, file_path, file_content, file_size, 
-                                 file_type, sensitivity_level, owner_id)
-                VALUES (%s, %s, %s, %s, %s, %s, %s)
-            """, (file_name, file_path, file_content, file_size, file_type, sensitivity, username))
-            
-            file_id = cursor.lastrowid
-            
-            # Track file creation
-            if username:
-                ActivityTracker.track_file_access(
-                    user_id=username,
-                    file_name=file_name,
-                    file_path=file_path,
-                    action='CREATE',
-                    file_size=file_size
-                )
-            
-            return {"status": "SUCCESS", "file_id": file_id, "message": "File created successfully"}
+            file_id = await repository.create_file(db, file_name, file_path, digest, file_size, file_type, sensitivity, username)
+            await file_versions.start_history(db, file_id, digest, file_size, username)
+            await search.index_file(db, file_id, file_name, file_path, file_content)
+        
+        # Track file creation
+        if username:
+            ActivityTracker.track_file_access(
+                user_id=username,
+                file_name=file_name,
+                file_path=file_path,
+                action='CREATE',
+                file_size=file_size
+            )
+        
+        return {"status": "SUCCESS", "file_id": file_id, "message": "File created successfully"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -269,50 +389,53 @@ async def create_file(request: Request):
 async def delete_file(file_id: int, username: str = None):
     """Delete file and track deletion"""
     try:
-        with get_db() as conn:
-            cursor = conn.cursor(dictionary=True)
-            
+        async with async_db.transaction() as db:
             # Get file info before deletion
-            cursor.execute("SELECT * FROM files WHERE id = %s AND is_deleted = 0", (file_id,))
-            file = cursor.fetchone()
+            file = await repository.get_file(db, file_id)
             
             if not file:
                 raise HTTPException(status_code=404, detail="File not found")
             
             # Mark as deleted
-            cursor.execute("UPDATE files SET is_deleted = 1 WHERE id = %s", (file_id,))
-            
-            # Track file deletion
-            if username:
-                ActivityTracker.track_file_access(
-                    user_id=username,
-                    file_name=file['file_name'],
-                    file_path=file['file_path'],
-                    action='DELETE',
-                    file_size=file['file_size']
-                )
-            
-            return {"status": "SUCCESS", "message": "File deleted successfully"}
+            await repository.delete_file(db, file_id)
+        
+        # Track file deletion
+        if username:
+            ActivityTracker.track_file_access(
+                user_id=username,
+                file_name=file['file_name'],
+                file_path=file['file_path'],
+                action='DELETE',
+                file_size=file['file_size']
+            )
+        
+        return {"status": "SUCCESS", "message": "File deleted successfully"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.post("/files/access")
 async def track_file_access(request: Request):
-    """Track file access for real-time monitoring"""
+    """Track file access for real-time monitoring; the row goes through the crash-safe ingest spool"""
     try:
         data = await request.json()
         username = data.get('user_id') or data.get('username')
         file_name = data.get('file_name')
-        action = data.get('action', 'read')
+        action = (data.get('action') or 'read').upper()
+        now = datetime.now()
+        spooled = False
         
         if username and file_name:
-            ActivityTracker.track_file_access(
-                user_id=username,
-                file_name=file_name,
-                file_path=f"/files/{file_name}",
-                action=action.upper()
-            )
+            sensitivity = ActivityTracker.file_sensitivity(file_name)
+            spooled = await async_db.call(ingest, {"file_access": [
+                (username, file_name, f"/files/{file_name}", action, sensitivity, get_client_ip(request), now, None)
+            ]})
+            risk_engine.record_file_access(username, file_name, action)
+            ActivityTracker.create_audit_entry('FILE_ACCESS', username, {
+                'file_name': file_name,
+                'action': action,
+                'sensitivity': sensitivity
+            })
         
-        return {"status": "SUCCESS", "timestamp": datetime.now().isoformat()}
+        return {"status": "SUCCESS", "timestamp": now.isoformat(), "spooled": spooled}
     except Exception as e:
         return {"status": "FAIL", "error": str(e)}
\ No newline at end of file
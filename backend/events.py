@@ -0,0 +1,65 @@
+from collections import defaultdict
+from websocket_manager import manager
+
+# Live events for WebSocket subscribers. Each publish goes to the fleet-wide
+# topic and to the per-user topic of every user in the batch; manager skips
+# topics nobody is subscribed to.
+
+
+def _publish_by_user(kind, event_type, events):
+    if not events:
+        return
+    manager.publish_threadsafe(kind, {"type": event_type, "events": events})
+    by_user = defaultdict(list)
+    for event in events:
+        by_user[event["user_id"]].append(event)
+    for user, user_events in by_user.items():
+        manager.publish_threadsafe(f"{kind}:{user}", {"type": event_type, "events": user_events})
+
+
+def publish_file_access(rows):
+    """rows as accepted by ingest.insert_file_access"""
+    _publish_by_user("files", "file_access", [
+        {"user_id": user, "file_name": name, "file_path": path, "action": action, "sensitivity": sensitivity,
+         "ip_address": ip, "access_time": access_time, "device_id": device_id}
+        for user, name, path, action, sensitivity, ip, access_time, device_id in rows
+    ])
+
+
+def publish_network(rows):
+    """rows as accepted by ingest.insert_network"""
+    _publish_by_user("network", "network", [
+        {"user_id": user, "connection": connection_type, "remote_ip": remote_ip, "remote_port": remote_port,
+         "protocol": protocol, "external": external, "timestamp": timestamp}
+        for user, connection_type, remote_ip, remote_port, protocol, external, timestamp in rows
+    ])
+
+
+PUBLISHERS = {"file_access": publish_file_access, "network": publish_network}
+
+
+def publish_batches(batches):
+    for kind, rows in batches.items():
+        PUBLISHERS[kind](rows)
+
+
+def publish_alert(user_id, event_type, risk_score, severity, description):
+    manager.publish_threadsafe("alerts", {
+        "type": "risk_event", "user_id": user_id, "event_type": event_type,
+        "risk_score": risk_score, "severity": severity, "description": description
+    })
+
+
+def publish_risk(user_id, score, previous):
+    """RiskEngine listener: a user's score or signals changed"""
+    message = dict(score, type="risk_delta", user_id=user_id, previous_score=previous["risk_score"] if previous else 0)
+    manager.publish_threadsafe(f"risk:{user_id}", message)
+    manager.publish_threadsafe("risk", message)
+
+
+def publish_audit(entries):
+    """AuditChain listener: newly committed entries"""
+    manager.publish_threadsafe("audit", {"type": "audit_block", "entries": [
+        {key: entry[key] for key in ("block_index", "block_number", "timestamp", "event_type", "user_id", "tx_id", "current_hash")}
+        for entry in entries
+    ]})
@@ -0,0 +1,131 @@
+import difflib
+import hashlib
+import json
+import os
+import repository
+import search
+from blob_store import blob_store, load_content
+
+# A full snapshot at least this often bounds how many deltas a read replays
+SNAPSHOT_INTERVAL = int(os.getenv("FILE_SNAPSHOT_INTERVAL", "20"))
+
+
+class PatchError(ValueError):
+    pass
+
+
+class VersionConflict(Exception):
+    pass
+
+
+def diff(old, new):
+    """Line delta turning old into new: a list of ["=", n], ["-", n] and ["+", [lines]] ops"""
+    a = old.splitlines(keepends=True)
+    b = new.splitlines(keepends=True)
+    # Small edits to large documents: trim the shared head and tail before matching
+    prefix = 0
+    while prefix < len(a) and prefix < len(b) and a[prefix] == b[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < len(a) - prefix and suffix < len(b) - prefix and a[-1 - suffix] == b[-1 - suffix]:
+        suffix += 1
+    ops = []
+
+    def keep(n):
+        if n:
+            ops.append(["=", n])
+
+    keep(prefix)
+    middle_a, middle_b = a[prefix:len(a) - suffix], b[prefix:len(b) - suffix]
+    matcher = difflib.SequenceMatcher(None, middle_a, middle_b, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            keep(i2 - i1)
+            continue
+        if i2 > i1:
+            ops.append(["-", i2 - i1])
+        if j2 > j1:
+            ops.append(["+", middle_b[j1:j2]])
+    keep(suffix)
+    return ops
+
+
+def apply(old, ops):
+    """Apply a diff() delta; raises PatchError if it does not fit old"""
+    lines = old.splitlines(keepends=True)
+    position = 0
+    out = []
+    if not isinstance(ops, list):
+        raise PatchError("ops must be a list")
+    for op in ops:
+        if not isinstance(op, list) or len(op) != 2:
+            raise PatchError(f"Invalid op: {op!r}")
+        kind, arg = op
+        if kind in ("=", "-"):
+            if not isinstance(arg, int) or arg < 0 or position + arg > len(lines):
+                raise PatchError(f"Op {op!r} runs past line {len(lines)}")
+            if kind == "=":
+                out.extend(lines[position:position + arg])
+            position += arg
+        elif kind == "+":
+            if not isinstance(arg, list) or not all(isinstance(line, str) for line in arg):
+                raise PatchError(f"Invalid insert: {op!r}")
+            out.extend(arg)
+        else:
+            raise PatchError(f"Unknown op: {kind!r}")
+    if position != len(lines):
+        raise PatchError(f"Patch covers {position} of {len(lines)} lines")
+    return "".join(out)
+
+
+async def start_history(db, file_id, digest, size, author=None):
+    """Version 1 of a newly created file"""
+    await repository.insert_file_version(db, file_id, 1, "snapshot", digest, digest, size, author)
+
+
+async def save_version(db, file, new_content, author=None, base_version=None):
+    """Record new_content as the next version of a files row locked with get_file_for_update.
+
+    Returns the version number, which is unchanged when the content is.
+    Raises VersionConflict when base_version is given and is not the latest.
+    """
+    file_id = file['id']
+    latest, latest_snapshot = await repository.latest_file_versions(db, file_id)
+    old_content = await load_content(file)
+    if latest is None:
+        # History starts at the body the file had before versioning
+        digest, size = await blob_store.write(old_content.encode("utf-8"))
+        await repository.insert_file_version(db, file_id, 1, "snapshot", digest, digest, size, file.get('owner_id'))
+        latest = latest_snapshot = 1
+    if base_version is not None and base_version != latest:
+        raise VersionConflict(f"Version {base_version} is not the latest ({latest})")
+
+    new_bytes = new_content.encode("utf-8")
+    content_digest = hashlib.sha256(new_bytes).hexdigest()
+    if content_digest == file.get('content_sha256'):
+        return latest
+    version = latest + 1
+    await blob_store.write(new_bytes)
+    delta = json.dumps(diff(old_content, new_content)).encode("utf-8")
+    if version - latest_snapshot >= SNAPSHOT_INTERVAL or len(delta) * 2 >= len(new_bytes):
+        await repository.insert_file_version(db, file_id, version, "snapshot", content_digest, content_digest, len(new_bytes), author)
+    else:
+        delta_digest, _ = await blob_store.write(delta)
+        await repository.insert_file_version(db, file_id, version, "delta", delta_digest, content_digest, len(new_bytes), author)
+    await repository.update_file_content(db, file_id, content_digest, len(new_bytes))
+    await search.index_file(db, file_id, file['file_name'], file['file_path'], new_content)
+    return version
+
+
+async def load_version(db, file_id, version):
+    """Rebuild a version from its nearest snapshot; None if it does not exist"""
+    chain = await repository.file_version_chain(db, file_id, version)
+    if not chain or chain[-1]['version'] != version:
+        return None
+    content = None
+    for row in chain:
+        data = (await blob_store.read(row['blob_sha256'])).decode("utf-8")
+        content = data if row['kind'] == "snapshot" else apply(content, json.loads(data))
+    if hashlib.sha256(content.encode("utf-8")).hexdigest() != chain[-1]['content_sha256']:
+        raise PatchError(f"Version {version} of file {file_id} does not match its recorded digest")
+    return content
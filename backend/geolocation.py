@@ -0,0 +1,272 @@
+import bisect
+import csv
+import ipaddress
+import os
+import queue
+import threading
+import requests
+from cache import TTLCache
+from mysql_database import get_db
+
+try:
+    import maxminddb
+except ImportError:
+    maxminddb = None
+
+GEO_FIELDS = ("country", "city", "region", "latitude", "longitude", "timezone", "isp", "postal")
+
+
+def unknown_location(ip):
+    return {"country": "Unknown", "city": "Unknown", "region": "Unknown", "latitude": 0, "longitude": 0, "timezone": "Unknown", "isp": "Unknown", "ip": ip, "postal": "Unknown"}
+
+
+class CSVRangeDatabase:
+    """IP ranges loaded from a CSV with start_ip,end_ip and GEO_FIELDS columns.
+
+    Ranges are kept as sorted integer bounds so a lookup is one bisect.
+    """
+
+    def __init__(self, path):
+        rows = []
+        with open(path, newline="", encoding="utf-8") as f:
+            for row in csv.DictReader(f):
+                start = int(ipaddress.ip_address(row["start_ip"].strip()))
+                end = int(ipaddress.ip_address(row["end_ip"].strip()))
+                rows.append((start, end, {k: row.get(k) or "Unknown" for k in GEO_FIELDS}))
+        rows.sort(key=lambda r: r[0])
+        self._starts = [r[0] for r in rows]
+        self._ends = [r[1] for r in rows]
+        self._records = [r[2] for r in rows]
+
+    def __len__(self):
+        return len(self._records)
+
+    def get(self, ip):
+        value = int(ipaddress.ip_address(ip))
+        i = bisect.bisect_right(self._starts, value) - 1
+        if i < 0 or value > self._ends[i]:
+            return None
+        record = dict(self._records[i])
+        for key in ("latitude", "longitude"):
+            try:
+                record[key] = float(record[key])
+            except (TypeError, ValueError):
+                record[key] = 0
+        return record
+
+
+class MMDBDatabase:
+    """MaxMind/DB-IP .mmdb file opened memory-mapped"""
+
+    def __init__(self, path):
+        self._reader = maxminddb.open_database(path, maxminddb.MODE_MMAP)
+
+    def get(self, ip):
+        data = self._reader.get(ip)
+        if not data:
+            return None
+        location = data.get("location", {})
+        subdivisions = data.get("subdivisions") or [{}]
+        return {
+            "country": data.get("country", {}).get("names", {}).get("en", "Unknown"),
+            "city": data.get("city", {}).get("names", {}).get("en", "Unknown"),
+            "region": subdivisions[0].get("names", {}).get("en", "Unknown"),
+            "latitude": location.get("latitude", 0),
+            "longitude": location.get("longitude", 0),
+            "timezone": location.get("time_zone", "Unknown"),
+            "isp": data.get("traits", {}).get("isp", "Unknown"),
+            "postal": data.get("postal", {}).get("code", "Unknown")
+        }
+
+
+def open_database(path):
+    if not path or not os.path.exists(path):
+        return None
+    if path.endswith(".mmdb"):
+        if maxminddb is None:
+            print(f"maxminddb is not installed, cannot open {path}")
+            return None
+        return MMDBDatabase(path)
+    return CSVRangeDatabase(path)
+
+
+def fetch_remote(ip):
+    """Query the public providers; loopback asks for the server's own location"""
+    path = "" if ip in ("127.0.0.1", "localhost", "::1") else f"{ip}/"
+    try:
+        geo = requests.get(f"https://ipapi.co/{path}json/", timeout=3).json()
+        if not geo.get('error'):
+            return {
+                "country": geo.get("country_name", "Unknown"),
+                "city": geo.get("city", "Unknown"),
+                "region": geo.get("region", "Unknown"),
+                "latitude": geo.get("latitude", 0),
+                "longitude": geo.get("longitude", 0),
+                "timezone": geo.get("timezone", "Unknown"),
+                "isp": geo.get("org", "Unknown"),
+                "ip": geo.get("ip", ip),
+                "postal": geo.get("postal", "Unknown")
+            }
+    except:
+        pass
+
+    try:
+        geo = requests.get(f"http://ip-api.com/json/{path.rstrip('/')}", timeout=3).json()
+        if geo.get('status') == 'success':
+            return {
+                "country": geo.get("country", "Unknown"),
+                "city": geo.get("city", "Unknown"),
+                "region": geo.get("regionName", "Unknown"),
+                "latitude": geo.get("lat", 0),
+                "longitude": geo.get("lon", 0),
+                "timezone": geo.get("timezone", "Unknown"),
+                "isp": geo.get("isp", "Unknown"),
+                "ip": geo.get("query", ip),
+                "postal": geo.get("zip", "Unknown")
+            }
+    except:
+        pass
+    return None
+
+
+class GeoResolver:
+    """Resolves IPs from the local database and cache; never blocks on the network.
+
+    Misses are queued for a background worker that asks the remote providers,
+    caches the answer and backfills login_logs rows stored as Unknown.
+    """
+
+    def __init__(self, db_path=None, cache_size=10000, cache_ttl=86400.0, negative_ttl=300.0,
+                 remote_lookups=True, queue_size=1000):
+        self.db_path = db_path
+        self.database = None
+        self.cache = TTLCache(maxsize=cache_size, ttl=cache_ttl)
+        self.negative_ttl = negative_ttl
+        self.remote_lookups = remote_lookups
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._pending = set()
+        self._pending_lock = threading.Lock()
+        self._worker = None
+        self._stopping = threading.Event()
+        self.remote_resolved = 0
+        self.remote_failed = 0
+        self.backfilled_rows = 0
+
+    def load(self):
+        try:
+            self.database = open_database(self.db_path)
+        except Exception as e:
+            print(f"Failed to load IP database {self.db_path}: {e}")
+            self.database = None
+
+    def start(self):
+        if self.database is None:
+            self.load()
+        if self.remote_lookups and self._worker is None:
+            self._stopping.clear()
+            self._worker = threading.Thread(target=self._run, name="geo-resolver", daemon=True)
+            self._worker.start()
+
+    def stop(self):
+        if self._worker is not None:
+            self._stopping.set()
+            try:
+                self._queue.put_nowait(None)
+            except queue.Full:
+                pass
+            self._worker.join(timeout=5)
+            self._worker = None
+
+    def lookup(self, ip):
+        if not ip:
+            return unknown_location(ip)
+        cached = self.cache.get(ip)
+        if cached is not None:
+            return dict(cached)
+
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            address = None
+        if address is not None and address.is_private and not address.is_loopback:
+            geo = unknown_location(ip)
+            geo.update({"country": "Local Network", "city": "Private IP"})
+            self.cache.set(ip, geo)
+            return dict(geo)
+
+        record = None
+        if self.database is not None and address is not None and not address.is_loopback:
+            try:
+                record = self.database.get(ip)
+            except Exception:
+                record = None
+        if record:
+            geo = dict(record, ip=ip)
+            self.cache.set(ip, geo)
+            return dict(geo)
+
+        geo = unknown_location(ip)
+        self.cache.set(ip, geo, ttl=self.negative_ttl)
+        self._schedule(ip)
+        return geo
+
+    def _schedule(self, ip):
+        if not self.remote_lookups:
+            return
+        with self._pending_lock:
+            if ip in self._pending:
+                return
+            self._pending.add(ip)
+        try:
+            self._queue.put_nowait(ip)
+        except queue.Full:
+            with self._pending_lock:
+                self._pending.discard(ip)
+
+    def _run(self):
+        while not self._stopping.is_set():
+            ip = self._queue.get()
+            if ip is None:
+                break
+            try:
+                geo = fetch_remote(ip)
+                if geo:
+                    self.remote_resolved += 1
+                    self.cache.set(ip, dict(geo, ip=ip))
+                    self._backfill(ip, geo)
+                else:
+                    self.remote_failed += 1
+            except Exception as e:
+                self.remote_failed += 1
+                print(f"Geolocation lookup failed for {ip}: {e}")
+            finally:
+                with self._pending_lock:
+                    self._pending.discard(ip)
+
+    def _backfill(self, ip, geo):
+        with get_db() as db:
+            cursor = db.cursor()
+            cursor.execute("""
+                UPDATE login_logs SET country = %s, city = %s, latitude = %s, longitude = %s
+                WHERE ip_address = %s AND (country IS NULL OR country = 'Unknown')
+            """, (geo["country"], geo["city"], geo.get("latitude", 0), geo.get("longitude", 0), ip))
+            self.backfilled_rows += cursor.rowcount
+            cursor.close()
+
+    def stats(self):
+        return {
+            "database": self.db_path if self.database is not None else None,
+            "cache": self.cache.stats(),
+            "queued": self._queue.qsize(),
+            "remote_resolved": self.remote_resolved,
+            "remote_failed": self.remote_failed,
+            "backfilled_rows": self.backfilled_rows
+        }
+
+
+geo_resolver = GeoResolver(
+    db_path=os.getenv("GEOIP_DB_PATH", ""),
+    cache_size=int(os.getenv("GEOIP_CACHE_SIZE", "10000")),
+    cache_ttl=float(os.getenv("GEOIP_CACHE_TTL", "86400")),
+    remote_lookups=os.getenv("GEOIP_REMOTE_LOOKUPS", "1") == "1"
+)
@@ -0,0 +1,98 @@
+import json
+import os
+import psycopg2.extras
+from mysql_database import get_db
+from spool import Spool
+from events import publish_batches
+
+MAX_BODY_BYTES = int(os.getenv("INGEST_MAX_BODY_BYTES", str(2 * 1024 * 1024)))
+MAX_ROWS = int(os.getenv("INGEST_MAX_ROWS", "5000"))
+
+FILE_ACCESS_INSERT = """
+    INSERT INTO file_access_logs
+    (user_id, file_name, file_path, action, sensitivity_level, ip_address, access_time, device_id)
+    VALUES %s
+"""
+
+NETWORK_INSERT = """
+    INSERT INTO network_logs
+    (user_id, connection_type, remote_ip, remote_port, protocol, external, timestamp)
+    VALUES %s
+"""
+
+
+class PayloadTooLarge(ValueError):
+    pass
+
+
+async def read_json(request, max_bytes=None):
+    """Request body as JSON, refusing bodies over the ingest size limit"""
+    max_bytes = MAX_BODY_BYTES if max_bytes is None else max_bytes
+    declared = request.headers.get("content-length")
+    if declared and declared.isdigit() and int(declared) > max_bytes:
+        raise PayloadTooLarge(f"Payload exceeds {max_bytes} bytes")
+    body = await request.body()
+    if len(body) > max_bytes:
+        raise PayloadTooLarge(f"Payload exceeds {max_bytes} bytes")
+    return json.loads(body) if body else {}
+
+
+def check_rows(name, rows, max_rows=None):
+    max_rows = MAX_ROWS if max_rows is None else max_rows
+    if not isinstance(rows, list):
+        raise ValueError(f"'{name}' must be a list")
+    if len(rows) > max_rows:
+        raise PayloadTooLarge(f"'{name}' has {len(rows)} rows, limit is {max_rows}")
+
+
+def insert_file_access(cursor, rows):
+    """Multi-row insert of (user_id, file_name, file_path, action, sensitivity, ip, access_time, device_id) tuples"""
+    if rows:
+        psycopg2.extras.execute_values(cursor, FILE_ACCESS_INSERT, rows, page_size=1000)
+    return len(rows)
+
+
+def insert_network(cursor, rows):
+    """Multi-row insert of (user_id, connection_type, remote_ip, remote_port, protocol, external, timestamp) tuples"""
+    if rows:
+        psycopg2.extras.execute_values(cursor, NETWORK_INSERT, rows, page_size=1000)
+    return len(rows)
+
+
+WRITERS = {"file_access": insert_file_access, "network": insert_network}
+
+ingest_spool = Spool(
+    directory=os.getenv("SPOOL_DIR", "spool"),
+    segment_bytes=int(os.getenv("SPOOL_SEGMENT_BYTES", str(16 * 1024 * 1024))),
+    fsync=os.getenv("SPOOL_FSYNC", "interval"),
+    fsync_interval=float(os.getenv("SPOOL_FSYNC_INTERVAL", "1.0"))
+)
+for _kind, _writer in WRITERS.items():
+    ingest_spool.register(_kind, _writer)
+SPOOL_ENABLED = os.getenv("SPOOL_ENABLED", "1") == "1"
+
+
+def ingest(batches):
+    """Durably accept {kind: rows}; spooled when enabled, otherwise written straight to the database.
+
+    Returns True when the rows went to the spool. Subscribers are notified once
+    the rows are accepted either way. Blocks on disk or database writes, so
+    async handlers call it through async_db.call().
+    """
+    batches = {kind: rows for kind, rows in batches.items() if rows}
+    spooled = False
+    if SPOOL_ENABLED:
+        try:
+            if batches:
+                ingest_spool.append(batches)
+            spooled = True
+        except OSError as e:
+            print(f"Spool append failed, writing directly: {e}")
+    if not spooled:
+        with get_db() as db:
+            cursor = db.cursor()
+            for kind, rows in batches.items():
+                WRITERS[kind](cursor, rows)
+            cursor.close()
+    publish_batches(batches)
+    return spooled
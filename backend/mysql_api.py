@@ -1,6 +1,11 @@
 from fastapi import APIRouter, HTTPException, Depends
-from mysql_database import get_db
+from async_db import async_db
 from activity_tracker import ActivityTracker
+from blockchain import audit_chain
+from blob_store import collect_garbage
+import repository
+from pagination import PageRequest, page_response
+from security import require_admin
 import json
 
 router = APIRouter()
@@ -8,227 +13,141 @@ router = APIRouter()
 @router.get("/admin/user-devices/{username}")
 async def get_user_devices(username: str):
     """Get real device fingerprints for user"""
-    with get_db() as conn:
-        cursor = conn.cursor(dictionary=True)
-        cursor.execute("""
-            SELECT device_id, mac_address, hostname, os, ip_address, wifi_ssid,
-                   device_type, trusted, first_seen, last_seen, login_count,
-                   browser, screen_resolution, timezone
-            FROM device_logs 
-            WHERE user_id = %s 
-            ORDER BY last_seen DESC
-        """, (username,))
-        devices = cursor.fetchall()
-        
-        # Convert datetime to string
-        for device in devices:
-            if device['first_seen']:
-                device['first_seen'] = device['first_seen'].isoformat()
-            if device['last_seen']:
-                device['last_seen'] = device['last_seen'].isoformat()
-        
-        return {"devices": devices}
+    devices = await repository.user_devices(async_db, username)
+    return {"devices": devices}
 
 @router.get("/admin/file-access")
-async def get_file_access(user: str = None, limit: int = 50):
-    """Get real file access logs"""
-    with get_db() as conn:
-        cursor = conn.cursor(dictionary=True)
-        
-        if user:
-            cursor.execute("""
-                SELECT file_name, file_path, action, file_size, 
-                       COALESCE(sensitivity_level, 'internal') as sensitivity,
-                       ip_address, access_time, device_id, risk_flag
-                FROM file_access_logs 
-                WHERE user_id = %s 
-                ORDER BY access_time DESC 
-                LIMIT %s
-            """, (user, limit))
-        else:
-            cursor.execute("""
-                SELECT user_id, file_name, file_path, action, file_size, 
-                       COALESCE(sensitivity_level, 'internal') as sensitivity,
-                       ip_address, access_time, device_id, risk_flag
-                FROM file_access_logs 
-                ORDER BY access_time DESC 
-                LIMIT %s
-            """, (limit,))
-        
-        file_logs = cursor.fetchall()
-        
-        for log in file_logs:
-            if log.get('access_time'):
-                log['access_time'] = log['access_time'].isoformat()
-        
-        return {"file_logs": file_logs}
+async def get_file_access(user: str = None, limit: int = None, cursor: str = None, fields: str = None):
+    """Get real file access logs, newest first; pass page.next_cursor as cursor for the next page"""
+    file_logs, page = await repository.file_access_logs(async_db, PageRequest(limit, cursor, fields), user)
+    return page_response("file_logs", file_logs, page)
 
 @router.get("/admin/login-history/{username}")
 async def get_login_history(username: str):
     """Get real login history"""
-    with get_db() as conn:
-        cursor = conn.cursor(dictionary=True)
-        cursor.execute("""
-            SELECT l.login_time, l.logout_time, l.ip_address, l.city, l.country, 
-                   l.success, l.failure_reason, l.device_fingerprint, l.user_agent,
-                   COALESCE(l.mac_address, 'N/A') as mac_address,
-                   COALESCE(l.hostname, 'N/A') as hostname,
-                   COALESCE(l.device_os, 'N/A') as device_os,
-                   COALESCE(l.wifi_ssid, 'N/A') as wifi_ssid
-            FROM login_logs l
-            WHERE l.user_id = %s 
-            ORDER BY l.login_time DESC 
-            LIMIT 20
-        """, (username,))
-        
-        login_history = cursor.fetchall()
-        
-        for login in login_history:
-            if login['login_time']:
-                login['login_time'] = login['login_time'].isoformat()
-            if login['logout_time']:
-                login['logout_time'] = login['logout_time'].isoformat()
-        
-        return {"login_history": login_history}
+    login_history = await repository.login_history(async_db, username)
+    return {"login_history": login_history}
 
 @router.get("/admin/network-activity")
-async def get_network_activity(user: str = None, limit: int = 50):
-    """Get real network activity"""
-    with get_db() as conn:
-        cursor = conn.cursor(dictionary=True)
-        
-        if user:
-            cursor.execute("""
-                SELECT user_id, 
-                       COALESCE(connection_type, 'Unknown') as connection,
-                       CONCAT(COALESCE(remote_ip, 'N/A'), ':', COALESCE(remote_port, 0)) as destination,
-                       COALESCE(protocol, 'N/A') as protocol,
-                       remote_port as port,
-                       external, 
-                       timestamp
-                FROM network_logs 
-                WHERE user_id = %s 
-                ORDER BY timestamp DESC 
-                LIMIT %s
-            """, (user, limit))
-        else:
-            cursor.execute("""
-                SELECT user_id, 
-                       COALESCE(connection_type, 'Unknown') as connection,
-                       CONCAT(COALESCE(remote_ip, 'N/A'), ':', COALESCE(remote_port, 0)) as destination,
-                       COALESCE(protocol, 'N/A') as protocol,
-                       remote_port as port,
-                       external, 
-                       timestamp
-                FROM network_logs 
-                ORDER BY timestamp DESC 
-                LIMIT %s
-            """, (limit,))
-        
-        network_logs = cursor.fetchall()
-        
-        for log in network_logs:
-            if log.get('timestamp'):
-                log['timestamp'] = log['timestamp'].isoformat()
-        
-        return {"network_logs": network_logs}
+async def get_network_activity(user: str = None, limit: int = None, cursor: str = None, fields: str = None):
+    """Get real network activity, newest first"""
+    network_logs, page = await repository.network_activity(async_db, PageRequest(limit, cursor, fields), user)
+    return page_response("network_logs", network_logs, page)
+
+USER_OVERVIEW_SQL = """
+    WITH active AS (
+        SELECT username, status FROM users WHERE status = 'active'
+    ), login_counts AS (
+        SELECT user_id, COUNT(*) AS login_count
+        FROM login_logs
+        WHERE user_id IN (SELECT username FROM active)
+        GROUP BY user_id
+    ), last_login AS (
+        SELECT DISTINCT ON (user_id) id, user_id, login_time, ip_address, country, city,
+               mac_address, hostname, device_os
+        FROM login_logs
+        WHERE user_id IN (SELECT username FROM active)
+        ORDER BY user_id, login_time DESC
+    ), last_device AS (
+        SELECT DISTINCT ON (user_id) id, user_id, device_id, mac_address, hostname, os,
+               wifi_ssid, ip_address
+        FROM device_logs
+        WHERE user_id IN (SELECT username FROM active)
+        ORDER BY user_id, last_seen DESC
+    )
+    SELECT a.username, a.status, COALESCE(lc.login_count, 0) AS login_count,
+           ll.id AS login_id, ll.login_time, ll.ip_address AS login_ip_address,
+           ll.country, ll.city, ll.mac_address AS login_mac_address,
+           ll.hostname AS login_hostname, ll.device_os,
+           d.id AS device_row_id, d.device_id, d.mac_address, d.hostname, d.os,
+           d.wifi_ssid, d.ip_address
+    FROM active a
+    LEFT JOIN login_counts lc ON lc.user_id = a.username
+    LEFT JOIN last_login ll ON ll.user_id = a.username
+    LEFT JOIN last_device d ON d.user_id = a.username
+    ORDER BY a.username
+"""
+
+def fetch_user_overview(conn):
+    """Active users with login count, latest login, latest device and risk - three queries total"""
+    from advanced_ueba import calculate_advanced_risk_batch
+
+    cursor = conn.cursor(dictionary=True)
+    cursor.execute(USER_OVERVIEW_SQL)
+    users = cursor.fetchall()
+    cursor.close()
+
+    risk = calculate_advanced_risk_batch([u['username'] for u in users], conn)
+    for user in users:
+        user['risk'] = risk[user['username']]
+    return users
 
 @router.get("/security/analyze/admin")
 async def get_security_analysis():
     """Get real user security analysis"""
-    from advanced_ueba import calculate_advanced_risk
-    
-    with get_db() as conn:
-        cursor = conn.cursor(dictionary=True)
-        
-        # Get active users
-        cursor.execute("""
-            SELECT u.username, u.status,
-                   (SELECT COUNT(*) FROM login_logs WHERE user_id = u.username) as login_count
-            FROM users u
-            WHERE u.status = 'active'
-        """)
-        
-        users = cursor.fetchall()
-        
-        # Get additional info for each user
-        for user in users:
-            # Calculate dynamic risk score
-            db2 = get_db()
-            risk_data = calculate_advanced_risk(user['username'], db2)
-            db2.close()
-            
-            user['risk_score'] = risk_data['risk_score']
-            user['risk_level'] = risk_data['risk_level']
-            user['decision'] = risk_data['decision']
-            user['zone'] = risk_data['zone']
-            user['signals'] = risk_data['signals']
-            
-            # Get latest device
-            cursor.execute("""
-                SELECT hostname, ip_address, device_id, mac_address, os, wifi_ssid
-                FROM device_logs
-                WHERE user_id = %s
-                ORDER BY last_seen DESC
-                LIMIT 1
-            """, (user['username'],))
-            device = cursor.fetchone()
-            
-            # Get latest login
-            cursor.execute("""
-                SELECT city, country, login_time
-                FROM login_logs
-                WHERE user_id = %s
-                ORDER BY login_time DESC
-                LIMIT 1
-            """, (user['username'],))
-            login = cursor.fetchone()
-            
-            # Merge data
-            if device:
-                user.update(device)
-            else:
-                user.update({'hostname': 'N/A', 'ip_address': 'N/A', 'device_id': 'N/A', 'mac_address': 'N/A', 'os': 'N/A', 'wifi_ssid': 'N/A'})
-            
-            if login:
-                user['city'] = login['city']
-                user['country'] = login['country']
-                user['login_time'] = login['login_time'].isoformat() if login['login_time'] else None
-            else:
-                user['city'] = 'Unknown'
-                user['country'] = 'Unknown'
-                user['login_time'] = None
+    users = []
+    for row in await async_db.run_sync(fetch_user_overview):
+        risk_data = row['risk']
+        user = {
+            'username': row['username'],
+            'status': row['status'],
+            'login_count': row['login_count'],
+            'risk_score': risk_data['risk_score'],
+            'risk_level': risk_data['risk_level'],
+            'decision': risk_data['decision'],
+            'zone': risk_data['zone'],
+            'signals': risk_data['signals']
+        }
+        
+        # Merge data
+        if row['device_row_id'] is not None:
+            user.update({k: row[k] for k in ('hostname', 'ip_address', 'device_id', 'mac_address', 'os', 'wifi_ssid')})
+        else:
+            user.update({'hostname': 'N/A', 'ip_address': 'N/A', 'device_id': 'N/A', 'mac_address': 'N/A', 'os': 'N/A', 'wifi_ssid': 'N/A'})
         
-        return {"users": users}
+        if row['login_id'] is not None:
+            user['city'] = row['city']
+            user['country'] = row['country']
+            user['login_time'] = row['login_time'].isoformat() if row['login_time'] else None
+        else:
+            user['city'] = 'Unknown'
+            user['country'] = 'Unknown'
+            user['login_time'] = None
+        users.append(user)
+    
+    return {"users": users}
 
 @router.get("/admin/audit-chain")
-async def get_audit_chain():
-    """Get blockchain audit trail"""
-    with get_db() as conn:
-        cursor = conn.cursor(dictionary=True)
-        cursor.execute("""
-            SELECT block_index, timestamp, event_type, user_id, event_data,
-                   current_hash, previous_hash
-            FROM blockchain_audit 
-            ORDER BY block_index DESC 
-            LIMIT 50
-        """)
-        
-        blockchain = cursor.fetchall()
-        
-        # Convert datetime to string
-        for block in blockchain:
-            if block['timestamp']:
-                block['timestamp'] = block['timestamp'].isoformat()
-            if block['event_data']:
-                block['event_data'] = json.loads(block['event_data'])
-        
-        return {"blockchain": blockchain}
+async def get_audit_chain(limit: int = None, cursor: str = None, fields: str = None):
+    """Get blockchain audit trail, newest first"""
+    blockchain, page = await repository.audit_entries(async_db, PageRequest(limit, cursor, fields))
+    for block in blockchain:
+        if block.get('event_data'):
+            block['event_data'] = json.loads(block['event_data'])
+    return page_response("blockchain", blockchain, page)
+
+@router.get("/admin/audit-chain/proof/{block_index}")
+async def get_audit_proof(block_index: int):
+    """Merkle inclusion proof for one audit event"""
+    proof = await async_db.run_sync(audit_chain.inclusion_proof, block_index)
+    if proof is None:
+        return {"status": "FAIL", "error": "Event not found or not sealed in a block"}
+    return proof
+
+@router.post("/admin/audit-chain/verify")
+async def verify_audit_chain(limit: int = 1000):
+    """Verify audit blocks sealed since the last checkpoint"""
+    return await async_db.run_sync(audit_chain.verify_new_blocks, limit)
+
+@router.post("/admin/blob-store/collect")
+async def collect_blobs(grace_seconds: int = 3600, admin: dict = Depends(require_admin)):
+    """Delete file bodies superseded by edits and no longer referenced by any file or version"""
+    return await async_db.run_sync(collect_garbage, grace_seconds)
 
 @router.post("/track/login")
 async def track_login_endpoint(data: dict):
     """Track user login"""
-    session_id = ActivityTracker.track_login(
+    session_id = await async_db.call(lambda: ActivityTracker.track_login(
         user_id=data['username'],
         ip_address=data.get('ip_address', '127.0.0.1'),
         mac_address=data.get('mac_address', 'unknown'),
@@ -237,7 +156,7 @@ async def track_login_endpoint(data: dict):
         wifi_ssid=data.get('wifi_ssid', 'unknown'),
         user_agent=data.get('user_agent', 'unknown'),
         success=data.get('success', True)
-    )
+    ))
     return {"session_id": session_id}
 
 @router.post("/track/file-access")
@@ -1,12 +1,259 @@
 import psycopg2
+import psycopg2.extensions
 import psycopg2.extras
 import os
+import threading
+import time
+from collections import deque
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class PooledConnection:
+    """Connection checked out of the pool; close() or leaving a with-block returns it"""
+
+    def __init__(self, pool, conn, overflow=False):
+        self._pool = pool
+        self._conn = conn
+        self._overflow = overflow
+        self._released = False
+
+    def cursor(self, dictionary=False, **kwargs):
+        # Routers still use the mysql-connector style cursor(dictionary=True)
+        if dictionary:
+            kwargs.setdefault("cursor_factory", psycopg2.extras.RealDictCursor)
+        return self._conn.cursor(**kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def close(self):
+        if not self._released:
+            self._released = True
+            self._pool.release(self._conn, self._overflow)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if not self._conn.closed:
+                if exc_type is None:
+                    self._conn.commit()
+                else:
+                    self._conn.rollback()
+        finally:
+            self.close()
+        return False
+
+
+class ConnectionPool:
+    def __init__(self, min_size=1, max_size=10, overflow=5, timeout=10.0,
+                 idle_timeout=300.0, health_check_interval=30.0):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.overflow = overflow
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.health_check_interval = health_check_interval
+
+        self._cond = threading.Condition()
+        self._idle = deque()  # (conn, last_used) - most recently used on the right
+        self._size = 0
+        self._in_use = 0
+        self._overflow_in_use = 0
+
+        self._checkouts = 0
+        self._waits = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._timeouts = 0
+        self._peak_in_use = 0
+        self._opened = 0
+        self._closed = 0
+        self._failed_health_checks = 0
+
+    def _connect(self):
+        conn = psycopg2.connect(
+            host=os.getenv("DB_HOST", "localhost"),
+            user=os.getenv("DB_USER", "postgres"),
+            password=os.getenv("DB_PASSWORD", ""),
+            database=os.getenv("DB_NAME", "postgres"),
+            port=os.getenv("DB_PORT", "5432")
+        )
+        with self._cond:
+            self._opened += 1
+        return conn
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._cond:
+            self._closed += 1
+
+    def _is_healthy(self, conn, last_used):
+        if conn.closed:
+            return False
+        if time.monotonic() - last_used < self.health_check_interval:
+            return True
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1")
+            cursor.close()
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def _evict_idle_locked(self):
+        # Oldest idle connections sit on the left; keep at least min_size open
+        evicted = []
+        now = time.monotonic()
+        while self._idle and self._size > self.min_size and now - self._idle[0][1] > self.idle_timeout:
+            conn, _ = self._idle.popleft()
+            self._size -= 1
+            evicted.append(conn)
+        return evicted
+
+    def acquire(self):
+        start = time.monotonic()
+        deadline = start + self.timeout
+        waited = False
+        conn = last_used = None
+        overflow = False
+        with self._cond:
+            evicted = self._evict_idle_locked()
+            while True:
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                    break
+                if self._size < self.max_size + self.overflow:
+                    overflow = self._size >= self.max_size
+                    self._size += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._timeouts += 1
+                    raise PoolTimeout(f"No database connection available within {self.timeout}s")
+                waited = True
+                self._cond.wait(remaining)
+            self._in_use += 1
+            if overflow:
+                self._overflow_in_use += 1
+        for stale in evicted:
+            self._discard(stale)
+
+        if conn is not None and not self._is_healthy(conn, last_used):
+            with self._cond:
+                self._failed_health_checks += 1
+            self._discard(conn)
+            conn = None
+        if conn is None:
+            try:
+                conn = self._connect()
+            except Exception:
+                self._forget(overflow)
+                raise
+
+        wait = time.monotonic() - start
+        with self._cond:
+            self._checkouts += 1
+            self._wait_total += wait
+            self._wait_max = max(self._wait_max, wait)
+            if waited:
+                self._waits += 1
+            self._peak_in_use = max(self._peak_in_use, self._in_use)
+        return PooledConnection(self, conn, overflow)
+
+    def _forget(self, overflow):
+        with self._cond:
+            self._size -= 1
+            self._in_use -= 1
+            if overflow:
+                self._overflow_in_use -= 1
+            self._cond.notify()
+
+    def release(self, conn, overflow=False):
+        reusable = not conn.closed and not overflow
+        if reusable and conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except Exception:
+                reusable = False
+        if not reusable:
+            self._discard(conn)
+            self._forget(overflow)
+            return
+        with self._cond:
+            self._in_use -= 1
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def warm(self):
+        """Open connections up to min_size"""
+        while True:
+            with self._cond:
+                if self._size >= self.min_size:
+                    return
+                self._size += 1
+            try:
+                conn = self._connect()
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                raise
+            with self._cond:
+                self._idle.append((conn, time.monotonic()))
+                self._cond.notify()
+
+    def close_all(self):
+        with self._cond:
+            idle = [conn for conn, _ in self._idle]
+            self._idle.clear()
+            self._size -= len(idle)
+        for conn in idle:
+            self._discard(conn)
+
+    def stats(self):
+        with self._cond:
+            return {
+                "size": self._size,
+                "in_use": self._in_use,
+                "idle": len(self._idle),
+                "overflow_in_use": self._overflow_in_use,
+                "peak_in_use": self._peak_in_use,
+                "min_size": self.min_size,
+                "max_size": self.max_size,
+                "max_overflow": self.overflow,
+                "checkouts": self._checkouts,
+                "waits": self._waits,
+                "timeouts": self._timeouts,
+                "wait_avg_ms": round(self._wait_total / self._checkouts * 1000, 3) if self._checkouts else 0.0,
+                "wait_max_ms": round(self._wait_max * 1000, 3),
+                "connections_opened": self._opened,
+                "connections_closed": self._closed,
+                "failed_health_checks": self._failed_health_checks
+            }
+
+
+pool = ConnectionPool(
+    min_size=int(os.getenv("DB_POOL_MIN_SIZE", "1")),
+    max_size=int(os.getenv("DB_POOL_MAX_SIZE", "10")),
+    overflow=int(os.getenv("DB_POOL_OVERFLOW", "5")),
+    timeout=float(os.getenv("DB_POOL_TIMEOUT", "10")),
+    idle_timeout=float(os.getenv("DB_POOL_IDLE_TIMEOUT", "300")),
+    health_check_interval=float(os.getenv("DB_POOL_HEALTH_CHECK_INTERVAL", "30"))
+)
+
 
 def get_db():
-    return psycopg2.connect(
-        host=os.getenv("DB_HOST", "localhost"),
-        user=os.getenv("DB_USER", "postgres"),
-        password=os.getenv("DB_PASSWORD", ""),
-        database=os.getenv("DB_NAME", "postgres"),
-        port=os.getenv("DB_PORT", "5432")
-    )
\ No newline at end of file
+    """Check a connection out of the process-wide pool.
+
+    Use as `with get_db() as conn:` - the transaction is committed (or rolled
+    back on error) and the connection returned to the pool on exit.
+    """
+    return pool.acquire()
@@ -0,0 +1,105 @@
+import base64
+import json
+import os
+from datetime import datetime
+from fastapi import HTTPException
+
+MAX_LIMIT = int(os.getenv("PAGE_MAX_LIMIT", "1000"))
+
+
+def encode_cursor(values):
+    """Opaque cursor for the sort key of the last row on a page; a NULL key is kept as null"""
+    data = [{"t": v.isoformat()} if isinstance(v, datetime) else v for v in values]
+    return base64.urlsafe_b64encode(json.dumps(data, separators=(",", ":")).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        values = [datetime.fromisoformat(v["t"]) if isinstance(v, dict) else v for v in data]
+    except (ValueError, TypeError, KeyError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if not all(v is None or isinstance(v, (int, float, datetime)) and not isinstance(v, bool) for v in values):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return values
+
+
+class PageRequest:
+    """limit, cursor and fields= of a list request.
+
+    Lists are read newest first by keyset: a page asks for rows whose sort
+    key (timestamp, id) is below the last row of the previous page, which an
+    index answers directly however deep the client has scrolled. Rows whose
+    timestamp is NULL sort first, as ORDER BY ... DESC puts them.
+
+    A missing limit means `default`; limits above `maximum` are lowered to it.
+    The response reports both, so a client can tell it got fewer rows than
+    it asked for.
+    """
+
+    def __init__(self, limit=None, cursor=None, fields=None, default=50, maximum=MAX_LIMIT):
+        if limit is not None and limit < 1:
+            raise HTTPException(status_code=400, detail="limit must be at least 1")
+        self.requested_limit = limit
+        self.max_limit = maximum
+        self.limit = min(limit or default, maximum)
+        self.after = decode_cursor(cursor) if cursor else None
+        self.fields = [f.strip() for f in fields.split(",") if f.strip()] if fields else None
+
+    def select(self, columns):
+        """SELECT list for the requested fields; columns maps field names to SQL expressions"""
+        names = self.fields or list(columns)
+        unknown = [name for name in names if name not in columns]
+        if unknown:
+            raise HTTPException(status_code=400,
+                                detail=f"Unknown fields: {', '.join(unknown)} (available: {', '.join(columns)})")
+        return [f'{columns[name]} AS "{name}"' for name in dict.fromkeys(names)]
+
+
+def _after(keys, after):
+    """WHERE clause and params for rows after the cursor; only the first key may be NULL"""
+    if len(after) != len(keys) or None in after[1:]:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    first, rest = keys[0], keys[1:]
+    if after[0] is not None:
+        # A row comparison is NULL for NULL keys, and those rows came before the cursor anyway
+        return f"({', '.join(keys)}) < ({', '.join(['%s'] * len(keys))})", tuple(after)
+    if not rest:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return (f"({first} IS NOT NULL OR ({', '.join(rest)}) < ({', '.join(['%s'] * len(rest))}))",
+            tuple(after[1:]))
+
+
+async def fetch_page(db, page, columns, source, keys, where="TRUE", params=()):
+    """One page of `source` ordered by `keys` descending; returns (rows, page info for the response)"""
+    select = page.select(columns) + [f"{key} AS _key{i}" for i, key in enumerate(keys)]
+    params = tuple(params)
+    if page.after is not None:
+        after, after_params = _after(keys, page.after)
+        where = f"({where}) AND {after}"
+        params += after_params
+    rows = await db.fetch_all(f"""
+        SELECT {', '.join(select)}
+        FROM {source}
+        WHERE {where}
+        ORDER BY {', '.join(key + ' DESC NULLS FIRST' for key in keys)}
+        LIMIT %s
+    """, params + (page.limit + 1,))
+    has_more = len(rows) > page.limit
+    rows = rows[:page.limit]
+    next_cursor = encode_cursor([rows[-1][f"_key{i}"] for i in range(len(keys))]) if has_more else None
+    for row in rows:
+        for i in range(len(keys)):
+            del row[f"_key{i}"]
+    return rows, page_info(page, len(rows), next_cursor)
+
+
+def page_info(page, count, next_cursor=None):
+    """The "page" object every list response carries"""
+    return {"limit": page.limit, "requested_limit": page.requested_limit, "max_limit": page.max_limit,
+            "count": count, "next_cursor": next_cursor, "has_more": next_cursor is not None}
+
+
+def page_response(key, rows, info):
+    """List response envelope: the rows under the endpoint's key, and the page object"""
+    return {key: rows, "page": info}
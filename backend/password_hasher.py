@@ -0,0 +1,145 @@
+import asyncio
+import hmac
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import bcrypt
+
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+BCRYPT_PREFIXES = ("$2a$", "$2b$", "$2y$")
+
+
+class HasherBusy(Exception):
+    pass
+
+
+def _secret(password):
+    # bcrypt only reads the first 72 bytes; passlib truncated the same way
+    return password.encode("utf-8")[:72]
+
+
+def is_bcrypt(stored):
+    return bool(stored) and stored.startswith(BCRYPT_PREFIXES)
+
+
+def hash_password(password, rounds=None):
+    return bcrypt.hashpw(_secret(password), bcrypt.gensalt(rounds or BCRYPT_ROUNDS)).decode()
+
+
+def check_password(password, stored):
+    """Compare against a bcrypt hash, or a legacy plaintext value in constant time"""
+    if not stored:
+        return False
+    if is_bcrypt(stored):
+        try:
+            return bcrypt.checkpw(_secret(password), stored.encode())
+        except ValueError:
+            return False
+    return hmac.compare_digest(password.encode("utf-8"), stored.encode("utf-8"))
+
+
+def needs_rehash(stored, rounds=None):
+    if not is_bcrypt(stored):
+        return True
+    try:
+        return int(stored.split("$")[2]) != (rounds or BCRYPT_ROUNDS)
+    except (IndexError, ValueError):
+        return True
+
+
+def verify_and_update(password, stored, rounds=None):
+    """(matches, new_hash); new_hash is set when the stored value should be replaced"""
+    if not check_password(password, stored):
+        return False, None
+    if needs_rehash(stored, rounds):
+        return True, hash_password(password, rounds)
+    return True, None
+
+
+class PasswordHasher:
+    """Runs bcrypt in a process pool so hashing never holds the event loop or the GIL.
+
+    At most `max_concurrent` operations run at once; callers that wait longer
+    than `queue_timeout` for a slot get HasherBusy, which keeps a credential
+    stuffing burst from queueing unbounded CPU work behind other endpoints.
+    """
+
+    def __init__(self, rounds=12, max_workers=None, max_concurrent=None, queue_timeout=5.0):
+        self.rounds = rounds
+        self.max_workers = max_workers or min(4, os.cpu_count() or 1)
+        self.max_concurrent = max_concurrent or self.max_workers * 2
+        self.queue_timeout = queue_timeout
+        self._executor = None
+        self._semaphore = None
+        self.in_flight = 0
+        self.waiting = 0
+        self.completed = 0
+        self.rejected = 0
+        self.rehashed = 0
+        self._total_ms = 0.0
+
+    def start(self):
+        if self._executor is None:
+            # Spawned, not forked: the parent already runs the DB pool, spool and
+            # watcher threads, and a forked child could inherit one of their locks held
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers,
+                                                 mp_context=multiprocessing.get_context("spawn"))
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    async def _run(self, fn, *args):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrent)
+        self.start()
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            raise HasherBusy("Password hashing is saturated, try again shortly")
+        finally:
+            self.waiting -= 1
+        self.in_flight += 1
+        started = time.perf_counter()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+        finally:
+            self.in_flight -= 1
+            self.completed += 1
+            self._total_ms += (time.perf_counter() - started) * 1000
+            self._semaphore.release()
+
+    async def hash(self, password):
+        return await self._run(hash_password, password, self.rounds)
+
+    async def verify(self, password, stored):
+        """(matches, new_hash) - new_hash is set when the stored value is plaintext or uses other cost settings"""
+        matches, new_hash = await self._run(verify_and_update, password, stored, self.rounds)
+        if new_hash:
+            self.rehashed += 1
+        return matches, new_hash
+
+    def stats(self):
+        return {
+            "rounds": self.rounds,
+            "workers": self.max_workers,
+            "max_concurrent": self.max_concurrent,
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "rehashed": self.rehashed,
+            "avg_ms": round(self._total_ms / self.completed, 2) if self.completed else 0.0
+        }
+
+
+password_hasher = PasswordHasher(
+    rounds=BCRYPT_ROUNDS,
+    max_workers=int(os.getenv("PASSWORD_HASH_WORKERS", "0")) or None,
+    max_concurrent=int(os.getenv("PASSWORD_HASH_MAX_CONCURRENT", "0")) or None,
+    queue_timeout=float(os.getenv("PASSWORD_HASH_QUEUE_TIMEOUT", "5"))
+)
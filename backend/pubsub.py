@@ -0,0 +1,179 @@
+import asyncio
+import json
+import os
+import uuid
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:
+    aioredis = None
+
+# INCR and PUBLISH in one script: Redis runs scripts atomically, so every
+# worker receives messages in sequence order whichever worker published them.
+# ARGV[2] numbers the message among its worker's publishes and KEYS[3] holds the
+# highest number published so far, so resending a pipeline that partly went
+# through skips the messages it already published instead of repeating them
+PUBLISH_SCRIPT = """
+if tonumber(ARGV[2]) <= tonumber(redis.call('GET', KEYS[3]) or '0') then
+    return 0
+end
+redis.call('SET', KEYS[3], ARGV[2], 'EX', ARGV[3])
+local seq = redis.call('INCR', KEYS[1])
+redis.call('PUBLISH', KEYS[2], seq .. ' ' .. ARGV[1])
+return seq
+"""
+# How long Redis remembers a worker's last published number after its last publish
+PUBLISHER_KEY_TTL = 86400
+
+
+class LocalBus:
+    """In-process backbone: messages only reach this worker's connections"""
+
+    shared = False
+
+    def __init__(self):
+        self.manager = None
+        self.published = 0
+
+    async def start(self, manager):
+        self.manager = manager
+
+    async def close(self):
+        pass
+
+    def publish(self, topic, message):
+        """Called on the event loop thread"""
+        self.published += 1
+        self.manager.deliver(topic, message)
+
+    def stats(self):
+        return {"backend": "local", "published": self.published}
+
+
+class RedisBus:
+    """Backbone shared by every worker through Redis pub/sub.
+
+    Messages are numbered by a Redis counter as they are published, so the
+    sequence numbers clients resume from mean the same thing on every worker.
+    Publishing goes through one task per worker that pipelines whatever has
+    queued up, which keeps this worker's messages in order without a round
+    trip per message. A failed pipeline is resent whole; the script skips
+    what already went out, so a retry never publishes a message twice.
+
+    At most `queue_size` messages wait to be published; while Redis is
+    unreachable further messages are dropped and counted in stats(), and
+    clients catch up through their periodic REST reconcile.
+    """
+
+    shared = True
+
+    def __init__(self, url, channel="zerotrust:ws", batch_size=500, queue_size=10000):
+        if aioredis is None:
+            raise RuntimeError("WS_PUBSUB_URL needs the redis package (pip install redis)")
+        self.url = url
+        self.channel = channel
+        self.seq_key = f"{channel}:seq"
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self.publisher_key = f"{channel}:publisher:{uuid.uuid4().hex}"
+        self._number = 0
+        self.manager = None
+        self._redis = None
+        self._script = None
+        self._queue = None
+        self._tasks = []
+        self.published = 0
+        self.received = 0
+        self.failures = 0
+        self.dropped = 0
+        self._overflowing = False
+
+    async def start(self, manager):
+        self.manager = manager
+        self._redis = aioredis.from_url(self.url)
+        self._script = self._redis.register_script(PUBLISH_SCRIPT)
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        self._tasks = [asyncio.create_task(self._publisher()), asyncio.create_task(self._subscriber())]
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._redis is not None:
+            await self._redis.aclose()
+            self._redis = None
+
+    def publish(self, topic, message):
+        """Called on the event loop thread"""
+        if self._queue.full():
+            self.dropped += 1
+            if not self._overflowing:
+                self._overflowing = True
+                print(f"Pub/sub queue full ({self.queue_size} messages), dropping messages until Redis catches up")
+            return
+        self._number += 1
+        self._queue.put_nowait((self._number, json.dumps({"topic": topic, "message": message}, default=str)))
+
+    async def _publisher(self):
+        batch = []
+        while True:
+            if not batch:
+                batch.append(await self._queue.get())
+                while len(batch) < self.batch_size and not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+            try:
+                pipe = self._redis.pipeline(transaction=False)
+                for number, payload in batch:
+                    await self._script(keys=[self.seq_key, self.channel, self.publisher_key],
+                                       args=[payload, number, PUBLISHER_KEY_TTL], client=pipe)
+                await pipe.execute()
+                self.published += len(batch)
+                self._overflowing = False
+                batch = []
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Keep the batch and retry so this worker's messages stay in order
+                self.failures += 1
+                print(f"Pub/sub publish failed, retrying: {e}")
+                await asyncio.sleep(1)
+
+    async def _subscriber(self):
+        while True:
+            pubsub = self._redis.pubsub()
+            try:
+                await pubsub.subscribe(self.channel)
+                async for item in pubsub.listen():
+                    if item["type"] != "message":
+                        continue
+                    seq, _, payload = item["data"].partition(b" ")
+                    data = json.loads(payload)
+                    self.received += 1
+                    self.manager.deliver(data["topic"], data["message"], int(seq))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.failures += 1
+                print(f"Pub/sub subscription lost, reconnecting: {e}")
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.aclose()
+
+    def stats(self):
+        return {
+            "backend": "redis",
+            "published": self.published,
+            "received": self.received,
+            "pending": self._queue.qsize() if self._queue is not None else 0,
+            "queue_capacity": self.queue_size,
+            "failures": self.failures,
+            "dropped": self.dropped
+        }
+
+
+def open_bus(url):
+    if url:
+        return RedisBus(url, channel=os.getenv("WS_PUBSUB_CHANNEL", "zerotrust:ws"),
+                        queue_size=int(os.getenv("WS_PUBSUB_QUEUE_SIZE", "10000")))
+    return LocalBus()
@@ -0,0 +1,248 @@
+import asyncio
+import json
+import math
+import os
+import sqlite3
+import threading
+import time
+from urllib.parse import parse_qs
+from fastapi import Request
+from fastapi.responses import JSONResponse
+from client_ip import get_client_ip
+from config import settings
+
+# Capacity is one minute of tokens, so buckets idle this long are full again and can be dropped
+SWEEP_INTERVAL = 60.0
+
+
+class MemoryBackend:
+    """Token buckets for one process, stored as key -> [tokens, updated_at]"""
+
+    blocking = False
+
+    def __init__(self):
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._last_sweep = time.monotonic()
+
+    def take(self, key, rate, capacity, now=None):
+        """Spend one token; returns (allowed, retry_after_seconds)"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [capacity, now]
+            else:
+                bucket[0] = min(capacity, bucket[0] + (now - bucket[1]) * rate)
+                bucket[1] = now
+            if now - self._last_sweep > SWEEP_INTERVAL:
+                self._sweep(now)
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return True, 0.0
+            return False, (1 - bucket[0]) / rate
+
+    def _sweep(self, now):
+        self._last_sweep = now
+        stale = [key for key, (_, updated) in self._buckets.items() if now - updated > SWEEP_INTERVAL]
+        for key in stale:
+            del self._buckets[key]
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class SQLiteBackend:
+    """Token buckets in a SQLite file shared by every worker on the host.
+
+    take() can wait up to busy_timeout for another worker's write lock, so the
+    middleware runs it off the event loop; a lock held longer than that fails
+    open like any other backend error.
+    """
+
+    blocking = True
+
+    def __init__(self, path, busy_timeout=0.2):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+        self._last_sweep = time.time()
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL, updated REAL)")
+            self._local.conn = conn
+        return conn
+
+    def take(self, key, rate, capacity, now=None):
+        now = time.time() if now is None else now
+        conn = self._conn()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+            tokens = capacity if row is None else min(capacity, row[0] + (now - row[1]) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            conn.execute("INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)", (key, tokens, now))
+            if now - self._last_sweep > SWEEP_INTERVAL:
+                self._last_sweep = now
+                conn.execute("DELETE FROM buckets WHERE updated < ?", (now - SWEEP_INTERVAL,))
+            conn.execute("COMMIT")
+        except Exception:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        return allowed, 0.0 if allowed else (1 - tokens) / rate
+
+    def __len__(self):
+        return self._conn().execute("SELECT COUNT(*) FROM buckets").fetchone()[0]
+
+
+class RouteGroup:
+    def __init__(self, name, per_minute, prefixes, methods=None, by_user=False):
+        self.name = name
+        self.per_minute = per_minute
+        self.prefixes = tuple(prefixes)
+        self.methods = set(methods) if methods else None
+        self.by_user = by_user
+        self.allowed = 0
+        self.limited = 0
+
+    def matches(self, method, path):
+        return (self.methods is None or method in self.methods) and path.startswith(self.prefixes)
+
+
+def _username_from_body(content_type, body):
+    try:
+        if content_type.startswith("application/x-www-form-urlencoded"):
+            values = parse_qs(body.decode("utf-8", "replace")).get("username")
+            return values[0] if values else None
+        if content_type.startswith("application/json"):
+            data = json.loads(body or b"{}")
+            if isinstance(data, dict):
+                return data.get("username") or data.get("user_id")
+    except ValueError:
+        pass
+    return None
+
+
+class RateLimiter:
+    """ASGI middleware applying per-IP (and for some groups per-username) token buckets.
+
+    The first route group whose method and path prefix match a request
+    decides its limit; requests outside every group are not limited. When the
+    backend fails the request is let through rather than taking the API down.
+    """
+
+    def __init__(self, app, limiter):
+        self.app = app
+        self.limiter = limiter
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.limiter.enabled:
+            return await self.app(scope, receive, send)
+        group = self.limiter.group_for(scope["method"], scope["path"])
+        if group is None:
+            return await self.app(scope, receive, send)
+
+        request = Request(scope)
+        keys = [f"{group.name}:ip:{get_client_ip(request)}"]
+        if group.by_user:
+            # Buffer the (small) auth body to read the username, then replay it to the app
+            body = b""
+            more = True
+            while more:
+                message = await receive()
+                body += message.get("body", b"")
+                more = message.get("more_body", False)
+            username = _username_from_body(request.headers.get("content-type", ""), body)
+            if username:
+                keys.append(f"{group.name}:user:{username}")
+            replayed = False
+
+            async def receive():
+                nonlocal replayed
+                if not replayed:
+                    replayed = True
+                    return {"type": "http.request", "body": body, "more_body": False}
+                return {"type": "http.disconnect"}
+
+        if self.limiter.backend.blocking:
+            retry_after = await asyncio.to_thread(self.limiter.check, group, keys)
+        else:
+            retry_after = self.limiter.check(group, keys)
+        if retry_after:
+            response = JSONResponse(
+                {"status": "FAIL", "error": "Rate limit exceeded", "retry_after": retry_after},
+                status_code=429,
+                headers={"Retry-After": str(retry_after)}
+            )
+            return await response(scope, receive, send)
+        return await self.app(scope, receive, send)
+
+
+class Limiter:
+    def __init__(self, backend, groups, enabled=True):
+        self.backend = backend
+        self.groups = groups
+        self.enabled = enabled
+        self.errors = 0
+
+    def group_for(self, method, path):
+        for group in self.groups:
+            if group.matches(method, path):
+                return group
+        return None
+
+    def check(self, group, keys):
+        """0 when allowed, otherwise whole seconds until a token is available"""
+        rate = group.per_minute / 60.0
+        wait = 0.0
+        try:
+            for key in keys:
+                allowed, retry_after = self.backend.take(key, rate, group.per_minute)
+                if not allowed:
+                    wait = max(wait, retry_after)
+        except Exception as e:
+            self.errors += 1
+            print(f"Rate limiter backend error, allowing request: {e}")
+            return 0
+        if wait:
+            group.limited += 1
+            return max(1, math.ceil(wait))
+        group.allowed += 1
+        return 0
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "backend": type(self.backend).__name__,
+            "buckets": len(self.backend),
+            "errors": self.errors,
+            "groups": {g.name: {"per_minute": g.per_minute, "allowed": g.allowed, "limited": g.limited} for g in self.groups}
+        }
+
+
+def open_backend(kind, path, busy_timeout=0.2):
+    if kind == "sqlite":
+        return SQLiteBackend(path, busy_timeout)
+    return MemoryBackend()
+
+
+limiter = Limiter(
+    backend=open_backend(os.getenv("RATE_LIMIT_BACKEND", "memory"), os.getenv("RATE_LIMIT_SQLITE_PATH", "rate_limit.db"),
+                         float(os.getenv("RATE_LIMIT_SQLITE_TIMEOUT", "0.2"))),
+    groups=[
+        RouteGroup("auth", settings.RATE_LIMIT_PER_MINUTE,
+                   ("/auth/login", "/auth/register"), methods=("POST",), by_user=True),
+        RouteGroup("ingestion", int(os.getenv("RATE_LIMIT_INGEST_PER_MINUTE", "600")),
+                   ("/agent/telemetry", "/track/", "/files/access", "/device/register"), methods=("POST",)),
+        RouteGroup("admin", int(os.getenv("RATE_LIMIT_ADMIN_PER_MINUTE", "300")),
+                   ("/admin/", "/security/analyze/", "/audit/", "/metrics/"), methods=("GET",)),
+    ],
+    enabled=os.getenv("RATE_LIMIT_ENABLED", "1") == "1"
+)
@@ -0,0 +1,413 @@
+# Async queries for the routers. Every function takes `db` - either
+# async_db.async_db or a connection from `async with async_db.transaction() as db:` -
+# and returns plain dicts.
+from pagination import fetch_page
+
+
+def isoformat(rows, *keys):
+    """Convert the given datetime columns to ISO strings in place"""
+    for row in rows:
+        for key in keys:
+            if row.get(key):
+                row[key] = row[key].isoformat()
+    return rows
+
+
+# users
+
+async def get_user(db, username):
+    return await db.fetch_one("SELECT * FROM users WHERE username = %s", (username,))
+
+
+async def create_user(db, username, password, role='user', status='pending'):
+    await db.execute("INSERT INTO users (username, password, role, status) VALUES (%s, %s, %s, %s)",
+                     (username, password, role, status))
+
+
+async def set_user_password(db, username, password_hash):
+    return await db.execute("UPDATE users SET password = %s WHERE username = %s", (password_hash, username))
+
+
+async def set_user_status(db, username, status):
+    return await db.execute("UPDATE users SET status = %s WHERE username = %s", (status, username))
+
+
+async def delete_user(db, username):
+    return await db.execute("DELETE FROM users WHERE username = %s", (username,))
+
+
+# login_logs
+
+async def insert_login(db, username, geo, success=True):
+    await db.execute("""
+        INSERT INTO login_logs (user_id, login_time, ip_address, success, country, city, latitude, longitude,
+                                mac_address, hostname, device_os)
+        VALUES (%s, NOW(), %s, %s, %s, %s, %s, %s, %s, %s, %s)
+    """, (username, geo["ip"], success, geo["country"], geo["city"], geo.get("latitude", 0), geo.get("longitude", 0),
+          "Pending", "Pending", "Pending"))
+
+
+async def complete_pending_login(db, username, mac, hostname, os_name, wifi_ssid):
+    """Fill in device details on the user's most recent login still marked Pending"""
+    return await db.execute("""
+        UPDATE login_logs
+        SET mac_address = %s, hostname = %s, device_os = %s, wifi_ssid = %s
+        WHERE id = (
+            SELECT id FROM login_logs
+            WHERE user_id = %s AND mac_address = 'Pending'
+            ORDER BY login_time DESC
+            LIMIT 1
+        )
+    """, (mac, hostname, os_name, wifi_ssid, username))
+
+
+async def login_history(db, username, limit=20):
+    rows = await db.fetch_all("""
+        SELECT l.login_time, l.logout_time, l.ip_address, l.city, l.country,
+               l.success, l.failure_reason, l.device_fingerprint, l.user_agent,
+               COALESCE(l.mac_address, 'N/A') as mac_address,
+               COALESCE(l.hostname, 'N/A') as hostname,
+               COALESCE(l.device_os, 'N/A') as device_os,
+               COALESCE(l.wifi_ssid, 'N/A') as wifi_ssid
+        FROM login_logs l
+        WHERE l.user_id = %s
+        ORDER BY l.login_time DESC
+        LIMIT %s
+    """, (username, limit))
+    return isoformat(rows, 'login_time', 'logout_time')
+
+
+# device_logs
+
+async def user_devices(db, username):
+    rows = await db.fetch_all("""
+        SELECT device_id, mac_address, hostname, os, ip_address, wifi_ssid,
+               device_type, trusted, first_seen, last_seen, login_count,
+               browser, screen_resolution, timezone
+        FROM device_logs
+        WHERE user_id = %s
+        ORDER BY last_seen DESC
+    """, (username,))
+    return isoformat(rows, 'first_seen', 'last_seen')
+
+
+async def upsert_device(db, username, device_id, mac, os_name, wifi_ssid, hostname, ip, os_version=None):
+    await db.execute("""
+        INSERT INTO device_logs
+        (user_id, device_id, mac_address, os, os_version, wifi_ssid, hostname, ip_address, trusted, first_seen, last_seen)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, NOW(), NOW())
+        ON CONFLICT (user_id, device_id) DO UPDATE SET
+        ip_address=EXCLUDED.ip_address,
+        os=EXCLUDED.os,
+        os_version=COALESCE(EXCLUDED.os_version, device_logs.os_version),
+        wifi_ssid=EXCLUDED.wifi_ssid,
+        hostname=EXCLUDED.hostname,
+        last_seen=NOW()
+    """, (username, device_id, mac, os_name, os_version, wifi_ssid, hostname, ip, False))
+
+
+# file_access_logs
+
+FILE_ACCESS_COLUMNS = {
+    "user_id": "user_id",
+    "file_name": "file_name",
+    "file_path": "file_path",
+    "action": "action",
+    "file_size": "file_size",
+    "sensitivity": "COALESCE(sensitivity_level, 'internal')",
+    "ip_address": "ip_address",
+    "access_time": "access_time",
+    "device_id": "device_id",
+    "risk_flag": "risk_flag"
+}
+
+RECENT_ACTIVITY_COLUMNS = {
+    "file_name": "file_name",
+    "file_path": "file_path",
+    "action": "action",
+    "file_size": "file_size",
+    "sensitivity_level": "sensitivity_level",
+    "access_time": "access_time",
+    "ip_address": "ip_address"
+}
+
+
+async def file_access_logs(db, page, user=None):
+    """page is a pagination.PageRequest; returns (rows, page info)"""
+    where, params = ("user_id = %s", (user,)) if user else ("TRUE", ())
+    rows, info = await fetch_page(db, page, FILE_ACCESS_COLUMNS, "file_access_logs", ("access_time", "id"), where, params)
+    return isoformat(rows, 'access_time'), info
+
+
+async def recent_file_activity(db, page, username):
+    rows, info = await fetch_page(db, page, RECENT_ACTIVITY_COLUMNS, "file_access_logs", ("access_time", "id"),
+                                  "user_id = %s", (username,))
+    return isoformat(rows, 'access_time'), info
+
+
+async def insert_file_access(db, username, file_name, action, sensitivity=None):
+    await db.execute("""
+        INSERT INTO file_access_logs (user_id, file_name, action, sensitivity_level)
+        VALUES (%s, %s, %s, %s)
+    """, (username, file_name, action, sensitivity))
+
+
+# network_logs
+
+NETWORK_COLUMNS = {
+    "user_id": "user_id",
+    "connection": "COALESCE(connection_type, 'Unknown')",
+    "destination": "CONCAT(COALESCE(remote_ip, 'N/A'), ':', COALESCE(remote_port, 0))",
+    "protocol": "COALESCE(protocol, 'N/A')",
+    "port": "remote_port",
+    "external": "external",
+    "timestamp": "timestamp"
+}
+
+
+async def network_activity(db, page, user=None):
+    where, params = ("user_id = %s", (user,)) if user else ("TRUE", ())
+    rows, info = await fetch_page(db, page, NETWORK_COLUMNS, "network_logs", ("timestamp", "id"), where, params)
+    return isoformat(rows, 'timestamp'), info
+
+
+async def insert_network(db, username, connection_type, remote_ip, remote_port, protocol, external):
+    await db.execute("""
+        INSERT INTO network_logs (user_id, connection_type, remote_ip, remote_port, protocol, external, timestamp)
+        VALUES (%s, %s, %s, %s, %s, %s, NOW())
+    """, (username, connection_type, remote_ip, remote_port, protocol, external))
+
+
+# files
+
+# Metadata plus the inline body of rows not yet moved to the blob store
+FILE_COLUMNS = """
+    id, file_name, file_path, file_size, file_type, sensitivity_level, owner_id,
+    created_at, updated_at, is_deleted, content_sha256,
+    CASE WHEN content_sha256 IS NULL THEN file_content END AS file_content
+"""
+
+
+async def list_files(db):
+    rows = await db.fetch_all("""
+        SELECT id, file_name, file_path, file_size, file_type,
+               sensitivity_level, owner_id, created_at, updated_at
+        FROM files
+        WHERE is_deleted = 0
+        ORDER BY updated_at DESC
+    """)
+    return isoformat(rows, 'created_at', 'updated_at')
+
+
+FILE_LIST_COLUMNS = {
+    "id": "id",
+    "file_name": "file_name",
+    "file_path": "file_path",
+    "file_size": "file_size",
+    "file_type": "file_type",
+    "sensitivity_level": "sensitivity_level",
+    "owner_id": "owner_id",
+    "created_at": "created_at",
+    "updated_at": "updated_at"
+}
+
+# Field names of the legacy /files/list response
+FILE_LIST_LEGACY_COLUMNS = {
+    "name": "file_name",
+    "size": "file_size",
+    "sensitivity": "sensitivity_level",
+    "modified": "updated_at"
+}
+
+
+async def list_files_page(db, page, columns=FILE_LIST_COLUMNS):
+    rows, info = await fetch_page(db, page, columns, "files", ("updated_at", "id"), "is_deleted = 0")
+    return isoformat(rows, 'created_at', 'updated_at', 'modified'), info
+
+
+async def get_file(db, file_id):
+    return await db.fetch_one(f"SELECT {FILE_COLUMNS} FROM files WHERE id = %s AND is_deleted = 0", (file_id,))
+
+
+async def get_file_by_name(db, file_name):
+    return await db.fetch_one(f"SELECT {FILE_COLUMNS} FROM files WHERE file_name = %s AND is_deleted = 0", (file_name,))
+
+
+async def get_file_for_update(db, file_id):
+    """get_file, locking the row until the transaction ends"""
+    return await db.fetch_one(f"SELECT {FILE_COLUMNS} FROM files WHERE id = %s AND is_deleted = 0 FOR UPDATE", (file_id,))
+
+
+async def get_file_by_name_for_update(db, file_name):
+    return await db.fetch_one(f"SELECT {FILE_COLUMNS} FROM files WHERE file_name = %s AND is_deleted = 0 FOR UPDATE", (file_name,))
+
+
+async def create_file(db, file_name, file_path, digest, size, file_type, sensitivity, owner):
+    """digest and size come from blob_store.store_content"""
+    return await db.fetch_val("""
+        INSERT INTO files (file_name, file_path, content_sha256, file_size,
+                           file_type, sensitivity_level, owner_id)
+        VALUES (%s, %s, %s, %s, %s, %s, %s)
+        RETURNING id
+    """, (file_name, file_path, digest, size, file_type, sensitivity, owner))
+
+
+async def update_file_content(db, file_id, digest, size):
+    return await db.execute("""
+        UPDATE files SET content_sha256 = %s, file_content = NULL, file_size = %s, updated_at = NOW()
+        WHERE id = %s
+    """, (digest, size, file_id))
+
+
+# Weights rank name matches over path matches over content matches
+SET_FILE_SEARCH_VECTOR = """
+    UPDATE files SET search_vector =
+        setweight(to_tsvector('simple', %s), 'A') ||
+        setweight(to_tsvector('simple', %s), 'B') ||
+        setweight(to_tsvector('simple', %s), 'C')
+    WHERE id = %s
+"""
+
+
+async def set_file_search_vector(db, file_id, name_text, path_text, content_text):
+    """Texts come from search.index_text"""
+    return await db.execute(SET_FILE_SEARCH_VECTOR, (name_text, path_text, content_text, file_id))
+
+
+SEARCH_FILE_COLUMNS = {
+    "id": "id",
+    "file_name": "file_name",
+    "file_path": "file_path",
+    "file_size": "file_size",
+    "file_type": "file_type",
+    "sensitivity_level": "sensitivity_level",
+    "owner_id": "owner_id",
+    "created_at": "created_at",
+    "updated_at": "updated_at",
+    "rank": "rank"
+}
+
+# The candidates are ranked as float8 so a rank read back from a cursor compares exactly.
+# They are the best max_candidates matches, in the order fetch_page pages them in, so
+# the cap keeps the top-ranked files rather than whichever the scan found first
+SEARCH_FILE_CANDIDATES = """(
+    SELECT f.id, f.file_name, f.file_path, f.file_size, f.file_type, f.sensitivity_level,
+           f.owner_id, f.created_at, f.updated_at, m.rank
+    FROM (
+        SELECT id, ts_rank(search_vector, query)::float8 AS rank
+        FROM files, to_tsquery('simple', %s) AS query
+        WHERE search_vector @@ query AND is_deleted = 0
+        ORDER BY rank DESC, id DESC
+        LIMIT %s
+    ) AS m JOIN files f ON f.id = m.id
+) AS matches"""
+
+SEARCH_ACCESS_COLUMNS = {
+    "id": "id",
+    "user_id": "user_id",
+    "file_name": "file_name",
+    "file_path": "file_path",
+    "action": "action",
+    "sensitivity_level": "sensitivity_level",
+    "ip_address": "ip_address",
+    "access_time": "access_time",
+    "device_id": "device_id"
+}
+
+
+async def search_files(db, tsquery, page, max_candidates):
+    """(matches counted up to max_candidates, page of those matches by rank, page info)"""
+    rows, info = await fetch_page(db, page, SEARCH_FILE_COLUMNS, SEARCH_FILE_CANDIDATES, ("rank", "id"),
+                                  params=(tsquery, max_candidates))
+    total = await count_matches(db, "files", tsquery, max_candidates)
+    return total, isoformat(rows, 'created_at', 'updated_at'), info
+
+
+async def search_file_access(db, tsquery, page, max_candidates):
+    """(matches counted up to max_candidates, page of those matches newest first, page info)"""
+    rows, info = await fetch_page(db, page, SEARCH_ACCESS_COLUMNS, "file_access_logs", ("access_time", "id"),
+                                  "search_vector @@ to_tsquery('simple', %s)", (tsquery,))
+    total = await count_matches(db, "file_access_logs", tsquery, max_candidates)
+    return total, isoformat(rows, 'access_time'), info
+
+
+async def count_matches(db, table, tsquery, max_candidates):
+    """table is one of the two searchable tables, never user input"""
+    deleted = " AND is_deleted = 0" if table == "files" else ""
+    return await db.fetch_val(f"""
+        SELECT COUNT(*) FROM (
+            SELECT 1 FROM {table}
+            WHERE search_vector @@ to_tsquery('simple', %s){deleted}
+            LIMIT %s
+        ) AS matches
+    """, (tsquery, max_candidates))
+
+
+async def delete_file(db, file_id):
+    return await db.execute("UPDATE files SET is_deleted = 1 WHERE id = %s", (file_id,))
+
+
+async def delete_file_by_name(db, file_name):
+    return await db.execute("UPDATE files SET is_deleted = 1 WHERE file_name = %s", (file_name,))
+
+
+# file_versions
+
+async def latest_file_versions(db, file_id):
+    """(latest version, latest snapshot version); (None, None) when the file has no history"""
+    row = await db.fetch_one("""
+        SELECT MAX(version) AS latest,
+               MAX(CASE WHEN kind = 'snapshot' THEN version END) AS latest_snapshot
+        FROM file_versions
+        WHERE file_id = %s
+    """, (file_id,))
+    return (row['latest'], row['latest_snapshot']) if row else (None, None)
+
+
+async def insert_file_version(db, file_id, version, kind, blob_sha256, content_sha256, size, author):
+    await db.execute("""
+        INSERT INTO file_versions (file_id, version, kind, blob_sha256, content_sha256, file_size, author)
+        VALUES (%s, %s, %s, %s, %s, %s, %s)
+    """, (file_id, version, kind, blob_sha256, content_sha256, size, author))
+
+
+async def file_version_chain(db, file_id, version):
+    """The nearest snapshot at or before version, then every delta up to it"""
+    return await db.fetch_all("""
+        SELECT version, kind, blob_sha256, content_sha256
+        FROM file_versions
+        WHERE file_id = %s AND version <= %s AND version >= (
+            SELECT MAX(version) FROM file_versions
+            WHERE file_id = %s AND version <= %s AND kind = 'snapshot'
+        )
+        ORDER BY version
+    """, (file_id, version, file_id, version))
+
+
+async def list_file_versions(db, file_id):
+    rows = await db.fetch_all("""
+        SELECT version, kind, content_sha256, file_size, author, created_at
+        FROM file_versions
+        WHERE file_id = %s
+        ORDER BY version DESC
+    """, (file_id,))
+    return isoformat(rows, 'created_at')
+
+
+# blockchain_audit
+
+AUDIT_COLUMNS = {
+    "block_index": "block_index",
+    "timestamp": "timestamp",
+    "event_type": "event_type",
+    "user_id": "user_id",
+    "event_data": "event_data",
+    "current_hash": "current_hash",
+    "previous_hash": "previous_hash"
+}
+
+
+async def audit_entries(db, page):
+    # block_index is the chain order and unique, so it is the whole sort key
+    rows, info = await fetch_page(db, page, AUDIT_COLUMNS, "blockchain_audit", ("block_index",))
+    return isoformat(rows, 'timestamp'), info
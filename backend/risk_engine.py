@@ -0,0 +1,300 @@
+import os
+import threading
+from collections import Counter, deque
+from datetime import datetime, timedelta
+from advanced_ueba import CRITICAL_FILE_PATTERNS, SIGNAL_COUNTERS, fetch_risk_counters, score_risk
+
+FILE_WINDOW = timedelta(hours=24)
+ODD_HOUR_WINDOW = timedelta(hours=24)
+FAILED_LOGIN_WINDOW = timedelta(hours=1)
+IP_WINDOW = timedelta(hours=2)
+
+CRITICAL_FILE_WORDS = tuple(p.strip('%') for p in CRITICAL_FILE_PATTERNS)
+
+
+def file_counter_keys(file_name, action):
+    """Counters a single file_access_logs row contributes to (mirrors RISK_COUNTERS_SQL)"""
+    critical = any(word in (file_name or "").lower() for word in CRITICAL_FILE_WORDS)
+    keys = []
+    if action == 'READ':
+        if critical:
+            keys.append("critical_read")
+    elif action == 'WRITE':
+        keys.append("edits")
+        if critical:
+            keys.append("critical_edit")
+    elif action == 'DOWNLOAD':
+        keys.append("downloads")
+        if critical:
+            keys.append("critical_download")
+    elif action == 'DELETE':
+        keys.append("deletes")
+    return tuple(keys)
+
+
+def is_odd_hour(at):
+    return at.hour >= 20 or at.hour < 6
+
+
+class UserWindow:
+    __slots__ = ("file_events", "file_counts", "odd_hour_logins", "failed_logins", "ips", "ip_counts")
+
+    def __init__(self):
+        self.file_events = deque()  # (time, counter keys)
+        self.file_counts = Counter()
+        self.odd_hour_logins = deque()
+        self.failed_logins = deque()
+        self.ips = deque()  # (time, ip)
+        self.ip_counts = Counter()
+
+    def add_file(self, at, keys):
+        if keys:
+            self.file_events.append((at, keys))
+            self.file_counts.update(keys)
+
+    def add_login(self, at, ip, success):
+        if is_odd_hour(at):
+            self.odd_hour_logins.append(at)
+        if not success:
+            self.failed_logins.append(at)
+        if ip:
+            self.ips.append((at, ip))
+            self.ip_counts[ip] += 1
+
+    def expire(self, now):
+        cutoff = now - FILE_WINDOW
+        while self.file_events and self.file_events[0][0] <= cutoff:
+            _, keys = self.file_events.popleft()
+            self.file_counts.subtract(keys)
+        cutoff = now - ODD_HOUR_WINDOW
+        while self.odd_hour_logins and self.odd_hour_logins[0] <= cutoff:
+            self.odd_hour_logins.popleft()
+        cutoff = now - FAILED_LOGIN_WINDOW
+        while self.failed_logins and self.failed_logins[0] <= cutoff:
+            self.failed_logins.popleft()
+        cutoff = now - IP_WINDOW
+        while self.ips and self.ips[0][0] <= cutoff:
+            _, ip = self.ips.popleft()
+            self.ip_counts[ip] -= 1
+            if self.ip_counts[ip] <= 0:
+                del self.ip_counts[ip]
+
+    def empty(self):
+        return not (self.file_events or self.odd_hour_logins or self.failed_logins or self.ips)
+
+    def counters(self):
+        counters = {k: self.file_counts.get(k, 0) for k in SIGNAL_COUNTERS}
+        counters["odd_hour_logins"] = len(self.odd_hour_logins)
+        counters["failed_logins"] = len(self.failed_logins)
+        counters["distinct_ips"] = len(self.ip_counts)
+        return counters
+
+
+class RiskEngine:
+    """Per-user sliding-window risk counters kept up to date from ingestion events.
+
+    Events are expected roughly in time order; a window is trimmed from the
+    front whenever the user is recorded or looked up.
+
+    Once ready, listeners added with add_listener() are called with
+    (user, score, previous_score) whenever a user's score or signals change,
+    either from a new event or, via the sweep thread, as events age out.
+    Until then (or when disabled) they hear about changes in the scores the
+    SQL path computes, passed in through observe().
+    """
+
+    def __init__(self, enabled=True, sweep_interval=30.0):
+        self.enabled = enabled
+        self.sweep_interval = sweep_interval
+        self.ready = False
+        self._lock = threading.Lock()
+        self._users = {}
+        self._scores = {}  # user -> last score passed to listeners
+        self._listeners = []
+        self._thread = None
+        self._stopping = threading.Event()
+        self.rebuilt_at = None
+        self.changes = 0
+
+    def add_listener(self, fn):
+        self._listeners.append(fn)
+
+    def _changed(self, user, counters):
+        """Notify listeners if the user's score moved; called with the lock held so changes stay in order"""
+        if not self.ready or not self._listeners:
+            return
+        self._notify(user, score_risk(counters))
+
+    def observe(self, user, score):
+        """Pass on a score computed from SQL while the engine is not scoring from memory"""
+        if self.ready or not self._listeners:
+            return
+        with self._lock:
+            self._notify(user, score)
+
+    def _notify(self, user, score):
+        previous = self._scores.get(user)
+        if previous is not None and previous["risk_score"] == score["risk_score"] and previous["signals"] == score["signals"]:
+            return
+        if previous is None and score["risk_score"] == 0 and not score["signals"]:
+            return
+        if score["risk_score"] == 0 and not score["signals"]:
+            self._scores.pop(user, None)
+        else:
+            self._scores[user] = score
+        self.changes += 1
+        for listener in self._listeners:
+            try:
+                listener(user, score, previous)
+            except Exception as e:
+                print(f"Risk listener failed: {e}")
+
+    def _window(self, user):
+        window = self._users.get(user)
+        if window is None:
+            window = self._users[user] = UserWindow()
+        return window
+
+    def record_file_access(self, user, file_name, action, at=None):
+        if not self.enabled or not user:
+            return
+        keys = file_counter_keys(file_name, action)
+        if not keys:
+            return
+        at = at or datetime.now()
+        with self._lock:
+            window = self._window(user)
+            window.expire(at)
+            window.add_file(at, keys)
+            self._changed(user, window.counters())
+
+    def record_login(self, user, ip_address, success=True, at=None):
+        if not self.enabled or not user:
+            return
+        at = at or datetime.now()
+        with self._lock:
+            window = self._window(user)
+            window.expire(at)
+            window.add_login(at, ip_address, success)
+            self._changed(user, window.counters())
+
+    def counters(self, user, now=None):
+        now = now or datetime.now()
+        with self._lock:
+            window = self._users.get(user)
+            if window is None:
+                return dict.fromkeys(SIGNAL_COUNTERS, 0)
+            window.expire(now)
+            counters = window.counters()
+            if window.empty():
+                del self._users[user]
+            return counters
+
+    def score(self, user):
+        return score_risk(self.counters(user))
+
+    def rebuild(self, db):
+        """Reload the windows from the last 24 hours of logs"""
+        if not self.enabled:
+            return
+        users = {}
+        cursor = db.cursor()
+        cursor.execute("""
+            SELECT user_id, file_name, action, access_time FROM file_access_logs
+            WHERE access_time > NOW() - INTERVAL '24 hours'
+            ORDER BY access_time
+        """)
+        for user_id, file_name, action, access_time in cursor.fetchall():
+            window = users.get(user_id) or users.setdefault(user_id, UserWindow())
+            window.add_file(access_time, file_counter_keys(file_name, action))
+        cursor.execute("""
+            SELECT user_id, ip_address, success, login_time FROM login_logs
+            WHERE login_time > NOW() - INTERVAL '24 hours'
+            ORDER BY login_time
+        """)
+        for user_id, ip_address, success, login_time in cursor.fetchall():
+            window = users.get(user_id) or users.setdefault(user_id, UserWindow())
+            window.add_login(login_time, ip_address, success)
+        cursor.close()
+
+        now = datetime.now()
+        scores = {}
+        for user, window in users.items():
+            window.expire(now)
+            score = score_risk(window.counters())
+            if score["risk_score"] or score["signals"]:
+                scores[user] = score
+        with self._lock:
+            self._users = users
+            self._scores = scores
+            self.ready = True
+            self.rebuilt_at = now
+
+    def sweep(self, now=None):
+        """Expire every window, notifying listeners of scores that dropped as events aged out"""
+        now = now or datetime.now()
+        with self._lock:
+            for user in list(self._users):
+                window = self._users[user]
+                window.expire(now)
+                self._changed(user, window.counters())
+                if window.empty():
+                    del self._users[user]
+
+    def _run(self):
+        while not self._stopping.wait(self.sweep_interval):
+            try:
+                self.sweep()
+            except Exception as e:
+                print(f"Risk sweep failed: {e}")
+
+    def start(self):
+        if self.enabled and self._thread is None:
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name="risk-sweep", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stopping.set()
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def check_consistency(self, db, usernames=None):
+        """Compare in-memory counters with the SQL aggregation"""
+        if usernames is None:
+            cursor = db.cursor()
+            cursor.execute("SELECT username FROM users WHERE status='active'")
+            usernames = [row[0] for row in cursor.fetchall()]
+            cursor.close()
+        sql_counters = fetch_risk_counters(usernames, db)
+        mismatches = []
+        for username in usernames:
+            engine = self.counters(username)
+            sql = sql_counters.get(username, dict.fromkeys(SIGNAL_COUNTERS, 0))
+            if engine != sql:
+                mismatches.append({"username": username, "engine": engine, "sql": sql})
+        return {
+            "ready": self.ready,
+            "rebuilt_at": self.rebuilt_at.isoformat() if self.rebuilt_at else None,
+            "users_checked": len(usernames),
+            "consistent": not mismatches,
+            "mismatches": mismatches
+        }
+
+
+def _engine_enabled():
+    """Counters are per process, so each worker would score only the events it handled itself"""
+    if os.getenv("RISK_ENGINE_ENABLED", "0") != "1":
+        return False
+    workers = os.getenv("WEB_CONCURRENCY", "1")
+    if workers.isdigit() and int(workers) > 1:
+        print(f"RISK_ENGINE_ENABLED ignored: the risk engine needs a single worker (WEB_CONCURRENCY={workers})")
+        return False
+    return True
+
+
+risk_engine = RiskEngine(
+    enabled=_engine_enabled(),
+    sweep_interval=float(os.getenv("RISK_SWEEP_INTERVAL", "30"))
+)
@@ -0,0 +1,65 @@
+import os
+import re
+import repository
+from blob_store import blob_store
+
+# Ranking scores every match, so only this many matches are ranked per query
+MAX_CANDIDATES = int(os.getenv("SEARCH_MAX_CANDIDATES", "10000"))
+# Distinct content tokens indexed per file; keeps a tsvector under Postgres' 1 MB limit
+MAX_CONTENT_TOKENS = int(os.getenv("SEARCH_MAX_CONTENT_TOKENS", "20000"))
+MAX_TOKEN_LENGTH = 100
+
+# Letters and digits; "Q3_budget-final.xlsx" -> q3 budget final xlsx. The
+# generated column on file_access_logs splits the same way in SQL.
+_TOKEN = re.compile(r"[^\W_]+")
+_QUERY_TERM = re.compile(r"([^\W_]+)(\*?)")
+
+
+def tokens(text):
+    return [t for t in _TOKEN.findall((text or "").lower()) if len(t) <= MAX_TOKEN_LENGTH]
+
+
+def index_text(text, max_tokens=None):
+    """Distinct tokens of text, space separated, for to_tsvector('simple', ...)"""
+    return " ".join(list(dict.fromkeys(tokens(text)))[:max_tokens])
+
+
+def parse_query(q):
+    """tsquery matching every term; "term*" matches by prefix. None when q has no terms"""
+    terms = []
+    for word, star in _QUERY_TERM.findall((q or "").lower()):
+        if len(word) <= MAX_TOKEN_LENGTH:
+            terms.append(word + (":*" if star else ""))
+    return " & ".join(terms) or None
+
+
+async def index_file(db, file_id, file_name, file_path, content):
+    """Refresh a file's search_vector; call in the transaction that writes the file"""
+    await repository.set_file_search_vector(db, file_id, index_text(file_name), index_text(file_path),
+                                            index_text(content, MAX_CONTENT_TOKENS))
+
+
+def reindex_files(conn, batch_size=200):
+    """Index files that have no search_vector yet (rows from before search existed); returns rows indexed"""
+    indexed = 0
+    cursor = conn.cursor()
+    last_id = 0
+    while True:
+        cursor.execute("""
+            SELECT id, file_name, file_path, content_sha256, file_content FROM files
+            WHERE search_vector IS NULL AND id > %s
+            ORDER BY id
+            LIMIT %s
+        """, (last_id, batch_size))
+        rows = cursor.fetchall()
+        if not rows:
+            break
+        for file_id, file_name, file_path, digest, inline in rows:
+            content = blob_store.get(digest).decode("utf-8") if digest else (inline or "")
+            cursor.execute(repository.SET_FILE_SEARCH_VECTOR,
+                           (index_text(file_name), index_text(file_path),
+                            index_text(content, MAX_CONTENT_TOKENS), file_id))
+            last_id = file_id
+        indexed += len(rows)
+    cursor.close()
+    return indexed
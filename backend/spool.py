@@ -0,0 +1,332 @@
+import json
+import os
+import struct
+import threading
+import time
+import uuid
+import zlib
+import psycopg2
+from mysql_database import get_db
+
+HEADER = struct.Struct(">II")  # payload length, crc32
+SEGMENT_SUFFIX = ".seg"
+ID_FILE = "SPOOL_ID"
+FSYNC_POLICIES = ("always", "interval", "never")
+# Errors caused by a row itself; retrying it would block the spool forever. Anything else
+# (a missing table, a lost connection) is retried, since the rows are fine
+REJECTED_ERRORS = (psycopg2.DataError, psycopg2.IntegrityError)
+
+
+def load_checkpoint(cursor, name):
+    """(segment, position) stored under name in spool_checkpoints, or None"""
+    cursor.execute("SELECT segment, position FROM spool_checkpoints WHERE name = %s", (name,))
+    row = cursor.fetchone()
+    return (row[0], row[1]) if row else None
+
+
+def save_checkpoint(cursor, name, segment, position):
+    """Store a replay position; commits with whatever else the cursor's transaction wrote"""
+    cursor.execute("""
+        INSERT INTO spool_checkpoints (name, segment, position, updated_at)
+        VALUES (%s, %s, %s, NOW())
+        ON CONFLICT (name) DO UPDATE SET segment = EXCLUDED.segment,
+            position = EXCLUDED.position, updated_at = EXCLUDED.updated_at
+    """, (name, segment, position))
+
+
+def segment_name(number):
+    return f"{number:020d}{SEGMENT_SUFFIX}"
+
+
+def read_records(path, offset=0, limit=None):
+    """Complete records from offset onwards and the offset just past the last one.
+
+    Reading stops at the first short or corrupt record, which is what a crash
+    in the middle of an append leaves behind.
+    """
+    records = []
+    with open(path, "rb") as f:
+        f.seek(offset)
+        while limit is None or len(records) < limit:
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size:
+                break
+            length, crc = HEADER.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                break
+            records.append(json.loads(payload))
+            offset += HEADER.size + length
+    return records, offset
+
+
+class Spool:
+    """Append-only, segment-rotated local log that ingestion writes to before the database.
+
+    append() frames each record with its length and CRC and writes it to the
+    active segment, rotating once a segment reaches `segment_bytes`. A replayer
+    thread drains segments in order through the registered handlers. The
+    replay position is stored in spool_checkpoints in the same transaction as
+    the replayed rows, so a restart resumes exactly where the last commit left
+    off and nothing is inserted twice.
+
+    A batch the database refuses is bisected under savepoints down to the rows
+    it refuses, which are appended to rejected.jsonl once the rest of the
+    batch and the checkpoint have committed.
+
+    Checkpoints are keyed by an id kept in the directory, so a wiped or new
+    spool directory starts from its own first segment instead of inheriting
+    (and deleting segments below) another directory's position.
+    """
+
+    def __init__(self, directory, name="ingest", segment_bytes=16 * 1024 * 1024, fsync="interval",
+                 fsync_interval=1.0, batch_records=500, poll_interval=0.2):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"Unknown spool fsync policy: {fsync}")
+        self.directory = directory
+        self.name = name
+        self.segment_bytes = segment_bytes
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.batch_records = batch_records
+        self.poll_interval = poll_interval
+        self.handlers = {}
+        self._lock = threading.Lock()
+        self._file = None
+        self._segment = None
+        self._size = 0
+        self._last_fsync = 0.0
+        self._checkpoint = None  # (segment, position) last committed by the replayer
+        self._id = None
+        self._adopt_legacy = False
+        self._thread = None
+        self._stopping = threading.Event()
+        self.appended = 0
+        self.appended_bytes = 0
+        self.replayed = 0
+        self.replay_batches = 0
+        self.rejected = 0
+        self.failures = 0
+
+    def register(self, kind, handler):
+        """handler(cursor, rows) writes the rows of every spooled record of this kind"""
+        self.handlers[kind] = handler
+
+    def _segments(self):
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(int(f[:-len(SEGMENT_SUFFIX)]) for f in os.listdir(self.directory)
+                      if f.endswith(SEGMENT_SUFFIX) and f[:-len(SEGMENT_SUFFIX)].isdigit())
+
+    def _path(self, number):
+        return os.path.join(self.directory, segment_name(number))
+
+    def _directory_id(self):
+        """Id of the spool directory, created with it; call with the lock held"""
+        if self._id is None:
+            os.makedirs(self.directory, exist_ok=True)
+            path = os.path.join(self.directory, ID_FILE)
+            try:
+                with open(path, encoding="utf-8") as f:
+                    fields = f.read().split()
+            except FileNotFoundError:
+                # Segments without an id were spooled before ids existed; they
+                # carry on from the checkpoint stored under the bare name
+                fields = [uuid.uuid4().hex] + (["legacy"] if self._segments() else [])
+                tmp_path = path + ".tmp"
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    f.write(" ".join(fields))
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, path)
+            self._id = fields[0]
+            self._adopt_legacy = "legacy" in fields[1:]
+        return self._id
+
+    def _open_segment(self, number):
+        self._file = open(self._path(number), "ab")
+        self._segment = number
+        self._size = self._file.tell()
+
+    def _sync(self, force=False):
+        self._file.flush()
+        now = time.monotonic()
+        if self.fsync == "always" or force or (self.fsync == "interval" and now - self._last_fsync >= self.fsync_interval):
+            if self.fsync != "never":
+                os.fsync(self._file.fileno())
+            self._last_fsync = now
+
+    def append(self, batches):
+        """Write {kind: rows} as one record, so a request is spooled completely or not at all"""
+        for kind in batches:
+            if kind not in self.handlers:
+                raise ValueError(f"No spool handler for {kind}")
+        payload = json.dumps(batches, default=str).encode()
+        record = HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+        with self._lock:
+            if self._file is None:
+                # Never append to a segment left by a previous run: it may end in a torn record,
+                # nor reuse a number at or below what the replayer has consumed
+                self._directory_id()
+                segments = self._segments()
+                consumed = self._checkpoint[0] if self._checkpoint else 0
+                self._open_segment(max(segments[-1] if segments else 0, consumed) + 1)
+            elif self._size >= self.segment_bytes:
+                self._sync(force=True)
+                self._file.close()
+                self._open_segment(self._segment + 1)
+            self._file.write(record)
+            self._size += len(record)
+            self._sync()
+            self.appended += 1
+            self.appended_bytes += len(record)
+
+    def _checkpoint_name(self):
+        with self._lock:
+            return f"{self.name}:{self._directory_id()}"
+
+    def _load_checkpoint(self, conn):
+        cursor = conn.cursor()
+        checkpoint = load_checkpoint(cursor, self._checkpoint_name())
+        if checkpoint is None and self._adopt_legacy:
+            checkpoint = load_checkpoint(cursor, self.name)
+        cursor.close()
+        self._checkpoint = checkpoint or (0, 0)
+
+    def _save_checkpoint(self, cursor, segment, position):
+        save_checkpoint(cursor, self._checkpoint_name(), segment, position)
+
+    def _reject(self, rows):
+        """Append refused (kind, row) pairs to rejected.jsonl, one single-row record per line"""
+        with open(os.path.join(self.directory, "rejected.jsonl"), "a", encoding="utf-8") as f:
+            for kind, row in rows:
+                f.write(json.dumps({kind: [row]}, default=str) + "\n")
+        self.rejected += len(rows)
+
+    def _write(self, cursor, rows, rejected):
+        """Insert (kind, row) pairs, bisecting under savepoints to collect the rows the database refuses"""
+        by_kind = {}
+        for kind, row in rows:
+            by_kind.setdefault(kind, []).append(row)
+        cursor.execute("SAVEPOINT spool_rows")
+        try:
+            for kind, kind_rows in by_kind.items():
+                self.handlers[kind](cursor, kind_rows)
+        except REJECTED_ERRORS as e:
+            cursor.execute("ROLLBACK TO SAVEPOINT spool_rows")
+            cursor.execute("RELEASE SAVEPOINT spool_rows")
+            if len(rows) == 1:
+                print(f"Spool row rejected by the database, moved aside: {e}")
+                rejected.append(rows[0])
+                return
+            middle = len(rows) // 2
+            self._write(cursor, rows[:middle], rejected)
+            self._write(cursor, rows[middle:], rejected)
+            return
+        cursor.execute("RELEASE SAVEPOINT spool_rows")
+
+    def replay_once(self):
+        """Replay one batch from the oldest unconsumed segment; returns the number of records"""
+        if self._checkpoint is None:
+            with get_db() as conn:
+                self._load_checkpoint(conn)
+        checkpoint_segment, checkpoint_position = self._checkpoint
+        for number in self._segments():
+            path = self._path(number)
+            with self._lock:
+                active = number == self._segment
+            if number < checkpoint_segment and not active:
+                os.remove(path)
+                continue
+            # The segment being written is never deleted, whatever the checkpoint says
+            position = checkpoint_position if number == checkpoint_segment else 0
+            records, end = read_records(path, position, self.batch_records)
+            if not records:
+                if active:
+                    return 0
+                os.remove(path)
+                continue
+
+            rows = [(kind, row) for record in records for kind, kind_rows in record.items() for row in kind_rows]
+            rejected = []
+            with get_db() as conn:
+                cursor = conn.cursor()
+                self._write(cursor, rows, rejected)
+                self._save_checkpoint(cursor, number, end)
+                cursor.close()
+            # Only once committed, so a retried batch never lands in the file twice
+            if rejected:
+                self._reject(rejected)
+            self._checkpoint = (number, end)
+            self.replayed += len(records)
+            self.replay_batches += 1
+            return len(records)
+        return 0
+
+    def _run(self):
+        backoff = 1.0
+        while True:
+            try:
+                replayed = self.replay_once()
+                backoff = 1.0
+            except Exception as e:
+                # The checkpoint is re-read from the database before the next attempt
+                self.failures += 1
+                self._checkpoint = None
+                print(f"Spool replay failed, retrying in {backoff:.0f}s: {e}")
+                if self._stopping.wait(backoff):
+                    return
+                backoff = min(backoff * 2, 30.0)
+                continue
+            if not replayed and self._stopping.wait(self.poll_interval):
+                return
+
+    def start(self):
+        if self._thread is None:
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name=f"spool-{self.name}", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=10):
+        """Drain what the database will take within `timeout`, then sync and close the active segment"""
+        if self._thread is not None:
+            self._stopping.set()
+            self._thread.join(timeout=timeout)
+            self._thread = None
+            deadline = time.monotonic() + timeout
+            try:
+                while time.monotonic() < deadline and self.replay_once():
+                    pass
+            except Exception as e:
+                print(f"Spool drain on shutdown stopped: {e}")
+        with self._lock:
+            if self._file is not None:
+                self._sync(force=True)
+                self._file.close()
+                self._file = None
+
+    def stats(self):
+        segments = self._segments()
+        pending_bytes = 0
+        for number in segments:
+            try:
+                pending_bytes += os.path.getsize(self._path(number))
+            except OSError:
+                pass
+        if self._checkpoint and self._checkpoint[0] in segments:
+            pending_bytes -= self._checkpoint[1]
+        return {
+            "directory": self.directory,
+            "fsync": self.fsync,
+            "segments": len(segments),
+            "active_segment": self._segment,
+            "pending_bytes": max(pending_bytes, 0),
+            "checkpoint": list(self._checkpoint) if self._checkpoint else None,
+            "appended": self.appended,
+            "appended_bytes": self.appended_bytes,
+            "replayed": self.replayed,
+            "replay_batches": self.replay_batches,
+            "rejected": self.rejected,
+            "failures": self.failures,
+            "running": self._thread is not None
+        }
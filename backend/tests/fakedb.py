@@ -0,0 +1,77 @@
+import psycopg2
+
+
+class FakeCursor:
+    """Just enough of a psycopg2 cursor for the spools: savepoints, the checkpoint table, inserted rows and audit blocks"""
+
+    def __init__(self, db):
+        self.db = db
+        self.pending = list(db.rows)
+        self.checkpoint = dict(db.checkpoints)
+        self.savepoints = []
+        self.result = None
+
+    def execute(self, sql, params=None):
+        sql = " ".join(sql.split())
+        if sql.startswith("SAVEPOINT"):
+            self.savepoints.append(len(self.pending))
+        elif sql.startswith("ROLLBACK TO SAVEPOINT"):
+            del self.pending[self.savepoints[-1]:]
+        elif sql.startswith("RELEASE SAVEPOINT"):
+            self.savepoints.pop()
+        elif "spool_checkpoints" in sql:
+            if self.db.missing_checkpoints:
+                raise psycopg2.ProgrammingError('relation "spool_checkpoints" does not exist')
+            if sql.startswith("SELECT"):
+                self.result = self.checkpoint.get(params[0])
+            elif sql.startswith("DELETE"):
+                self.checkpoint.pop(params[0], None)
+            else:
+                self.checkpoint[params[0]] = (params[1], params[2])
+        elif sql.startswith("INSERT INTO audit_blocks"):
+            self.pending.append(("block",) + tuple(params))
+        else:
+            raise AssertionError(sql)
+
+    def insert(self, rows):
+        """Rows whose first value starts with "bad" are refused like a row-level error"""
+        self.db.inserts += 1
+        if self.db.inserts in self.db.fail_inserts:
+            raise psycopg2.OperationalError("server closed the connection unexpectedly")
+        if any(str(row[0]).startswith("bad") for row in rows):
+            raise psycopg2.DataError("invalid input syntax")
+        self.pending.extend(tuple(row) for row in rows)
+
+    def fetchone(self):
+        return self.result
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self, db):
+        self.db = db
+        self.cursors = []
+
+    def cursor(self):
+        cursor = FakeCursor(self.db)
+        self.cursors.append(cursor)
+        return cursor
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None and self.cursors:
+            self.db.rows = self.cursors[-1].pending
+            self.db.checkpoints = self.cursors[-1].checkpoint
+
+
+class FakeDB:
+    def __init__(self):
+        self.rows = []
+        self.checkpoints = {}
+        self.missing_checkpoints = False
+        self.inserts = 0
+        self.fail_inserts = set()  # insert calls (counted from 1) that lose the connection
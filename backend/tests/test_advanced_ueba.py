@@ -0,0 +1,232 @@
+import itertools
+import os
+import random
+from datetime import timedelta
+
+import pytest
+
+import advanced_ueba
+from advanced_ueba import SIGNAL_COUNTERS, calculate_advanced_risk_batch, fetch_risk_counters, score_risk
+from risk_engine import risk_engine
+
+# The per-signal queries calculate_advanced_risk ran before RISK_COUNTERS_SQL,
+# in the order it ran them (Postgres spelling of the MySQL originals)
+LEGACY_QUERIES = (
+    "SELECT COUNT(*) as c FROM file_access_logs WHERE user_id=%s AND (file_name ILIKE %s OR file_name ILIKE %s OR file_name ILIKE %s) AND action='READ' AND access_time > NOW() - INTERVAL '24 hours'",
+    "SELECT COUNT(*) as c FROM file_access_logs WHERE user_id=%s AND (file_name ILIKE %s OR file_name ILIKE %s OR file_name ILIKE %s) AND action='WRITE' AND access_time > NOW() - INTERVAL '24 hours'",
+    "SELECT COUNT(*) as c FROM file_access_logs WHERE user_id=%s AND (file_name ILIKE %s OR file_name ILIKE %s OR file_name ILIKE %s) AND action='DOWNLOAD' AND access_time > NOW() - INTERVAL '24 hours'",
+    "SELECT COUNT(*) as c FROM file_access_logs WHERE user_id=%s AND action='DELETE' AND access_time > NOW() - INTERVAL '24 hours'",
+    "SELECT COUNT(*) as c FROM file_access_logs WHERE user_id=%s AND action='WRITE' AND access_time > NOW() - INTERVAL '24 hours'",
+    "SELECT COUNT(*) as c FROM file_access_logs WHERE user_id=%s AND action='DOWNLOAD' AND access_time > NOW() - INTERVAL '24 hours'",
+    "SELECT COUNT(*) as c FROM login_logs WHERE user_id=%s AND (EXTRACT(HOUR FROM login_time) >= 20 OR EXTRACT(HOUR FROM login_time) < 6) AND login_time > NOW() - INTERVAL '24 hours'",
+    "SELECT COUNT(*) as c FROM login_logs WHERE user_id=%s AND NOT success AND login_time > NOW() - INTERVAL '1 hour'",
+    "SELECT COUNT(DISTINCT ip_address) as c FROM login_logs WHERE user_id=%s AND login_time > NOW() - INTERVAL '2 hours'",
+)
+
+
+def legacy_score(counts):
+    """Scoring of the old calculate_advanced_risk, fed the nine counts in query order"""
+    risk = 0
+    signals = []
+    weights = (
+        ("CRITICAL_FILE_READ", 0, lambda c: c * 5),
+        ("CRITICAL_FILE_EDIT", 0, lambda c: c * 20),
+        ("CRITICAL_FILE_DOWNLOAD", 0, lambda c: c * 12),
+        ("FILE_DELETION", 0, lambda c: c * 15),
+        ("FILE_EDIT", 1, lambda c: c * 3),
+        ("FILE_DOWNLOAD", 3, lambda c: c * 2),
+        ("ODD_HOUR_LOGIN", 0, lambda c: c * 8),
+        ("FAILED_LOGIN", 3, lambda c: 20),
+        ("MULTIPLE_IPS", 2, lambda c: 15),
+    )
+    for (name, threshold, points), c in zip(weights, counts):
+        if c > threshold:
+            risk += points(c)
+            signals.append(f"{name}({c})")
+    risk = min(risk, 100)
+    if risk <= 30:
+        level, decision, zone = "LOW", "ALLOW", "CRITICAL"
+    elif risk <= 50:
+        level, decision, zone = "MEDIUM", "RESTRICT", "SENSITIVE"
+    elif risk <= 70:
+        level, decision, zone = "HIGH", "RESTRICT", "INTERNAL"
+    else:
+        level, decision, zone = "CRITICAL", "DENY", "PUBLIC"
+    return {"risk_score": risk, "risk_level": level, "decision": decision, "zone": zone, "signals": signals}
+
+
+class FakeCursor:
+    def __init__(self, rows):
+        self.rows = rows
+        self.executed = []
+
+    def execute(self, sql, params):
+        self.executed.append((sql, params))
+
+    def fetchall(self):
+        return self.rows
+
+    def close(self):
+        pass
+
+
+class FakeDB:
+    def __init__(self, rows):
+        self.cursor_ = FakeCursor(rows)
+
+    def cursor(self, dictionary=False):
+        return self.cursor_
+
+
+def test_no_activity_is_low_risk():
+    assert score_risk({}) == {"risk_score": 0, "risk_level": "LOW", "decision": "ALLOW", "zone": "CRITICAL", "signals": []}
+
+
+@pytest.mark.parametrize("counter, at_threshold, above", [
+    ("critical_read", 0, 1),
+    ("critical_edit", 0, 1),
+    ("critical_download", 0, 1),
+    ("deletes", 0, 1),
+    ("edits", 1, 2),
+    ("downloads", 3, 4),
+    ("odd_hour_logins", 0, 1),
+    ("failed_logins", 3, 4),
+    ("distinct_ips", 2, 3),
+])
+def test_signal_thresholds(counter, at_threshold, above):
+    assert score_risk({counter: at_threshold})["signals"] == []
+    assert len(score_risk({counter: above})["signals"]) == 1
+    assert score_risk({counter: above})["risk_score"] > 0
+
+
+@pytest.mark.parametrize("score, level, decision", [
+    (30, "LOW", "ALLOW"),
+    (31, "MEDIUM", "RESTRICT"),
+    (50, "MEDIUM", "RESTRICT"),
+    (51, "HIGH", "RESTRICT"),
+    (70, "HIGH", "RESTRICT"),
+    (71, "CRITICAL", "DENY"),
+])
+def test_level_boundaries(score, level, decision):
+    # Every score is reachable as a sum of 5s and 3s with critical reads and edits
+    for reads, edits in itertools.product(range(15), range(40)):
+        if reads * 5 + (edits * 3 if edits > 1 else 0) == score:
+            result = score_risk({"critical_read": reads, "edits": edits})
+            assert (result["risk_score"], result["risk_level"], result["decision"]) == (score, level, decision)
+            return
+    pytest.fail(f"no counters give score {score}")
+
+
+def test_score_is_capped():
+    assert score_risk({"critical_edit": 50})["risk_score"] == 100
+
+
+def test_score_matches_legacy_per_signal_scoring():
+    rng = random.Random(7)
+    grids = [[0] * 9, [1] * 9, [0, 0, 0, 0, 1, 3, 0, 3, 2], [0, 0, 0, 0, 2, 4, 0, 4, 3]]
+    grids += [[rng.randint(0, 6) for _ in range(9)] for _ in range(500)]
+    for counts in grids:
+        assert score_risk(dict(zip(SIGNAL_COUNTERS, counts))) == legacy_score(counts)
+
+
+def test_counter_rows_map_to_signals():
+    rows = [
+        {"user_id": "alice", "critical_read": 2, "critical_edit": 1, "critical_download": 0, "deletes": 0,
+         "edits": 3, "downloads": 0, "odd_hour_logins": 0, "failed_logins": 5, "distinct_ips": 1},
+        # A driver handing back NULL for a missing aggregate counts as zero
+        {"user_id": "bob", **{k: None for k in SIGNAL_COUNTERS}},
+    ]
+    db = FakeDB(rows)
+    counters = fetch_risk_counters(["alice", "bob", "alice"], db)
+    assert counters["alice"]["critical_edit"] == 1
+    assert counters["bob"] == {k: 0 for k in SIGNAL_COUNTERS}
+    # Users are looked up once each, for the file, login and result sets
+    sql, params = db.cursor_.executed[0]
+    assert sql == advanced_ueba.RISK_COUNTERS_SQL
+    assert params[3:] == (["alice", "bob"],) * 3
+
+    assert score_risk(counters["alice"]) == legacy_score([2, 1, 0, 0, 3, 0, 0, 5, 1])
+    assert score_risk(counters["bob"])["risk_score"] == 0
+
+
+def test_batch_scores_users_without_rows(monkeypatch):
+    monkeypatch.setattr(risk_engine, "ready", False)
+    rows = [{"user_id": "alice", **{k: 0 for k in SIGNAL_COUNTERS}, "deletes": 2}]
+    scores = calculate_advanced_risk_batch(["alice", "ghost"], FakeDB(rows))
+    assert scores["alice"]["signals"] == ["FILE_DELETION(2)"]
+    assert scores["ghost"] == score_risk({})
+
+
+def test_sql_scores_are_passed_to_risk_listeners(monkeypatch):
+    # With the engine off, scores computed from SQL are what risk pushes are made of
+    monkeypatch.setattr(risk_engine, "ready", False)
+    monkeypatch.setattr(risk_engine, "_scores", {})
+    changes = []
+    monkeypatch.setattr(risk_engine, "_listeners", [lambda user, score, previous: changes.append((user, score, previous))])
+    rows = [{"user_id": "alice", **{k: 0 for k in SIGNAL_COUNTERS}, "deletes": 2}]
+    calculate_advanced_risk_batch(["alice", "ghost"], FakeDB(rows))
+    calculate_advanced_risk_batch(["alice"], FakeDB(rows))
+    assert [(user, score["signals"], previous) for user, score, previous in changes] == [("alice", ["FILE_DELETION(2)"], None)]
+
+    calculate_advanced_risk_batch(["alice"], FakeDB([]))
+    assert changes[-1][0] == "alice" and changes[-1][1]["risk_score"] == 0 and changes[-1][2]["signals"] == ["FILE_DELETION(2)"]
+
+
+def test_no_users_skips_the_query():
+    db = FakeDB([])
+    assert fetch_risk_counters([], db) == {}
+    assert db.cursor_.executed == []
+
+
+@pytest.fixture
+def pg():
+    url = os.getenv("TEST_DATABASE_URL")
+    if not url:
+        pytest.skip("TEST_DATABASE_URL not set")
+    psycopg2 = pytest.importorskip("psycopg2")
+    import psycopg2.extras
+    conn = psycopg2.connect(url)
+    cursor = conn.cursor()
+    # Temporary tables shadow the real ones for this session only
+    cursor.execute("""
+        CREATE TEMP TABLE file_access_logs (user_id VARCHAR(50), file_name VARCHAR(255), action VARCHAR(50),
+                                            access_time TIMESTAMP);
+        CREATE TEMP TABLE login_logs (user_id VARCHAR(50), login_time TIMESTAMP, ip_address VARCHAR(50),
+                                      success BOOLEAN);
+    """)
+
+    class Conn:
+        def cursor(self, dictionary=False):
+            return conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) if dictionary else conn.cursor()
+
+    yield conn, Conn()
+    conn.rollback()
+    conn.close()
+
+
+def test_single_query_matches_legacy_queries(pg):
+    conn, db = pg
+    cursor = conn.cursor()
+    cursor.execute("SELECT NOW()::timestamp")
+    now = cursor.fetchone()[0]
+    rng = random.Random(11)
+    users = ["alice", "bob", "carol", "idle"]
+    names = ["Secret_plan.txt", "CREDENTIALS.env", "salary-2026.xlsx", "notes.txt", "readme.md"]
+    for _ in range(400):
+        cursor.execute("INSERT INTO file_access_logs VALUES (%s, %s, %s, %s)", (
+            rng.choice(users[:3]), rng.choice(names), rng.choice(["READ", "WRITE", "DOWNLOAD", "DELETE", "CREATE"]),
+            now - timedelta(minutes=rng.randint(1, 36 * 60))))
+        cursor.execute("INSERT INTO login_logs VALUES (%s, %s, %s, %s)", (
+            rng.choice(users[:3]), now - timedelta(minutes=rng.randint(1, 36 * 60)),
+            rng.choice(["10.0.0.1", "10.0.0.2", "10.0.0.3", "10.0.0.4", None]), rng.random() > 0.3))
+
+    counters = fetch_risk_counters(users, db)
+    for user in users:
+        legacy = []
+        for sql in LEGACY_QUERIES:
+            params = (user, *advanced_ueba.CRITICAL_FILE_PATTERNS) if "ILIKE" in sql else (user,)
+            cursor.execute(sql, params)
+            legacy.append(cursor.fetchone()[0])
+        assert [counters[user][k] for k in SIGNAL_COUNTERS] == legacy
+        assert score_risk(counters[user]) == legacy_score(legacy)
+    assert counters["idle"] == {k: 0 for k in SIGNAL_COUNTERS}
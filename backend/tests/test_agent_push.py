@@ -0,0 +1,80 @@
+import json
+import os
+import socket
+import sys
+import threading
+import time
+
+import pytest
+
+websocket = pytest.importorskip("websocket")
+pytest.importorskip("psutil")
+pytest.importorskip("tkinter")
+uvicorn = pytest.importorskip("uvicorn")
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), "agent"))
+
+import main
+import unified_soc_agent
+from security import create_access_token
+from websocket_manager import manager
+
+
+@pytest.fixture(scope="module")
+def backend():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(main.app, host="127.0.0.1", port=port, lifespan="off", log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    deadline = time.time() + 10
+    while not server.started:
+        if time.time() > deadline:
+            pytest.fail("backend did not start")
+        time.sleep(0.05)
+    yield f"http://127.0.0.1:{port}"
+    server.should_exit = True
+    thread.join(10)
+    # The manager is bound to the server's loop, which is gone now
+    manager._loop = None
+    manager._loop_thread = None
+
+
+def receive(conn):
+    return json.loads(conn.recv())
+
+
+def test_agent_subscribes_with_its_login_token(backend):
+    token = create_access_token({"sub": "alice", "role": "user"})
+    conn = unified_soc_agent.connect_push("alice", token, ["risk:alice", "files:alice"], backend=backend)
+    try:
+        message = receive(conn)
+    finally:
+        conn.close()
+    assert message["type"] == "subscribed"
+    assert message["topics"] == ["files:alice", "risk:alice"]
+    assert message["denied"] == []
+    # The risk engine is off, so the agent is told to keep polling its score
+    assert message["risk_push"] is False
+
+
+def test_agent_resumes_from_its_last_sequence(backend):
+    token = create_access_token({"sub": "alice", "role": "user"})
+    conn = unified_soc_agent.connect_push("alice", token, ["risk:alice"], since=0, backend=backend)
+    try:
+        assert receive(conn)["type"] == "subscribed"
+        assert receive(conn)["type"] in ("resumed", "resync")
+    finally:
+        conn.close()
+
+
+@pytest.mark.parametrize("token", ["not-a-jwt", create_access_token({"sub": "bob", "role": "admin"})])
+def test_agent_is_refused_without_its_own_token(backend, token):
+    conn = unified_soc_agent.connect_push("alice", token, ["risk:alice"], backend=backend)
+    try:
+        opcode, data = conn.recv_data(control_frame=True)
+        assert opcode == websocket.ABNF.OPCODE_CLOSE
+        assert int.from_bytes(data[:2], "big") == 1008
+    finally:
+        conn.close()
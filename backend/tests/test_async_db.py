@@ -0,0 +1,23 @@
+import asyncio
+
+import async_db
+from async_db import AsyncDatabase
+from fakedb import FakeConnection, FakeDB
+
+
+def test_call_waits_for_a_connection_slot(monkeypatch):
+    monkeypatch.setattr(async_db, "get_db", lambda: FakeConnection(FakeDB()))
+    database = AsyncDatabase(max_connections=1)
+
+    async def scenario():
+        async with database.transaction():
+            # ingest and ActivityTracker open their own pool connections inside call()
+            waiting = asyncio.create_task(database.call(lambda: "done"))
+            await asyncio.sleep(0.05)
+            assert not waiting.done()
+            assert database.stats()["connections_free"] == 0
+        assert await waiting == "done"
+        assert database.stats()["connections_free"] == 1
+        await database.close()
+
+    asyncio.run(scenario())
@@ -0,0 +1,75 @@
+import psycopg2
+import pytest
+
+import blockchain
+from blockchain import DROPPED_EVENT, GENESIS_HASH, AuditChain
+from fakedb import FakeConnection, FakeDB
+
+
+@pytest.fixture
+def db(monkeypatch):
+    db = FakeDB()
+    monkeypatch.setattr(blockchain, "get_db", lambda: FakeConnection(db))
+    monkeypatch.setattr(blockchain.psycopg2.extras, "execute_values",
+                        lambda cursor, sql, rows, **kwargs: cursor.insert(rows))
+    return db
+
+
+def make_chain(db, monkeypatch, **kwargs):
+    chain = AuditChain(batch_size=2, max_latency=0.01, **kwargs)
+
+    def load_head(conn):
+        events = [row for row in db.rows if row[0] != "block"]
+        blocks = [row for row in db.rows if row[0] == "block"]
+        chain._head = (events[-1][0], events[-1][6]) if events else (0, GENESIS_HASH)
+        chain._block_head = (blocks[-1][1], blocks[-1][7]) if blocks else (0, GENESIS_HASH)
+
+    monkeypatch.setattr(chain, "_load_head", load_head)
+    return chain
+
+
+def committed(db):
+    events = [row for row in db.rows if row[0] != "block"]
+    for previous, event in zip(events, events[1:]):
+        assert event[0] == previous[0] + 1 and event[7] == previous[6]
+    return events
+
+
+def test_failed_commit_spills_and_replays_in_order(db, monkeypatch, tmp_path):
+    chain = make_chain(db, monkeypatch, spill_path=str(tmp_path / "audit.jsonl"))
+    for i in range(5):
+        chain.append("LOGIN", f"u{i}", {"n": i})
+    db.fail_inserts = {1, 3}
+    batch = chain._collect()
+    with pytest.raises(psycopg2.OperationalError) as error:
+        chain._commit(batch)
+    chain._failed(batch, 0, error.value)
+    assert chain.spilled == 5 and chain._queue.empty() and not chain._retry_batch
+
+    chain.append("LOGIN", "u5", {"n": 5})
+    # The second spilled block loses the connection after the first has committed
+    assert chain._replay_spill() == 2
+    with pytest.raises(psycopg2.OperationalError) as error:
+        chain._replay_spill()
+    chain._failed([], 0, error.value)
+    while chain._replay_spill():
+        pass
+    chain._commit(chain._collect())
+
+    assert [row[3] for row in committed(db)] == [f"u{i}" for i in range(6)]
+    assert chain.stats()["spill_pending_bytes"] == 0
+    assert db.checkpoints == {} and not list(tmp_path.iterdir())
+
+
+def test_dropped_events_are_recorded_in_the_chain(db, monkeypatch):
+    chain = make_chain(db, monkeypatch, queue_size=1)
+    assert chain.append("LOGIN", "u0", {})
+    assert chain.append("LOGIN", "u1", {}) is None
+    batch = chain._collect()
+    batch.append(chain._drop_notice())
+    chain._commit(batch)
+
+    events = committed(db)
+    assert [row[2] for row in events] == ["LOGIN", DROPPED_EVENT]
+    assert '"count": 1' in events[1][4]
+    assert chain._drop_notice() is None and chain.stats()["dropped"] == 1
@@ -0,0 +1,60 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("redis")
+fakeredis = pytest.importorskip("fakeredis")
+pytest.importorskip("lupa")
+
+import pubsub
+from pubsub import PUBLISHER_KEY_TTL, RedisBus
+
+
+class Recorder:
+    def __init__(self):
+        self.delivered = []
+
+    def deliver(self, topic, message, seq=None):
+        self.delivered.append((seq, message["n"]))
+
+
+async def wait_for(condition, timeout=2.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        assert asyncio.get_running_loop().time() < deadline
+        await asyncio.sleep(0.01)
+
+
+def test_resent_messages_are_not_published_twice(monkeypatch):
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(pubsub.aioredis, "from_url", lambda url: fakeredis.aioredis.FakeRedis(server=server))
+
+    async def scenario():
+        bus = RedisBus("redis://fake")
+        recorder = Recorder()
+        await bus.start(recorder)
+        await asyncio.sleep(0.05)
+        bus.publish("t", {"n": 1})
+        bus.publish("t", {"n": 2})
+        await wait_for(lambda: len(recorder.delivered) == 2)
+        # A pipeline resent after it partly went through carries the same numbers
+        assert await bus._script(keys=[bus.seq_key, bus.channel, bus.publisher_key],
+                                 args=['{"topic": "t", "message": {"n": 1}}', 1, PUBLISHER_KEY_TTL]) == 0
+        bus.publish("t", {"n": 3})
+        await wait_for(lambda: len(recorder.delivered) == 3)
+        await bus.close()
+        return recorder.delivered
+
+    assert asyncio.run(scenario()) == [(1, 1), (2, 2), (3, 3)]
+
+
+def test_full_queue_drops_and_counts():
+    async def scenario():
+        bus = RedisBus("redis://unused", queue_size=1)
+        bus._queue = asyncio.Queue(maxsize=1)
+        bus.publish("t", {"n": 1})
+        bus.publish("t", {"n": 2})
+        return bus.stats()
+
+    stats = asyncio.run(scenario())
+    assert stats["pending"] == 1 and stats["dropped"] == 1
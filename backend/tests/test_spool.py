@@ -0,0 +1,63 @@
+import json
+
+import psycopg2
+import pytest
+
+import spool
+from fakedb import FakeConnection, FakeDB
+from spool import Spool
+
+
+def insert(cursor, rows):
+    cursor.insert(rows)
+
+
+@pytest.fixture
+def db(monkeypatch):
+    db = FakeDB()
+    monkeypatch.setattr(spool, "get_db", lambda: FakeConnection(db))
+    return db
+
+
+@pytest.fixture
+def ingest_spool(tmp_path):
+    s = Spool(str(tmp_path), fsync="never")
+    s.register("events", insert)
+    yield s
+    s.stop()
+
+
+def rejected_lines(s):
+    try:
+        with open(f"{s.directory}/rejected.jsonl", encoding="utf-8") as f:
+            return [json.loads(line) for line in f]
+    except FileNotFoundError:
+        return []
+
+
+def test_bad_row_is_rejected_alone(db, ingest_spool):
+    ingest_spool.append({"events": [["a"], ["bad-1"], ["b"], ["c"]]})
+    ingest_spool.append({"events": [["d"], ["bad-2"]]})
+    assert ingest_spool.replay_once() == 2
+    assert db.rows == [("a",), ("b",), ("c",), ("d",)]
+    assert rejected_lines(ingest_spool) == [{"events": [["bad-1"]]}, {"events": [["bad-2"]]}]
+    assert ingest_spool.rejected == 2
+    assert ingest_spool.replay_once() == 0
+
+
+def test_schema_errors_are_retried_not_rejected(db, ingest_spool):
+    # The rows go in, then saving the checkpoint fails: e.g. /init-database not re-run
+    ingest_spool._checkpoint = (0, 0)
+    db.missing_checkpoints = True
+    ingest_spool.append({"events": [["a"], ["bad"]]})
+    for _ in range(3):
+        with pytest.raises(psycopg2.ProgrammingError):
+            ingest_spool.replay_once()
+    assert db.rows == []
+    assert rejected_lines(ingest_spool) == []
+    assert ingest_spool.rejected == 0
+
+    db.missing_checkpoints = False
+    assert ingest_spool.replay_once() == 1
+    assert db.rows == [("a",)]
+    assert rejected_lines(ingest_spool) == [{"events": [["bad"]]}]
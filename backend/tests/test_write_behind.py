@@ -0,0 +1,70 @@
+import os
+
+import psycopg2
+import pytest
+
+import write_behind
+from fakedb import FakeConnection, FakeDB
+from write_behind import WriteBehindQueue
+
+
+@pytest.fixture
+def db(monkeypatch):
+    db = FakeDB()
+    monkeypatch.setattr(write_behind, "get_db", lambda: FakeConnection(db))
+    monkeypatch.setattr(write_behind.psycopg2.extras, "execute_values",
+                        lambda cursor, sql, rows, **kwargs: cursor.insert(rows))
+    return db
+
+
+@pytest.fixture
+def writer(tmp_path):
+    return WriteBehindQueue(batch_size=2, queue_size=1, policy="spill", spill_path=str(tmp_path / "spill.jsonl"))
+
+
+def risk_event(user):
+    return ("risk_events", (user, "TEST", 10, "low", "test"))
+
+
+def test_replay_resumes_after_a_failure_partway(db, writer):
+    writer._spill([risk_event(f"u{i}") for i in range(6)])
+    # The second batch loses the connection after the first has committed
+    db.fail_inserts = {2}
+    with pytest.raises(psycopg2.OperationalError):
+        writer._replay_spill()
+    assert [row[0] for row in db.rows] == ["u0", "u1"]
+
+    writer._replay_spill()
+    assert [row[0] for row in db.rows] == [f"u{i}" for i in range(6)]
+    assert not [name for name in os.listdir(os.path.dirname(writer.spill_path)) if ".replay" in name]
+    assert db.checkpoints == {}
+
+
+def test_replay_sets_aside_rejected_rows_once(db, writer):
+    writer._spill([risk_event("u0"), risk_event("bad"), risk_event("u1")])
+    # [u0, bad] is split: u0 commits and bad is set aside; then the batch [u1] loses the connection
+    db.fail_inserts = {4}
+    with pytest.raises(psycopg2.OperationalError):
+        writer._replay_spill()
+    writer._replay_spill()
+    assert [row[0] for row in db.rows] == ["u0", "u1"]
+    with open(writer.spill_path + ".rejected", encoding="utf-8") as f:
+        assert len(f.readlines()) == 1
+    assert writer.rejected == 1
+
+
+def test_enqueue_leaves_spilling_to_the_flusher(db, writer):
+    # Pretend the flusher runs so enqueue() queues instead of writing through
+    writer._thread = object()
+    for i in range(2):
+        writer.enqueue(*risk_event(f"u{i}"))
+    assert not os.path.exists(writer.spill_path)
+    assert writer.stats()["spill_pending"] == 1
+    # Both queues full
+    writer.enqueue(*risk_event("u2"))
+    assert writer.dropped == 1
+
+    writer._spill_overflow()
+    with open(writer.spill_path, encoding="utf-8") as f:
+        assert len(f.readlines()) == 1
+    assert writer.spilled == 1
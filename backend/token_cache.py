@@ -0,0 +1,66 @@
+import hashlib
+import os
+import time
+from cache import TTLCache
+from config import settings
+
+# The lifetime create_access_token issues tokens with; revocations must last at least as long
+TOKEN_LIFETIME = settings.ACCESS_TOKEN_EXPIRE_MINUTES * 60
+
+
+def token_subject(claims):
+    return claims.get("sub") or claims.get("username")
+
+
+class TokenCache:
+    """Decoded JWT claims keyed by token digest, kept until the token's exp.
+
+    Revoking a user records the time; any token for that user issued at or
+    before it is refused, whether it comes from the cache or a fresh decode.
+    """
+
+    def __init__(self, maxsize=10000, token_lifetime=1800):
+        self.claims = TTLCache(maxsize=maxsize, ttl=token_lifetime)
+        # username -> revoked_at; only needs to outlive the tokens it refuses
+        self.revocations = TTLCache(maxsize=maxsize, ttl=token_lifetime)
+        self.revoked_hits = 0
+
+    @staticmethod
+    def digest(token):
+        return hashlib.sha256(token.encode()).hexdigest()
+
+    def is_revoked(self, claims):
+        revoked_at = self.revocations.get(token_subject(claims))
+        return revoked_at is not None and claims.get("iat", 0) <= revoked_at
+
+    def get(self, token):
+        """Cached claims, None on a miss; raises PermissionError for a revoked token"""
+        key = self.digest(token)
+        claims = self.claims.get(key)
+        if claims is None:
+            return None
+        if claims.get("exp", 0) <= time.time():
+            self.claims.pop(key)
+            return None
+        if self.is_revoked(claims):
+            self.claims.pop(key)
+            self.revoked_hits += 1
+            raise PermissionError("Token revoked")
+        return claims
+
+    def put(self, token, claims):
+        remaining = claims.get("exp", 0) - time.time()
+        if remaining > 0:
+            self.claims.set(self.digest(token), claims, ttl=remaining)
+
+    def revoke_user(self, username):
+        self.revocations.set(username, int(time.time()))
+
+    def stats(self):
+        return dict(self.claims.stats(), revoked_users=len(self.revocations), revoked_hits=self.revoked_hits)
+
+
+token_cache = TokenCache(
+    maxsize=int(os.getenv("TOKEN_CACHE_SIZE", "10000")),
+    token_lifetime=TOKEN_LIFETIME
+)
@@ -1,40 +1,343 @@
 from fastapi import WebSocket
-from typing import List, Dict
+from starlette.websockets import WebSocketState
+from typing import Dict, Set
+from collections import deque
 import json
 import asyncio
+import os
+import threading
+import time
+from pubsub import LocalBus, open_bus
+
+# "<kind>:<username>" - the user's own stream; admins may subscribe to anyone's
+USER_TOPICS = ("risk", "files", "network")
+# Fleet-wide streams carry every user's activity, so only admins get them
+ADMIN_TOPICS = ("risk", "files", "network", "audit", "alerts")
+OPEN_TOPICS = ("messages",)
+DEFAULT_TOPICS = ("messages",)
+
+
+def can_subscribe(topic, user, is_admin=False):
+    kind, _, owner = topic.partition(":")
+    if owner:
+        return kind in USER_TOPICS and (is_admin or owner == user)
+    if kind in OPEN_TOPICS:
+        return True
+    return kind in ADMIN_TOPICS and is_admin
+
+
+class Client:
+    """One WebSocket with its own bounded send queue, drained by a writer task"""
+
+    def __init__(self, websocket: WebSocket, user: str = None, queue_size: int = 256, is_admin: bool = False):
+        self.websocket = websocket
+        self.user = user
+        self.is_admin = is_admin
+        self.topics: Set[str] = set()
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.writer = None
+        self.sent = 0
+        self.dropped = 0
+        self.closed = False
+
 
 class ConnectionManager:
-    def __init__(self):
-        self.active_connections: List[WebSocket] = []
-        self.user_connections: Dict[str, List[WebSocket]] = {}
-    
-    async def connect(self, websocket: WebSocket, user: str = None):
-        await websocket.accept()
-        self.active_connections.append(websocket)
+    """Fans messages out to WebSockets without letting one client hold up the rest.
+
+    broadcast() serializes a message once and puts the text on every client's
+    queue without waiting; each client's writer task sends from its queue. When
+    a queue is full the client is a slow consumer and the policy decides what
+    happens: "drop" discards that client's oldest queued message, "disconnect"
+    closes the socket. Sockets whose send fails or takes longer than
+    send_timeout are closed and removed.
+
+    Clients subscribe to topics and publish() only touches the subscribers of
+    its topic, found through the topic -> clients index.
+
+    Every published message gets the next sequence number and is kept in a
+    bounded history for its topic, so a reconnecting client can resume() from
+    the last sequence it saw and receive only what it missed on its own topics.
+    Clients should ignore messages with a sequence they have already seen.
+
+    Topics nobody is subscribed to are not recorded. A topic stays recorded for
+    resume_window seconds after its last subscriber leaves so that client can
+    reconnect and resume; after that its messages are skipped and only noted,
+    so a resume that would have needed them gets a resync.
+
+    Publishing goes through a bus. LocalBus keeps messages in this process;
+    RedisBus carries them to every worker, numbered by a shared counter, and
+    each worker delivers what it receives to its own connections.
+    """
+
+    def __init__(self, queue_size=256, policy="drop", send_timeout=10.0, history_size=1000, resume_window=120.0, bus=None):
+        self.queue_size = queue_size
+        self.policy = policy
+        self.send_timeout = send_timeout
+        self.clients: Dict[WebSocket, Client] = {}
+        self.user_connections: Dict[str, Set[Client]] = {}
+        self.topics: Dict[str, Set[Client]] = {}
+        self.bus = bus or LocalBus()
+        self._loop = None
+        self._loop_thread = None
+        self.history_size = history_size
+        self.resume_window = resume_window
+        self.history: Dict[str, deque] = {}  # topic -> (seq, message)
+        self._lost: Dict[str, int] = {}  # topic -> newest seq of it that was not kept
+        self._idle_until: Dict[str, float] = {}  # topic -> when it stops being recorded without subscribers
+        self._base = 0  # nothing at or before this seq is kept
+        self._seq = 0
+        self._seq_lock = threading.Lock()
+        self.published = 0
+        self.slow_disconnects = 0
+        self.reaped = 0
+
+    @property
+    def active_connections(self):
+        return list(self.clients)
+
+    async def start(self):
+        if self._loop is None:
+            self._loop = asyncio.get_running_loop()
+            self._loop_thread = threading.get_ident()
+            await self.bus.start(self)
+
+    async def connect(self, websocket: WebSocket, user: str = None, is_admin: bool = False, topics=DEFAULT_TOPICS):
+        if websocket.application_state == WebSocketState.CONNECTING:
+            await websocket.accept()
+        await self.start()
+        client = Client(websocket, user, self.queue_size, is_admin)
+        self.clients[websocket] = client
         if user:
-            if user not in self.user_connections:
-                self.user_connections[user] = []
-            self.user_connections[user].append(websocket)
-    
+            self.user_connections.setdefault(user, set()).add(client)
+        self.subscribe(client, topics)
+        client.writer = asyncio.create_task(self._writer(client))
+        return client
+
+    def subscribe(self, client: Client, topics):
+        """Returns (subscribed, denied) topic lists"""
+        subscribed, denied = [], []
+        for topic in topics:
+            if not can_subscribe(topic, client.user, client.is_admin):
+                denied.append(topic)
+                continue
+            client.topics.add(topic)
+            self.topics.setdefault(topic, set()).add(client)
+            self._idle_until.pop(topic, None)
+            subscribed.append(topic)
+        return subscribed, denied
+
+    def unsubscribe(self, client: Client, topics):
+        for topic in topics:
+            client.topics.discard(topic)
+            subscribers = self.topics.get(topic)
+            if subscribers is not None:
+                subscribers.discard(client)
+                if not subscribers:
+                    del self.topics[topic]
+                    self._idle_until[topic] = time.monotonic() + self.resume_window
+
     def disconnect(self, websocket: WebSocket, user: str = None):
-        self.active_connections.remove(websocket)
-        if user and user in self.user_connections:
-            if websocket in self.user_connections[user]:
-                self.user_connections[user].remove(websocket)
-    
+        client = self.clients.pop(websocket, None)
+        if client is None:
+            return
+        client.closed = True
+        users = self.user_connections.get(client.user)
+        if users is not None:
+            users.discard(client)
+            if not users:
+                del self.user_connections[client.user]
+        self.unsubscribe(client, list(client.topics))
+        if client.writer is not None and client.writer is not asyncio.current_task():
+            client.writer.cancel()
+            # wait_for() can swallow a cancel that lands as a send completes, so
+            # also wake the writer with a sentinel it stops on
+            if client.queue.full():
+                client.queue.get_nowait()
+            client.queue.put_nowait(None)
+
+    async def _writer(self, client: Client):
+        try:
+            while True:
+                text = await client.queue.get()
+                if text is None or client.closed:
+                    break
+                await asyncio.wait_for(client.websocket.send_text(text), timeout=self.send_timeout)
+                client.sent += 1
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            # Closed, broken or stalled socket
+            self.reaped += 1
+            self._close(client, 1011)
+
+    def _close(self, client: Client, code: int):
+        if client.closed:
+            return
+        self.disconnect(client.websocket)
+        asyncio.create_task(self._close_socket(client.websocket, code))
+
+    async def _close_socket(self, websocket: WebSocket, code: int):
+        try:
+            await asyncio.wait_for(websocket.close(code=code), timeout=self.send_timeout)
+        except Exception:
+            pass
+
+    def _offer(self, client: Client, text: str):
+        try:
+            client.queue.put_nowait(text)
+            return True
+        except asyncio.QueueFull:
+            pass
+        if self.policy == "disconnect":
+            self.slow_disconnects += 1
+            # 1013: try again later
+            self._close(client, 1013)
+            return False
+        client.queue.get_nowait()
+        client.dropped += 1
+        client.queue.put_nowait(text)
+        return True
+
+    def _fan_out(self, clients, message: dict):
+        text = json.dumps(message, default=str)
+        delivered = 0
+        for client in list(clients):
+            if not client.closed and self._offer(client, text):
+                delivered += 1
+        return delivered
+
     async def broadcast(self, message: dict):
-        for connection in self.active_connections:
+        return self._fan_out(self.clients.values(), message)
+
+    async def send_to_user(self, user: str, message: dict):
+        return self._fan_out(self.user_connections.get(user, ()), message)
+
+    def send(self, client: Client, message: dict):
+        return self._fan_out((client,), message)
+
+    @property
+    def seq(self):
+        return self._seq
+
+    def recording(self, topic: str):
+        """Whether this worker keeps the topic's messages: it has subscribers, or had them within resume_window"""
+        return topic in self.topics or time.monotonic() < self._idle_until.get(topic, 0)
+
+    def _skip(self, topic: str, seq: int):
+        """Note that the topic's message seq was not kept; called with _seq_lock held"""
+        self._lost[topic] = seq
+        self.history.pop(topic, None)
+        self._idle_until.pop(topic, None)
+
+    def deliver(self, topic: str, message: dict, seq: int = None):
+        """Number, record and fan out a message coming off the bus; seq is set when the bus numbered it"""
+        recording = self.recording(topic)
+        with self._seq_lock:
+            if seq is None:
+                if not recording:
+                    self._skip(topic, self._seq + 1)
+                    return 0
+                seq = self._seq + 1
+            elif seq <= self._seq:
+                return 0
+            elif seq != self._seq + 1:
+                # First message, or missed messages (bus reconnect): older sequences can no longer be resumed from here
+                self.history.clear()
+                self._lost.clear()
+                self._base = seq - 1
+            self._seq = seq
+            if not recording:
+                self._skip(topic, seq)
+                return 0
+            message = dict(message, topic=topic, seq=seq)
+            history = self.history.setdefault(topic, deque(maxlen=self.history_size))
+            if len(history) == history.maxlen:
+                self._lost[topic] = history[0][0]
+            history.append((seq, message))
+        subscribers = self.topics.get(topic)
+        if not subscribers:
+            return 0
+        self.published += 1
+        return self._fan_out(subscribers, message)
+
+    async def publish(self, topic: str, message: dict):
+        await self.start()
+        self.bus.publish(topic, message)
+
+    def publish_threadsafe(self, topic: str, message: dict):
+        """publish() for synchronous code, which may be running on a worker thread"""
+        if not self.bus.shared and not self.recording(topic):
+            # Nobody here wants it and no other worker can; a shared bus has to publish
+            # because another worker may have subscribers
+            with self._seq_lock:
+                self._skip(topic, self._seq + 1)
+            return
+        if self._loop is None:
+            # Not serving yet; nothing is connected, only the history is kept
+            self.deliver(topic, message)
+        elif threading.get_ident() == self._loop_thread:
+            self.bus.publish(topic, message)
+        else:
             try:
-                await connection.send_json(message)
-            except:
+                self._loop.call_soon_threadsafe(self.bus.publish, topic, message)
+            except RuntimeError:
+                # Event loop already closed during shutdown
                 pass
-    
-    async def send_to_user(self, user: str, message: dict):
-        if user in self.user_connections:
-            for connection in self.user_connections[user]:
-                try:
-                    await connection.send_json(message)
-                except:
-                    pass
-
-manager = ConnectionManager()
+
+    def resume(self, client: Client, since: int):
+        """Queue the client's missed messages after `since`; returns False when history no longer reaches back that far"""
+        with self._seq_lock:
+            current = self._seq
+            oldest = max([self._base] + [self._lost.get(topic, 0) for topic in client.topics])
+            missed = sorted(
+                (entry for topic in client.topics for entry in self.history.get(topic, ()) if entry[0] > since),
+                key=lambda entry: entry[0])
+        if since > current or since < oldest:
+            self.send(client, {"type": "resync", "since": since, "seq": current})
+            return False
+        if len(missed) >= self.queue_size:
+            # More than the send queue holds; a snapshot is cheaper than replaying
+            self.send(client, {"type": "resync", "since": since, "seq": current})
+            return False
+        for seq, message in missed:
+            self._fan_out((client,), message)
+        self.send(client, {"type": "resumed", "since": since, "seq": current, "replayed": len(missed)})
+        return True
+
+    async def close_all(self):
+        clients = list(self.clients.values())
+        for client in clients:
+            self.disconnect(client.websocket)
+        await asyncio.gather(*(c.writer for c in clients if c.writer), return_exceptions=True)
+        await asyncio.gather(*(self._close_socket(c.websocket, 1001) for c in clients))
+        await self.bus.close()
+
+    def stats(self):
+        clients = list(self.clients.values())
+        return {
+            "connections": len(clients),
+            "users": len(self.user_connections),
+            "topics": {topic: len(subscribers) for topic, subscribers in self.topics.items()},
+            "published": self.published,
+            "seq": self._seq,
+            "history": sum(len(history) for history in list(self.history.values())),
+            "history_topics": len(self.history),
+            "policy": self.policy,
+            "queue_size": self.queue_size,
+            "queued": sum(c.queue.qsize() for c in clients),
+            "sent": sum(c.sent for c in clients),
+            "dropped": sum(c.dropped for c in clients),
+            "slow_disconnects": self.slow_disconnects,
+            "reaped": self.reaped,
+            "bus": self.bus.stats()
+        }
+
+
+manager = ConnectionManager(
+    queue_size=int(os.getenv("WS_QUEUE_SIZE", "256")),
+    policy=os.getenv("WS_SLOW_CONSUMER_POLICY", "drop"),
+    send_timeout=float(os.getenv("WS_SEND_TIMEOUT", "10")),
+    history_size=int(os.getenv("WS_HISTORY_SIZE", "1000")),
+    resume_window=float(os.getenv("WS_RESUME_WINDOW", "120")),
+    bus=open_bus(os.getenv("WS_PUBSUB_URL", ""))
+)
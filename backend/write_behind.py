@@ -0,0 +1,313 @@
+import glob
+import json
+import os
+import queue
+import threading
+import time
+import uuid
+import psycopg2.extras
+from mysql_database import get_db
+from spool import REJECTED_ERRORS, load_checkpoint, save_checkpoint
+
+# table -> (INSERT ... VALUES %s, row template)
+TABLES = {
+    "file_access_logs": ("""
+        INSERT INTO file_access_logs (user_id, file_name, file_path, action, file_size,
+                                      sensitivity_level, ip_address, device_id, access_time)
+        VALUES %s
+    """, "(%s, %s, %s, %s, %s, %s, %s, %s, %s)"),
+    "network_connections": ("""
+        INSERT INTO network_connections (user_id, remote_ip, remote_port, protocol, is_external)
+        VALUES %s
+    """, "(%s, %s, %s, %s, %s)"),
+    "network_logs": ("""
+        INSERT INTO network_logs (user_id, remote_ip, remote_port, protocol, external, timestamp)
+        VALUES %s
+    """, "(%s, %s, %s, %s, %s, %s)"),
+    "risk_events": ("""
+        INSERT INTO risk_events (user_id, event_type, risk_score, severity, description)
+        VALUES %s
+    """, "(%s, %s, %s, %s, %s)"),
+}
+
+POLICIES = ("drop", "spill")
+
+
+class WriteBehindQueue:
+    """Bounded queue of activity rows flushed to the database by a background thread.
+
+    Handlers call enqueue() and return immediately. The flusher gathers rows
+    until `batch_size` is reached or `max_latency` passes, then writes one
+    multi-row INSERT per table in a single transaction. enqueue() never
+    waits or touches the disk: when the queue is full the policy decides
+    between drop and spill. Spilled rows wait in a second bounded queue that
+    the flusher thread appends to a JSON-lines file, and the file is replayed
+    once the queue is idle. Replay stores its position in spool_checkpoints
+    in the same transaction as each batch, so a replay interrupted by a
+    failure or a restart resumes after the last committed batch.
+
+    Rows the database rejects (bad data, constraint violations) are isolated
+    by splitting the batch, set aside in <spill_path>.rejected and counted,
+    so one bad row cannot stop activity logging.
+    """
+
+    def __init__(self, batch_size=500, max_latency=0.5, queue_size=10000, policy="drop", spill_path=None):
+        if policy == "block":
+            # Waiting for room would stall the event loop enqueue() is called from
+            print("ACTIVITY_QUEUE_POLICY=block is no longer supported, using drop")
+            policy = "drop"
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown write-behind policy: {policy}")
+        self.batch_size = batch_size
+        self.max_latency = max_latency
+        self.policy = policy
+        self.spill_path = spill_path or None
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._overflow = queue.Queue(maxsize=queue_size)  # rows waiting to be spilled
+        self._spill_lock = threading.Lock()
+        self._thread = None
+        self._stopping = threading.Event()
+        self._retry_batch = []
+        self.enqueued = 0
+        self.flushed = 0
+        self.dropped = 0
+        self.spilled = 0
+        self.rejected = 0
+        self.flushes = 0
+        self.failures = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self._flush_ms_total = 0.0
+
+    def enqueue(self, table, row):
+        if table not in TABLES:
+            raise ValueError(f"Unknown write-behind table: {table}")
+        event = (table, tuple(row))
+        if self._thread is None:
+            # Not started (scripts, tests): write through
+            self._flush([event])
+            return
+        try:
+            self._queue.put_nowait(event)
+            self.enqueued += 1
+        except queue.Full:
+            if self.policy == "spill" and self.spill_path:
+                try:
+                    self._overflow.put_nowait(event)
+                    return
+                except queue.Full:
+                    pass
+            self.dropped += 1
+
+    def _spill(self, events, path=None):
+        with self._spill_lock:
+            with open(path or self.spill_path, "a", encoding="utf-8") as f:
+                for table, row in events:
+                    f.write(json.dumps([table, row], default=str) + "\n")
+        if path is None:
+            self.spilled += len(events)
+
+    def _spill_overflow(self):
+        """Write rows enqueue() could not queue to the spill file; runs on the flusher thread"""
+        events = []
+        while True:
+            try:
+                events.append(self._overflow.get_nowait())
+            except queue.Empty:
+                break
+        if events:
+            try:
+                self._spill(events)
+            except OSError as e:
+                self.dropped += len(events)
+                print(f"Activity spill failed, rows dropped: {e}")
+
+    def _reject(self, events, error):
+        self.rejected += len(events)
+        print(f"Activity row rejected by the database, set aside: {error}")
+        if self.spill_path:
+            self._spill(events, self.spill_path + ".rejected")
+
+    def _flush_isolating(self, batch, checkpoint=None, ends=None):
+        """Flush a batch, splitting it to set aside rows the database rejects.
+
+        With a checkpoint name, ends[i] is the replay position just past
+        batch[i] and is saved with every part that commits. Any other error is
+        raised with `unflushed` set to the rows not yet written, in order, so a
+        retry does not write any row twice.
+        """
+        pending = [(0, len(batch))]
+        while pending:
+            start, stop = pending.pop()
+            part = batch[start:stop]
+            mark = (checkpoint, ends[stop - 1]) if checkpoint else None
+            try:
+                self._flush(part, mark)
+            except REJECTED_ERRORS as e:
+                if len(part) == 1:
+                    if mark:
+                        self._save_mark(mark)
+                    self._reject(part, e)
+                else:
+                    middle = (start + stop) // 2
+                    pending += [(middle, stop), (start, middle)]
+            except Exception as e:
+                # The pending parts follow this one, so everything from here on is unwritten
+                e.unflushed = batch[start:]
+                raise
+
+    def _save_mark(self, mark):
+        with get_db() as conn:
+            cursor = conn.cursor()
+            save_checkpoint(cursor, mark[0], 0, mark[1])
+            cursor.close()
+
+    def _replay_spill(self):
+        """Feed spilled rows back through the flusher, resuming a replay that stopped partway"""
+        if not self.spill_path:
+            return
+        with self._spill_lock:
+            replays = sorted(glob.glob(glob.escape(self.spill_path) + ".replay*"))
+            if not replays:
+                if not os.path.exists(self.spill_path):
+                    return
+                # A fresh name per file, so its checkpoint never applies to a later one
+                replays = [f"{self.spill_path}.replay-{time.time_ns()}-{uuid.uuid4().hex[:8]}"]
+                os.replace(self.spill_path, replays[0])
+        replay_path = replays[0]
+        checkpoint = f"activity-spill:{os.path.basename(replay_path)}"
+        with get_db() as conn:
+            cursor = conn.cursor()
+            position = (load_checkpoint(cursor, checkpoint) or (0, 0))[1]
+            cursor.close()
+        events, ends = [], []
+        with open(replay_path, "rb") as f:
+            f.seek(position)
+            for line in f:
+                position += len(line)
+                try:
+                    table, row = json.loads(line)
+                except ValueError:
+                    continue
+                if table in TABLES:
+                    events.append((table, tuple(row)))
+                    ends.append(position)
+        for i in range(0, len(events), self.batch_size):
+            self._flush_isolating(events[i:i + self.batch_size], checkpoint, ends[i:i + self.batch_size])
+        os.remove(replay_path)
+        with get_db() as conn:
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM spool_checkpoints WHERE name = %s", (checkpoint,))
+            cursor.close()
+
+    def _collect(self):
+        """Wait for a row, then keep gathering until the batch is full or max_latency passes"""
+        batch = self._retry_batch
+        self._retry_batch = []
+        if not batch:
+            try:
+                batch.append(self._queue.get(timeout=self.max_latency))
+            except queue.Empty:
+                return batch
+        deadline = time.monotonic() + self.max_latency
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0 and not self._stopping.is_set():
+                    batch.append(self._queue.get(timeout=remaining))
+                else:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _flush(self, batch, mark=None):
+        """Write the rows in one transaction, with the replay position (checkpoint name, position) if given"""
+        started = time.perf_counter()
+        by_table = {}
+        for table, row in batch:
+            by_table.setdefault(table, []).append(row)
+        with get_db() as conn:
+            cursor = conn.cursor()
+            for table, rows in by_table.items():
+                sql, template = TABLES[table]
+                psycopg2.extras.execute_values(cursor, sql, rows, template=template, page_size=len(rows))
+            if mark:
+                save_checkpoint(cursor, mark[0], 0, mark[1])
+            cursor.close()
+        elapsed = (time.perf_counter() - started) * 1000
+        self.flushed += len(batch)
+        self.flushes += 1
+        self.last_flush_ms = elapsed
+        self.max_flush_ms = max(self.max_flush_ms, elapsed)
+        self._flush_ms_total += elapsed
+
+    def _run(self):
+        backoff = 1.0
+        while True:
+            self._spill_overflow()
+            batch = self._collect()
+            try:
+                if batch:
+                    self._flush_isolating(batch)
+                elif self._stopping.is_set():
+                    return
+                else:
+                    self._replay_spill()
+                backoff = 1.0
+            except Exception as e:
+                self.failures += 1
+                print(f"Activity flush failed, retrying in {backoff:.0f}s: {e}")
+                if batch:
+                    batch = getattr(e, "unflushed", batch)
+                if self._stopping.is_set():
+                    if batch and self.spill_path:
+                        self._spill(batch)
+                    elif batch:
+                        self.dropped += len(batch)
+                    return
+                self._retry_batch = batch
+                self._stopping.wait(backoff)
+                backoff = min(backoff * 2, 30.0)
+
+    def start(self):
+        if self._thread is None:
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name="activity-writer", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=10):
+        """Flush queued rows and stop the flusher"""
+        if self._thread is not None:
+            self._stopping.set()
+            self._thread.join(timeout=timeout)
+            self._thread = None
+            self._spill_overflow()
+
+    def stats(self):
+        return {
+            "policy": self.policy,
+            "queue_depth": self._queue.qsize(),
+            "queue_size": self._queue.maxsize,
+            "enqueued": self.enqueued,
+            "flushed": self.flushed,
+            "dropped": self.dropped,
+            "spilled": self.spilled,
+            "spill_pending": self._overflow.qsize(),
+            "rejected": self.rejected,
+            "flushes": self.flushes,
+            "failures": self.failures,
+            "last_flush_ms": round(self.last_flush_ms, 2),
+            "max_flush_ms": round(self.max_flush_ms, 2),
+            "avg_flush_ms": round(self._flush_ms_total / self.flushes, 2) if self.flushes else 0.0,
+            "running": self._thread is not None
+        }
+
+
+activity_writer = WriteBehindQueue(
+    batch_size=int(os.getenv("ACTIVITY_BATCH_SIZE", "500")),
+    max_latency=float(os.getenv("ACTIVITY_FLUSH_INTERVAL", "0.5")),
+    queue_size=int(os.getenv("ACTIVITY_QUEUE_SIZE", "10000")),
+    policy=os.getenv("ACTIVITY_QUEUE_POLICY", "drop"),
+    spill_path=os.getenv("ACTIVITY_SPILL_PATH", "")
+)